@@ -269,9 +269,9 @@ def is_anomalously_anomalous(metric_name, ensemble, datapoint):
     return abs(intervals[-1] - mean) > 3 * stdDev
 
 
-def run_selected_algorithm(timeseries, metric_name):
+def filter_timeseries(timeseries):
     """
-    Filter timeseries and run selected algorithm.
+    Raise if timeseries isn't worth running the algorithms over.
     """
     # Get rid of short series
     if len(timeseries) < MIN_TOLERABLE_LENGTH:
@@ -290,17 +290,32 @@ def run_selected_algorithm(timeseries, metric_name):
     if len(set(item[1] for item in timeseries[-MAX_TOLERABLE_BOREDOM:])) == BOREDOM_SET_SIZE:
         raise Boring()
 
-    try:
-        ensemble = [globals()[algorithm](timeseries) for algorithm in ALGORITHMS]
-        threshold = len(ensemble) - CONSENSUS
-        if ensemble.count(False) <= threshold:
-            if ENABLE_SECOND_ORDER:
-                if is_anomalously_anomalous(metric_name, ensemble, timeseries[-1][1]):
-                    return True, ensemble, timeseries[-1][1]
-            else:
+
+def judge(ensemble, timeseries, metric_name):
+    """
+    Decide whether enough algorithms of the ensemble agree that timeseries is
+    anomalous.
+    """
+    threshold = len(ensemble) - CONSENSUS
+    if ensemble.count(False) <= threshold:
+        if ENABLE_SECOND_ORDER:
+            if is_anomalously_anomalous(metric_name, ensemble, timeseries[-1][1]):
                 return True, ensemble, timeseries[-1][1]
+        else:
+            return True, ensemble, timeseries[-1][1]
+
+    return False, ensemble, timeseries[-1][1]
 
-        return False, ensemble, timeseries[-1][1]
+
+def run_selected_algorithm(timeseries, metric_name):
+    """
+    Filter timeseries and run selected algorithm.
+    """
+    filter_timeseries(timeseries)
+
+    try:
+        ensemble = [globals()[algorithm](timeseries) for algorithm in ALGORITHMS]
+        return judge(ensemble, timeseries, metric_name)
     except:
         logging.error("Algorithm error: " + traceback.format_exc())
         return False, [], 1
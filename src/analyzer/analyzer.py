@@ -1,25 +1,19 @@
 import logging
-<<<<<<< HEAD
-=======
 from Queue import Empty
-from redis import StrictRedis
->>>>>>> bcb25d59fa66f2f6261386b406941623c10ebe49
 from time import time, sleep
 from threading import Thread
 from collections import defaultdict
-from multiprocessing import Process, Manager, Queue
-from msgpack import Unpacker, unpackb, packb
-from os import path, kill, getpid, system
-from math import ceil
-import traceback
-import operator
+from multiprocessing import Queue
+from msgpack import packb
+from os import kill, getpid, system
 import settings
 import socket
 from ring import RedisRing
+from lease import Leases
+from codec import hash_tag, storage_key, read_format, decode_timeseries
+from worker import Worker
 
 from alerters import trigger_alert
-from algorithms import run_selected_algorithm
-from algorithm_exceptions import *
 
 logger = logging.getLogger("AnalyzerLog")
 
@@ -30,13 +24,21 @@ class Analyzer(Thread):
         Initialize the Analyzer
         """
         super(Analyzer, self).__init__()
-        self.ring = RedisRing(settings.REDIS_BACKENDS)
+        self.ring = RedisRing(settings.REDIS_BACKENDS, logger)
         self.daemon = True
         self.parent_pid = parent_pid
         self.current_pid = getpid()
-        self.anomalous_metrics = Manager().list()
-        self.exceptions_q = Queue()
-        self.anomaly_breakdown_q = Queue()
+        self.leases = Leases(self.ring, 'analyzer', socket.gethostname())
+        self.worker_timeout = getattr(settings, 'ANALYZER_WORKER_TIMEOUT', 300)
+
+        # Long lived workers, each with its own queues of tasks and of
+        # results, and the metrics of each partition they were last sent.
+        # Terminating a worker can leave its queues corrupt, so they are
+        # never shared with the others.
+        self.workers = {}
+        self.tasks = {}
+        self.results = {}
+        self.sent = {}
 
     def check_if_parent_is_alive(self):
         """
@@ -48,125 +50,91 @@ class Analyzer(Thread):
         except:
             exit(0)
 
-    def spin_process(self, i, unique_metrics):
-        process_key = '.'.join(['skyline','analyzer', socket.gethostname(), str(i)])
-        alive_key = '.'.join([process_key, 'alive'])
-        self.ring.run('set', alive_key, 1)
-        self.ring.run('expire', alive_key, 30)
+    def spawn(self, i):
         """
-        Assign a bunch of metrics for a process to analyze.
+        Start a worker, or start it again if it died.
         """
-        processes = list(self.ring.run('zrange', settings.ANALYZER_PROCESS_KEY, 0, -1))
-        for key in processes:
-            value = self.ring.run('get', key)
-            if not value:
-                self.ring.run('zrem', settings.ANALYZER_PROCESS_KEY, 0, key)
+        self.tasks[i] = Queue()
+        self.results[i] = Queue()
+        self.sent[i] = {}
+        self.workers[i] = Worker(self.current_pid, i, self.tasks[i], self.results[i])
+        self.workers[i].start()
 
-        # Add current process to index and determine position
-        if not self.ring.run('zscore', settings.ANALYZER_PROCESS_KEY, alive_key):
-            self.ring.run('zadd', settings.ANALYZER_PROCESS_KEY, time(), alive_key)
-        self.ring.run('expire', settings.ANALYZER_PROCESS_KEY, 60)
-        process_position = self.ring.run('zrank', settings.ANALYZER_PROCESS_KEY, alive_key) + 1
-        process_count = self.ring.run('zcard', settings.ANALYZER_PROCESS_KEY)
-
-        # If there are less processes then we know are going to be running assume
-        # the others will start
-        if process_count < settings.ANALYZER_PROCESSES:
-            process_count = settings.ANALYZER_PROCESSES
-
-        # Discover assigned metrics
-        keys_per_processor = int(ceil(float(len(unique_metrics)) / float(process_count)))
-        if process_position == process_count:
-            assigned_max = len(unique_metrics)
-        else:
-            assigned_max = process_position * keys_per_processor
-        assigned_min = assigned_max - keys_per_processor
-        assigned_keys = range(assigned_min, assigned_max)
-
-        # Compile assigned metrics
-        assigned_metrics = [unique_metrics[index] for index in assigned_keys]
-
-        # Check if this process is unnecessary
-        if len(assigned_metrics) == 0:
-            return
-
-        # Multi get series
-        raw_assigned = self.ring.run('mget', assigned_metrics)
-
-        # Make process-specific dicts
-        exceptions = defaultdict(int)
-        anomaly_breakdown = defaultdict(int)
-
-        # Distill timeseries strings into lists
-        for i, metric_name in enumerate(assigned_metrics):
+    def dispatch(self, cycle, unique_metrics, partitions):
+        """
+        Send each worker its share of partitions, with the metrics of those
+        that changed since it was last sent them.
+        """
+        metrics = defaultdict(list)
+        for metric in unique_metrics:
+            metrics[self.leases.partition(metric)].append(metric)
+
+        for i in self.workers:
+            # Partitions stick to the same worker as long as the process
+            # count doesn't change
+            assigned = [partition for partition in partitions
+                        if partition % settings.ANALYZER_PROCESSES == i - 1]
+            updates = {}
+            for partition in assigned:
+                if self.sent[i].get(partition) != metrics[partition]:
+                    updates[partition] = metrics[partition]
+            self.sent[i] = dict((partition, metrics[partition]) for partition in assigned)
+            self.tasks[i].put((cycle, assigned, updates))
+
+    def collect(self, cycle, partitions):
+        """
+        Wait for every worker to send back its results for cycle, renewing
+        the leases of partitions meanwhile. Returns the results, and the
+        partitions still held. A worker that died, or that is still at it
+        after ANALYZER_WORKER_TIMEOUT seconds, is started again, and its
+        share is skipped this cycle.
+        """
+        results = []
+        partitions = set(partitions)
+        pending = set(self.workers)
+        started = renewed = time()
+        while pending:
             self.check_if_parent_is_alive()
 
-            try:
-                raw_series = raw_assigned[i]
-                unpacker = Unpacker(use_list = False)
-                unpacker.feed(raw_series)
-                timeseries = list(unpacker)
-
-                anomalous, ensemble, datapoint = run_selected_algorithm(timeseries, metric_name)
-
-                # If it's anomalous, add it to list
-                if anomalous:
-                    base_name = metric_name.replace(settings.FULL_NAMESPACE, '', 1)
-                    metric = [datapoint, base_name]
-                    self.anomalous_metrics.append(metric)
+            if time() - renewed > self.leases.ttl / 3:
+                partitions.intersection_update(self.leases.renew(sorted(partitions)))
+                renewed = time()
 
-                    # Get the anomaly breakdown - who returned True?
-                    for index, value in enumerate(ensemble):
-                        if value:
-                            algorithm = settings.ALGORITHMS[index]
-                            anomaly_breakdown[algorithm] += 1
-
-            # It could have been deleted by the Roomba
-            except TypeError:
-                exceptions['DeletedByRoomba'] += 1
-            except TooShort:
-                exceptions['TooShort'] += 1
-            except Stale:
-                exceptions['Stale'] += 1
-            except Incomplete:
-                exceptions['Incomplete'] += 1
-            except Boring:
-                exceptions['Boring'] += 1
-            except:
-                exceptions['Other'] += 1
-                logger.info(traceback.format_exc())
-
-        # if anomalies detected Pack and Write anomoly data to Redis
-        if len(anomalous_metrics) > 0:
-            packed = Packer().pack(anomalous_metrics)
-            self.ring.run('set', process_key, packed)
-            # expire the key in 30s so anomalys don't show up for too long
-            self.ring.run('expire', process_key, 30)
-            self.ring.run('sadd', settings.ANALYZER_ANOMALY_KEY, process_key)
-            # expire the key in 60s so anomalys don't show up for too long
-            self.ring.run('expire', settings.ANALYZER_ANOMALY_KEY, 60)
-
-        # Collate process-specific dicts to main dicts
-        with self.lock:
-            for key, value in anomaly_breakdown.items():
-                if key not in self.anomaly_breakdown:
-                    self.anomaly_breakdown[key] = value
-                else:
-        	        self.anomaly_breakdown[key] += value
-
-            for key, value in exceptions.items():
-                if key not in self.exceptions:
-                    self.exceptions[key] = value
-                else:
-        	        self.exceptions[key] += value
+            # Take the results that came in, skipping those of a cycle given
+            # up on
+            received = False
+            for i in sorted(pending):
+                try:
+                    result = self.results[i].get_nowait()
+                except Empty:
+                    continue
+                received = True
+                if result[1] == cycle:
+                    pending.discard(i)
+                    results.append(result)
+            if received:
+                continue
 
-        for key, value in exceptions.items():
-            self.exceptions_q.put((key, value))
+            if time() - started > self.worker_timeout:
+                for i in pending:
+                    logger.error('analyzer worker %d hung, starting it again' % i)
+                    self.workers[i].terminate()
+                    self.spawn(i)
+                break
+
+            for i in list(pending):
+                if not self.workers[i].is_alive():
+                    logger.error('analyzer worker %d died, starting it again' % i)
+                    self.spawn(i)
+                    pending.discard(i)
+            sleep(0.1)
+        return results, sorted(partitions)
 
     def run(self):
         """
         Called when the process intializes.
         """
+        cycle = 0
         while 1:
             now = time()
             # Make sure Redis is up
@@ -174,7 +142,6 @@ class Analyzer(Thread):
                 self.ring.check_connections()
             except:
                 sleep(10)
-                self.ring = RedisRing(settings.REDIS_BACKENDS)
                 continue
 
             # Discover unique metrics
@@ -185,50 +152,43 @@ class Analyzer(Thread):
                 sleep(10)
                 continue
 
-            # Spawn processes
-            pids = []
+            # Start the workers, and any that died since the last cycle
             for i in range(1, settings.ANALYZER_PROCESSES + 1):
-                if i > len(unique_metrics):
-                    logger.info('WARNING: skyline is set for more cores than needed.')
-                    break
-
-                p = Process(target=self.spin_process, args=(i, unique_metrics))
-                pids.append(p)
-                p.start()
-
-            # Send wait signal to zombie processes
-            for p in pids:
-                p.join()
-
-            # Grab data from the queue and populate dictionaries
-            exceptions = dict()
-            anomaly_breakdown = dict()
-            while 1:
-                try:
-                    key, value = self.anomaly_breakdown_q.get_nowait()
-                    if key not in anomaly_breakdown.keys():
-                        anomaly_breakdown[key] = value
-                    else:
-                        anomaly_breakdown[key] += value
-                except Empty:
-                    break
-
-            while 1:
-                try:
-                    key, value = self.exceptions_q.get_nowait()
-                    if key not in exceptions.keys():
-                        exceptions[key] = value
-                    else:
-                        exceptions[key] += value
-                except Empty:
-                    break
+                if i not in self.workers or not self.workers[i].is_alive():
+                    self.spawn(i)
+
+            # Analyze the partitions this host holds, and those it stole
+            # from hosts that fell behind
+            cycle += 1
+            partitions = self.leases.acquire()
+            stolen = self.leases.steal()
+            held = sorted(set(partitions + stolen))
+            self.dispatch(cycle, unique_metrics, held)
+            results, held = self.collect(cycle, held)
+            self.leases.finish(held)
+            self.leases.release([partition for partition in stolen if partition in held])
+
+            # Gather the results
+            total = 0
+            anomalous_metrics = []
+            exceptions = defaultdict(int)
+            anomaly_breakdown = defaultdict(int)
+            for i, result_cycle, count, anomalies, result_exceptions, breakdown in results:
+                total += count
+                anomalous_metrics.extend(anomalies)
+                for key, value in result_exceptions.items():
+                    exceptions[key] += value
+                for key, value in breakdown.items():
+                    anomaly_breakdown[key] += value
+            exceptions = dict(exceptions)
+            anomaly_breakdown = dict(anomaly_breakdown)
 
             # Send alerts
             if settings.ENABLE_ALERTS:
                 for alert in settings.ALERTS:
-                    for metric in self.anomalous_metrics:
+                    for metric in anomalous_metrics:
                         if alert[0] in metric[1]:
-                            cache_key = 'last_alert.%s.%s' % (alert[1], metric[1])
+                            cache_key = 'last_alert.%s.%s' % (alert[1], hash_tag(settings.FULL_NAMESPACE + metric[1]))
                             try:
                                 last_alert = self.ring.run('get', cache_key)
                                 if not last_alert:
@@ -240,9 +200,9 @@ class Analyzer(Thread):
 
             # Log progress
             logger.info('seconds to run    :: %.2f' % (time() - now))
-            logger.info('total metrics     :: %d' % len(unique_metrics))
-            logger.info('total analyzed    :: %d' % (len(unique_metrics) - sum(exceptions.values())))
-            logger.info('total anomalies   :: %d' % len(self.anomalous_metrics))
+            logger.info('total metrics     :: %d' % total)
+            logger.info('total analyzed    :: %d' % (total - sum(exceptions.values())))
+            logger.info('total anomalies   :: %d' % len(anomalous_metrics))
             logger.info('exception stats   :: %s' % exceptions)
             logger.info('anomaly breakdown :: %s' % anomaly_breakdown)
 
@@ -250,14 +210,15 @@ class Analyzer(Thread):
             if settings.GRAPHITE_HOST != '':
                 host = settings.GRAPHITE_HOST.replace('http://', '')
                 system('echo skyline.analyzer.run_time %.2f %s | nc -w 3 %s 2003' % ((time() - now), now, host))
-                system('echo skyline.analyzer.total_analyzed %d %s | nc -w 3 %s 2003' % ((len(unique_metrics) - sum(exceptions.values())), now, host))
+                system('echo skyline.analyzer.total_analyzed %d %s | nc -w 3 %s 2003' % ((total - sum(exceptions.values())), now, host))
+                for name, value in self.ring.health_metrics():
+                    system('echo %s %s %s | nc -w 3 %s 2003' % (name, value, now, host))
 
             # Check canary metric
-            raw_series = self.ring.run('get', settings.FULL_NAMESPACE + settings.CANARY_METRIC)
+            fmt = read_format()
+            raw_series = self.ring.run('get', storage_key(settings.FULL_NAMESPACE + settings.CANARY_METRIC, fmt))
             if raw_series is not None:
-                unpacker = Unpacker(use_list = False)
-                unpacker.feed(raw_series)
-                timeseries = list(unpacker)
+                timeseries = decode_timeseries(raw_series, fmt)
                 time_human = (timeseries[-1][0] - timeseries[0][0]) / 3600
                 projected = 24 * (time() - now) / time_human
 
@@ -267,9 +228,6 @@ class Analyzer(Thread):
                     system('echo skyline.analyzer.duration %.2f %s | nc -w 3 %s 2003' % (time_human, now, host))
                     system('echo skyline.analyzer.projected %.2f %s | nc -w 3 %s 2003' % (projected, now, host))
 
-            # Reset counters
-            self.anomalous_metrics[:] = []
-
             # Sleep if it went too fast
             if time() - now < 5:
                 logger.info('sleeping due to low run time...')
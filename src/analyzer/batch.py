@@ -0,0 +1,272 @@
+"""
+The algorithms, run over many metrics at once.
+
+Series are stacked into 2D arrays with a column per metric, padded with NaN at
+the top so that the latest datapoints of every metric line up on the last
+row. Each algorithm then works down all the columns in a handful of NumPy
+calls, instead of building pandas Series metric by metric.
+
+These agree with the algorithms in algorithms.py, up to floating point
+rounding that only matters for values right on a threshold. Algorithms
+without a version here, and series with values that aren't finite, are run
+one metric at a time. Given the running statistics of each series, the
+algorithms in streaming.py take over from those here that they cover.
+"""
+import logging
+import traceback
+import numpy as np
+import scipy.stats
+from itertools import chain
+from time import time
+
+from settings import ALGORITHMS, FULL_DURATION
+
+import algorithms
+from streaming import STREAMING_ALGORITHMS
+
+logger = logging.getLogger("AnalyzerLog")
+
+
+def as_array(series):
+    """
+    A series of (timestamp, value) datapoints as an (n, 2) float64 array.
+    """
+    if isinstance(series, np.ndarray):
+        return series.astype('<f8', copy=False).reshape(-1, 2)
+    # Much quicker than np.array over a list of tuples
+    return np.fromiter(chain.from_iterable(series), '<f8', 2 * len(series)).reshape(-1, 2)
+
+
+def stack(timeseries):
+    """
+    Stack series of (timestamp, value) datapoints into 2D arrays of
+    timestamps and of values, with a column per series. Returns them with
+    the number of datapoints in each series.
+    """
+    arrays = [as_array(series) for series in timeseries]
+    lengths = np.array([len(array) for array in arrays], dtype=np.intp)
+    rows = lengths.max() if len(arrays) else 0
+
+    stacked = np.empty((rows, len(arrays), 2))
+    stacked.fill(np.nan)
+    for column, array in enumerate(arrays):
+        stacked[rows - len(array):, column] = array
+    return stacked[:, :, 0].copy(), stacked[:, :, 1].copy(), lengths
+
+
+def mean(values, counts):
+    """
+    The mean of each column, skipping NaN.
+    """
+    return np.nansum(values, axis=0) / counts
+
+
+def std(values, counts, ddof):
+    """
+    The standard deviation of each column, skipping NaN.
+    """
+    deviations = values - mean(values, counts)
+    return np.sqrt(np.nansum(deviations * deviations, axis=0) / (counts - ddof))
+
+
+def tail_avg(values, lengths):
+    """
+    The average of the last three datapoints of each column, or the last
+    datapoint of those that are shorter.
+    """
+    tail = values[-1].copy()
+    if len(values) >= 3:
+        averages = (values[-1] + values[-2] + values[-3]) / 3
+        tail[lengths >= 3] = averages[lengths >= 3]
+    return tail
+
+
+def median_absolute_deviation(timestamps, values, lengths, tail):
+    """
+    A timeseries is anomalous if the deviation of its latest datapoint with
+    respect to the median is X times larger than the median of deviations.
+
+    Like the scalar version, this is None rather than False for metrics
+    whose latest datapoint is within bounds.
+    """
+    median = np.nanmedian(values, axis=0)
+    demedianed = np.abs(values - median)
+    median_deviation = np.nanmedian(demedianed, axis=0)
+    test_statistic = demedianed[-1] / median_deviation
+
+    return [False if deviation == 0 else (True if statistic > 6 else None)
+            for deviation, statistic in zip(median_deviation, test_statistic)]
+
+
+def grubbs(timestamps, values, lengths, tail):
+    """
+    A timeseries is anomalous if the Z score is greater than the Grubb's score.
+    """
+    z_score = (tail - mean(values, lengths)) / std(values, lengths, 0)
+    len_series = lengths.astype('<f8')
+    threshold = scipy.stats.t.isf(.05 / (2 * len_series), len_series - 2)
+    threshold_squared = threshold * threshold
+    grubbs_score = ((len_series - 1) / np.sqrt(len_series)) * np.sqrt(threshold_squared / (len_series - 2 + threshold_squared))
+
+    return z_score > grubbs_score
+
+
+def first_hour_average(timestamps, values, lengths, tail):
+    """
+    Calcuate the simple average over one hour, FULL_DURATION seconds ago.
+    A timeseries is anomalous if the average of the last three datapoints
+    are outside of three standard deviations of this value.
+    """
+    first_hour = timestamps < time() - (FULL_DURATION - 3600)
+    series = np.where(first_hour, values, np.nan)
+    counts = first_hour.sum(axis=0)
+
+    return np.abs(tail - mean(series, counts)) > 3 * std(series, counts, 1)
+
+
+def stddev_from_average(timestamps, values, lengths, tail):
+    """
+    A timeseries is anomalous if the absolute value of the average of the latest
+    three datapoint minus the moving average is greater than one standard
+    deviation of the average.
+    """
+    return np.abs(tail - mean(values, lengths)) > 3 * std(values, lengths, 1)
+
+
+def least_squares(timestamps, values, lengths, tail):
+    """
+    A timeseries is anomalous if the average of the last three datapoints
+    on a projected least squares model is greater than three sigma.
+
+    The line is fitted with the closed form over centered timestamps, which
+    doesn't need a solver for each metric.
+    """
+    x_mean = mean(timestamps, lengths)
+    y_mean = mean(values, lengths)
+    x = timestamps - x_mean
+    m = np.nansum(x * (values - y_mean), axis=0) / np.nansum(x * x, axis=0)
+    c = y_mean - m * x_mean
+    errors = values - (m * timestamps + c)
+
+    if len(errors) < 3:
+        return np.zeros(len(lengths), dtype=bool)
+
+    std_dev = std(errors, lengths, 0)
+    t = (errors[-1] + errors[-2] + errors[-3]) / 3
+
+    # round() goes half away from zero, so round(t) != 0 when |t| >= 0.5
+    return (lengths >= 3) & (np.abs(t) > std_dev * 3) & (std_dev >= 0.5) & (np.abs(t) >= 0.5)
+
+
+def histogram_bins(timestamps, values, lengths, tail):
+    """
+    A timeseries is anomalous if the average of the last three datapoints falls
+    into a histogram bin with less than 20 other datapoints (you'll need to tweak
+    that number depending on your data)
+
+    The datapoints are binned the way np.histogram bins them, with its bin
+    edges worked out the way np.linspace lays them out.
+    """
+    bins = 15
+    columns = values.shape[1]
+    padding = np.isnan(values)
+
+    # Bin edges, as np.histogram picks them
+    first = np.nanmin(values, axis=0)
+    last = np.nanmax(values, axis=0)
+    flat = first == last
+    first = np.where(flat, first - 0.5, first)
+    last = np.where(flat, last + 0.5, last)
+    edges = np.arange(bins + 1.0).reshape(-1, 1) * ((last - first) / bins) + first
+    edges[-1] = last
+
+    # Bin the datapoints, correcting the ones that land a rounding error off
+    series = np.where(padding, first, values)
+    indices = ((series - first) * (bins / (last - first))).astype(np.intp)
+    indices[indices == bins] -= 1
+    column = np.arange(columns)
+    indices[series < edges[indices, column]] -= 1
+    increment = (series >= edges[indices + 1, column]) & (indices != bins - 1)
+    indices[increment] += 1
+
+    positions = (indices * columns + np.arange(columns))[~padding]
+    bin_sizes = np.bincount(positions, minlength=bins * columns).reshape(bins, columns)
+
+    small = bin_sizes <= 20
+    # Is it in the first bin?
+    anomalous = small[0] & (tail <= edges[0])
+    # Is it in any other bin?
+    anomalous |= (small[1:] & (tail >= edges[1:-1]) & (tail < edges[2:])).any(axis=0)
+    return anomalous
+
+
+BATCH_ALGORITHMS = {
+    'median_absolute_deviation': median_absolute_deviation,
+    'grubbs': grubbs,
+    'first_hour_average': first_hour_average,
+    'stddev_from_average': stddev_from_average,
+    'least_squares': least_squares,
+    'histogram_bins': histogram_bins,
+}
+
+
+def run_algorithms(timeseries, names=ALGORITHMS, states=None):
+    """
+    Run the algorithms named over many series, and return the ensemble of
+    each, as run_selected_algorithm would make it. With states, the
+    SeriesState of each series, those are brought up to date and the
+    algorithms that can work from them do.
+    """
+    ensembles = [[None] * len(names) for series in timeseries]
+    arrays = [as_array(series) for series in timeseries]
+    batched = [i for i, array in enumerate(arrays) if len(array) and np.isfinite(array).all()]
+
+    found = set()
+    if batched:
+        timestamps, values, lengths = stack([arrays[i] for i in batched])
+        with np.errstate(all='ignore'):
+            tail = tail_avg(values, lengths)
+            if states is not None:
+                for i in batched:
+                    states[i].update(arrays[i])
+                totals = np.array([states[i].total for i in batched])
+
+            for position, name in enumerate(names):
+                if states is not None and name in STREAMING_ALGORITHMS:
+                    results = STREAMING_ALGORITHMS[name](totals, timestamps, values, lengths, tail)
+                elif name in BATCH_ALGORITHMS:
+                    results = BATCH_ALGORITHMS[name](timestamps, values, lengths, tail)
+                else:
+                    continue
+                for i, result in zip(batched, list(results)):
+                    ensembles[i][position] = result
+                found.add(position)
+
+    batched = set(batched)
+    for i, series in enumerate(timeseries):
+        for position, name in enumerate(names):
+            if i not in batched or position not in found:
+                ensembles[i][position] = getattr(algorithms, name)(series)
+    return ensembles
+
+
+def run_selected_algorithms(timeseries, metric_names, states=None):
+    """
+    Like run_selected_algorithm, for many series that already went through
+    filter_timeseries. If the batch fails, the series are run one at a time.
+    """
+    try:
+        ensembles = run_algorithms(timeseries, states=states)
+    except:
+        logger.error("Batch algorithm error: " + traceback.format_exc())
+        return [algorithms.run_selected_algorithm(series, metric_name)
+                for series, metric_name in zip(timeseries, metric_names)]
+
+    results = []
+    for series, metric_name, ensemble in zip(timeseries, metric_names, ensembles):
+        try:
+            results.append(algorithms.judge(ensemble, series, metric_name))
+        except:
+            logger.error("Algorithm error: " + traceback.format_exc())
+            results.append((False, [], 1))
+    return results
@@ -0,0 +1,258 @@
+"""
+Statistics of every metric, kept up to date between analyzer runs.
+
+Rather than working out means, deviations, moving averages and regressions
+over a whole series every run, the analyzer processes keep the moments of
+each series and only fold in the datapoints that came in since. Moments are
+merged pairwise, the way Chan et al. combine variances, so nothing is ever
+subtracted and rounding errors don't build up.
+
+Datapoints expire from the front of a series as the Roomba trims it. To drop
+them, the moments are kept in runs of about BLOCK_SIZE datapoints: runs that
+expired are dropped, and the one still expiring is worked out again from
+what is left of it in the series.
+"""
+import logging
+import numpy as np
+import scipy.stats
+from random import randrange
+
+logger = logging.getLogger("AnalyzerLog")
+
+# Datapoints in a run of moments
+BLOCK_SIZE = 360
+
+# The weight each datapoint loses to the next in stddev_from_moving_average,
+# for an EWMA with com=50
+DECAY = 1 - 1 / 51.0
+
+# Fields of a set of moments
+COUNT, FIRST, LAST, MEAN_X, MEAN_Y, M_XX, M_YY, M_XY, WEIGHT, WEIGHT2, EW_MEAN, EW_M2 = range(12)
+
+
+def moments(series):
+    """
+    The moments of an (n, 2) array of datapoints: their count, first and
+    last timestamps, the means and co-moments of timestamps and values, and
+    the total weight, total squared weight, mean and second moment of the
+    values with the weights of an EWMA.
+    """
+    x = series[:, 0]
+    y = series[:, 1]
+    count = len(series)
+    mean_x = x.mean()
+    mean_y = y.mean()
+    dx = x - mean_x
+    dy = y - mean_y
+
+    weights = DECAY ** np.arange(count - 1, -1, -1.0)
+    weight = weights.sum()
+    ew_mean = weights.dot(y) / weight
+    dew = y - ew_mean
+
+    return (count, x[0], x[-1], mean_x, mean_y, dx.dot(dx), dy.dot(dy), dx.dot(dy),
+            weight, weights.dot(weights), ew_mean, weights.dot(dew * dew))
+
+
+def merge(a, b):
+    """
+    The moments of the datapoints of a followed by those of b.
+    """
+    if a is None:
+        return b
+    if b is None:
+        return a
+
+    count = a[COUNT] + b[COUNT]
+    factor = a[COUNT] * b[COUNT] / float(count)
+    dx = b[MEAN_X] - a[MEAN_X]
+    dy = b[MEAN_Y] - a[MEAN_Y]
+
+    # The datapoints of a lose weight for every datapoint of b
+    decay = DECAY ** b[COUNT]
+    weight_a = a[WEIGHT] * decay
+    weight = weight_a + b[WEIGHT]
+    de = b[EW_MEAN] - a[EW_MEAN]
+
+    return (count, a[FIRST], b[LAST],
+            a[MEAN_X] + dx * b[COUNT] / count,
+            a[MEAN_Y] + dy * b[COUNT] / count,
+            a[M_XX] + b[M_XX] + dx * dx * factor,
+            a[M_YY] + b[M_YY] + dy * dy * factor,
+            a[M_XY] + b[M_XY] + dx * dy * factor,
+            weight,
+            a[WEIGHT2] * decay * decay + b[WEIGHT2],
+            a[EW_MEAN] + de * b[WEIGHT] / weight,
+            a[EW_M2] * decay + b[EW_M2] + de * de * weight_a * b[WEIGHT] / weight)
+
+
+def summarize(runs):
+    """
+    The moments of a list of runs, in order.
+    """
+    return reduce(merge, runs, None)
+
+
+def drifted(a, b, tolerance=1e-6):
+    """
+    Whether two sets of moments of the same series disagree on the
+    statistics the algorithms use by more than tolerance of the size of
+    its values.
+    """
+    scale = tolerance * (abs(b[MEAN_Y]) + np.sqrt(b[M_YY] / b[COUNT]))
+
+    def statistics(m):
+        slope = m[M_XY] / m[M_XX] if m[M_XX] else 0.0
+        return (m[MEAN_Y],
+                np.sqrt(m[M_YY] / m[COUNT]),
+                slope * np.sqrt(m[M_XX] / m[COUNT]),
+                np.sqrt(max(m[M_YY] - slope * m[M_XY], 0) / m[COUNT]),
+                m[EW_MEAN],
+                np.sqrt(m[EW_M2] / m[WEIGHT]))
+
+    return a[:3] != b[:3] or any(abs(p - q) > scale for p, q in zip(statistics(a), statistics(b)))
+
+
+class SeriesState(object):
+    """
+    The moments of one metric's series, as of the last time it was seen.
+    """
+    def __init__(self, name, verify_interval=0):
+        self.name = name
+        self.verify_interval = verify_interval
+        # Spread the checks of different metrics over different runs
+        self.updates = randrange(verify_interval) if verify_interval else 0
+        self.runs = []
+        self.middle = None
+        self.total = None
+
+    def rebuild(self, series):
+        """
+        Work the moments out from scratch.
+        """
+        self.runs = [moments(series[start:start + BLOCK_SIZE])
+                     for start in xrange(0, len(series), BLOCK_SIZE)]
+        self.middle = summarize(self.runs[1:-1])
+        self.total = summarize(self.runs)
+
+    def update(self, series):
+        """
+        Bring the moments up to date with series, an (n, 2) array of the
+        whole series as it is now. Only the datapoints that came in or
+        expired since the last update are looked at, unless the series
+        doesn't follow on from it.
+        """
+        runs = self.runs
+        timestamps = series[:, 0]
+        if not runs or not len(series) or not (np.diff(timestamps) > 0).all():
+            self.rebuild(series)
+            return
+
+        # Drop the runs that expired, and work out what is left of the one
+        # expiring
+        first = timestamps[0]
+        moved = False
+        while runs and runs[0][LAST] < first:
+            del runs[0]
+            moved = True
+        if not runs:
+            self.rebuild(series)
+            return
+        if runs[0][FIRST] < first:
+            runs[0] = moments(series[:timestamps.searchsorted(runs[0][LAST], 'right')])
+
+        # Add the datapoints that came in
+        start = timestamps.searchsorted(runs[-1][LAST], 'right')
+        if start < len(series):
+            if runs[-1][COUNT] < BLOCK_SIZE:
+                runs[-1] = merge(runs[-1], moments(series[start:]))
+            else:
+                runs.append(moments(series[start:]))
+                moved = True
+
+        if moved:
+            self.middle = summarize(runs[1:-1])
+        if len(runs) == 1:
+            total = runs[0]
+        else:
+            total = merge(merge(runs[0], self.middle), runs[-1])
+
+        # Datapoints that came in late, or were rewritten, throw it all off
+        if total[COUNT] != len(series) or total[LAST] != timestamps[-1]:
+            self.rebuild(series)
+            return
+        self.total = total
+
+        self.updates += 1
+        if self.verify_interval and self.updates % self.verify_interval == 0:
+            self.verify(series)
+
+    def verify(self, series):
+        """
+        Check the moments against the whole series, and start them over if
+        they drifted. Returns True if they did.
+        """
+        total = self.total
+        self.rebuild(series)
+        if drifted(total, self.total):
+            logger.warning('running statistics of %s drifted from its series, starting them over' % self.name)
+            return True
+        return False
+
+
+def stddev_from_average(totals, timestamps, values, lengths, tail):
+    """
+    stddev_from_average, from the moments of each series.
+    """
+    count = totals[:, COUNT]
+    return np.abs(tail - totals[:, MEAN_Y]) > 3 * np.sqrt(totals[:, M_YY] / (count - 1))
+
+
+def grubbs(totals, timestamps, values, lengths, tail):
+    """
+    grubbs, from the moments of each series.
+    """
+    len_series = totals[:, COUNT]
+    z_score = (tail - totals[:, MEAN_Y]) / np.sqrt(totals[:, M_YY] / len_series)
+    threshold = scipy.stats.t.isf(.05 / (2 * len_series), len_series - 2)
+    threshold_squared = threshold * threshold
+    grubbs_score = ((len_series - 1) / np.sqrt(len_series)) * np.sqrt(threshold_squared / (len_series - 2 + threshold_squared))
+
+    return z_score > grubbs_score
+
+
+def least_squares(totals, timestamps, values, lengths, tail):
+    """
+    least_squares, from the moments of each series. The residuals have no
+    mean, so their deviation comes straight from the moments.
+    """
+    count = totals[:, COUNT]
+    m = totals[:, M_XY] / totals[:, M_XX]
+    c = totals[:, MEAN_Y] - m * totals[:, MEAN_X]
+    std_dev = np.sqrt(np.maximum(totals[:, M_YY] - m * totals[:, M_XY], 0) / count)
+
+    if len(values) < 3:
+        return np.zeros(len(lengths), dtype=bool)
+    errors = values[-3:] - (m * timestamps[-3:] + c)
+    t = (errors[-1] + errors[-2] + errors[-3]) / 3
+
+    # round() goes half away from zero, so round(t) != 0 when |t| >= 0.5
+    return (count >= 3) & (np.abs(t) > std_dev * 3) & (std_dev >= 0.5) & (np.abs(t) >= 0.5)
+
+
+def stddev_from_moving_average(totals, timestamps, values, lengths, tail):
+    """
+    stddev_from_moving_average, from the moments of each series. The
+    deviation is unbiased, as pandas' ewmstd makes it.
+    """
+    weight = totals[:, WEIGHT]
+    variance = totals[:, EW_M2] * weight / (weight * weight - totals[:, WEIGHT2])
+    return np.abs(values[-1] - totals[:, EW_MEAN]) > 3 * np.sqrt(variance)
+
+
+STREAMING_ALGORITHMS = {
+    'stddev_from_average': stddev_from_average,
+    'grubbs': grubbs,
+    'least_squares': least_squares,
+    'stddev_from_moving_average': stddev_from_moving_average,
+}
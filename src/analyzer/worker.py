@@ -0,0 +1,176 @@
+import logging
+from Queue import Empty
+from collections import defaultdict
+from multiprocessing import Process
+from msgpack import packb
+from os import kill
+import traceback
+import settings
+import socket
+from ring import RedisRing
+from codec import storage_key, read_format, decode_timeseries
+
+from algorithms import filter_timeseries, run_selected_algorithm
+from batch import run_selected_algorithms
+from streaming import SeriesState
+from algorithm_exceptions import *
+
+logger = logging.getLogger("AnalyzerLog")
+
+
+class Worker(Process):
+    """
+    A long lived analyzer process. Every cycle it is sent the partitions to
+    analyze, along with the metrics of those that changed since it last
+    heard of them, and it sends back what it found.
+    """
+    def __init__(self, parent_pid, index, tasks, results):
+        super(Worker, self).__init__()
+        self.parent_pid = parent_pid
+        self.index = index
+        self.tasks = tasks
+        self.results = results
+        self.daemon = True
+
+    def check_if_parent_is_alive(self):
+        """
+        Self explanatory
+        """
+        try:
+            kill(self.parent_pid, 0)
+        except:
+            exit(0)
+
+    def analyze(self, assigned_metrics):
+        """
+        Run the algorithms over a bunch of metrics. Returns the anomalies,
+        and counts of exceptions and of the algorithms that triggered.
+        """
+        anomalous_metrics = []
+        exceptions = defaultdict(int)
+        anomaly_breakdown = defaultdict(int)
+
+        # Forget the statistics of metrics that went elsewhere
+        incremental = getattr(settings, 'ANALYZER_INCREMENTAL', False)
+        if incremental:
+            for metric_name in set(self.states) - set(assigned_metrics):
+                del self.states[metric_name]
+
+        if not assigned_metrics:
+            return anomalous_metrics, exceptions, anomaly_breakdown
+
+        # Multi get series
+        fmt = read_format()
+        raw_assigned = self.ring.mget([storage_key(metric_name, fmt) for metric_name in assigned_metrics])
+
+        # Distill timeseries strings into lists, leaving out those not worth
+        # analyzing
+        names = []
+        series = []
+        for i, metric_name in enumerate(assigned_metrics):
+            self.check_if_parent_is_alive()
+
+            try:
+                raw_series = raw_assigned[i]
+                timeseries = decode_timeseries(raw_series, fmt)
+                filter_timeseries(timeseries)
+                names.append(metric_name)
+                series.append(timeseries)
+
+            # It could have been deleted by the Roomba
+            except TypeError:
+                exceptions['DeletedByRoomba'] += 1
+            except TooShort:
+                exceptions['TooShort'] += 1
+            except Stale:
+                exceptions['Stale'] += 1
+            except Incomplete:
+                exceptions['Incomplete'] += 1
+            except Boring:
+                exceptions['Boring'] += 1
+            except:
+                exceptions['Other'] += 1
+                logger.info(traceback.format_exc())
+
+        verify_interval = getattr(settings, 'ANALYZER_VERIFY_INTERVAL', 100)
+
+        # Run the algorithms over a batch of metrics at a time
+        batch_size = getattr(settings, 'ANALYZER_BATCH_SIZE', 100) or 1
+        for start in xrange(0, len(series), batch_size):
+            self.check_if_parent_is_alive()
+
+            batch_names = names[start:start + batch_size]
+            batch_series = series[start:start + batch_size]
+            if incremental:
+                states = []
+                for metric_name in batch_names:
+                    if metric_name not in self.states:
+                        self.states[metric_name] = SeriesState(metric_name, verify_interval)
+                    states.append(self.states[metric_name])
+                results = run_selected_algorithms(batch_series, batch_names, states)
+            elif batch_size > 1:
+                results = run_selected_algorithms(batch_series, batch_names)
+            else:
+                results = [run_selected_algorithm(batch_series[0], batch_names[0])]
+
+            for metric_name, (anomalous, ensemble, datapoint) in zip(batch_names, results):
+                # If it's anomalous, add it to list
+                if anomalous:
+                    base_name = metric_name.replace(settings.FULL_NAMESPACE, '', 1)
+                    anomalous_metrics.append([datapoint, base_name])
+
+                    # Get the anomaly breakdown - who returned True?
+                    for index, value in enumerate(ensemble):
+                        if value:
+                            algorithm = settings.ALGORITHMS[index]
+                            anomaly_breakdown[algorithm] += 1
+
+        return anomalous_metrics, exceptions, anomaly_breakdown
+
+    def run(self):
+        """
+        Called when the process intializes.
+        """
+        self.ring = RedisRing(settings.REDIS_BACKENDS, logger)
+        process_key = '.'.join(['skyline', 'analyzer', socket.gethostname(), str(self.index)])
+
+        # The metrics of each partition, kept from one cycle to the next,
+        # and the running statistics of their series
+        metrics = {}
+        self.states = {}
+
+        while 1:
+            self.check_if_parent_is_alive()
+
+            try:
+                cycle, partitions, updates = self.tasks.get(timeout=10)
+            except Empty:
+                continue
+
+            metrics.update(updates)
+            for partition in metrics.keys():
+                if partition not in partitions:
+                    del metrics[partition]
+            assigned_metrics = [metric for partition in partitions for metric in metrics.get(partition, ())]
+
+            try:
+                # Make sure Redis is up, and follow the backends the monitor
+                # took out of the ring. The cycle is skipped if none is up.
+                self.ring.check_connections()
+
+                anomalous_metrics, exceptions, anomaly_breakdown = self.analyze(assigned_metrics)
+
+                # if anomalies detected Pack and Write anomoly data to Redis
+                if anomalous_metrics:
+                    self.ring.run('set', process_key, packb(anomalous_metrics))
+                    # expire the key in 30s so anomalys don't show up for too long
+                    self.ring.run('expire', process_key, 30)
+                    self.ring.run('sadd', settings.ANALYZER_ANOMALY_KEY, process_key)
+                    # expire the key in 60s so anomalys don't show up for too long
+                    self.ring.run('expire', settings.ANALYZER_ANOMALY_KEY, 60)
+            except Exception as e:
+                logger.error('analyzer worker %d failed: %s' % (self.index, e))
+                anomalous_metrics, exceptions, anomaly_breakdown = [], {'Other': len(assigned_metrics)}, {}
+
+            self.results.put((self.index, cycle, len(assigned_metrics), anomalous_metrics,
+                              dict(exceptions), dict(anomaly_breakdown)))
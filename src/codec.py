@@ -0,0 +1,456 @@
+"""
+Encoding of stored timeseries.
+
+Series are stored either as concatenated msgpack (timestamp, value) tuples, or
+in the 'binary' format as packed little-endian float64 (timestamp, value)
+records that decode straight into a NumPy array.
+
+Binary series are kept under their own keys, so both formats can coexist. To
+migrate, set STORAGE_FORMAT to 'binary' and STORAGE_MIGRATING to True. The
+workers then write both formats while everything keeps reading msgpack. Once
+the binary series hold FULL_DURATION of data, set STORAGE_MIGRATING back to
+False. Readers switch to the binary keys and the Roomba deletes the msgpack
+ones.
+
+The 'compressed' format is a run of compressed blocks followed by a tail of
+binary records. Workers append to the tail, and the Roomba seals it into
+blocks of up to STORAGE_BLOCK_SIZE datapoints when it trims the series. A
+block holds delta-of-delta encoded timestamps and XORed float values, byte
+shuffled and deflated, so that it can be decoded with a handful of NumPy
+calls instead of a bit-level loop. A series made only of a tail, such as one
+that the Roomba has not visited yet, has no header.
+
+The 'ring' format gives every series a fixed number of slots, one for each
+STORAGE_RESOLUTION seconds of the duration it covers. Workers write a record
+into the slot its timestamp falls in with SETRANGE, overwriting whatever the
+slot held a lap earlier, so rings never grow and never need trimming.
+Datapoints less than STORAGE_RESOLUTION apart share a slot and only the last
+one written is kept. Slots that were never written read as zero timestamps.
+
+Of datapoints with the same timestamp, whatever the format, the one stored
+first is kept and the others are dropped when the series is trimmed.
+"""
+import zlib
+import numpy as np
+from math import ceil
+from operator import itemgetter
+from struct import Struct
+from msgpack import Unpacker, packb
+
+import settings
+
+MSGPACK = 'msgpack'
+BINARY = 'binary'
+COMPRESSED = 'compressed'
+RING = 'ring'
+
+KEY_PREFIXES = {
+    MSGPACK: '',
+    BINARY: 'b:',
+    COMPRESSED: 'c:',
+    RING: 'r:',
+}
+
+RECORD = Struct('<dd')
+
+# Length of the blocks and a marker. Read as the timestamp of a record it is a
+# NaN, which the workers never store, so a header can't be mistaken for a tail.
+SERIES_HEADER = Struct('<IHH')
+SERIES_MARKER = 0xffff
+SERIES_VERSION = 1
+
+# Flags, datapoint count, payload length, first and last timestamp
+BLOCK_HEADER = Struct('<BIIdd')
+INTEGRAL_TIMESTAMPS = 1
+
+STORAGE_FORMAT = getattr(settings, 'STORAGE_FORMAT', MSGPACK)
+STORAGE_MIGRATING = getattr(settings, 'STORAGE_MIGRATING', False)
+STORAGE_BLOCK_SIZE = getattr(settings, 'STORAGE_BLOCK_SIZE', 360)
+STORAGE_RESOLUTION = getattr(settings, 'STORAGE_RESOLUTION', 10)
+
+
+def hash_tag(key):
+    """
+    Wrap a metric key in braces, so that Redis keys built with it are stored
+    on the same backends as its series. Metric names with braces of their
+    own are refused by the relays and the workers, as they would pick
+    another tag.
+    """
+    return '{%s}' % key
+
+
+def storage_key(key, fmt=STORAGE_FORMAT):
+    """
+    Return the Redis key holding the series for key in the given format.
+    The name is hash tagged, so that every format of a series lives on the
+    same backends as its msgpack key.
+    """
+    if fmt == MSGPACK:
+        return key
+    return KEY_PREFIXES[fmt] + hash_tag(key)
+
+
+def read_format():
+    """
+    The format readers use. While migrating, the new format doesn't hold
+    FULL_DURATION of data yet, so reads stay on msgpack.
+    """
+    if STORAGE_MIGRATING:
+        return MSGPACK
+    return STORAGE_FORMAT
+
+
+def series_format(key):
+    """
+    The format of the series stored under key, or None if key doesn't hold
+    a series.
+    """
+    fmt = MSGPACK
+    for candidate, prefix in KEY_PREFIXES.iteritems():
+        if prefix and key.startswith(prefix + '{') and key.endswith('}'):
+            fmt = candidate
+            key = key[len(prefix) + 1:-1]
+    if key.startswith(settings.FULL_NAMESPACE) or key.startswith(settings.MINI_NAMESPACE):
+        return fmt
+    return None
+
+
+def write_formats():
+    """
+    The formats the workers write.
+    """
+    if STORAGE_MIGRATING and STORAGE_FORMAT != MSGPACK:
+        return (STORAGE_FORMAT, MSGPACK)
+    return (STORAGE_FORMAT,)
+
+
+def encode_datapoint(datapoint, fmt=STORAGE_FORMAT):
+    """
+    Encode a (timestamp, value) datapoint to be appended to a series.
+    """
+    if fmt in (BINARY, COMPRESSED, RING):
+        return RECORD.pack(datapoint[0], datapoint[1])
+    return packb(datapoint)
+
+
+def ring_slots(duration):
+    """
+    The number of slots in the ring of a series covering duration seconds.
+    """
+    return int(ceil(float(duration) / STORAGE_RESOLUTION))
+
+
+def ring_offset(timestamp, slots):
+    """
+    The byte offset of the slot a timestamp is written to.
+    """
+    return int(timestamp) // STORAGE_RESOLUTION % slots * RECORD.size
+
+
+def linearize(records, slots):
+    """
+    Put the records of a ring in time order, leaving out empty slots and
+    those holding datapoints from the previous lap.
+    """
+    if not len(records):
+        return records
+
+    timestamps = records[:, 0]
+    newest = timestamps.max()
+    # The slot after the newest datapoint holds the oldest one
+    start = (int(newest) // STORAGE_RESOLUTION + 1) % slots
+    if start < len(records):
+        records = np.roll(records, -start, axis=0)
+        timestamps = records[:, 0]
+    return records[timestamps > max(newest - slots * STORAGE_RESOLUTION, 0)]
+
+
+def _records(raw):
+    """
+    View binary records as an (n, 2) array, ignoring a trailing partial one.
+    """
+    count = len(raw) / RECORD.size * 2
+    return np.frombuffer(raw, dtype='<f8', count=count).reshape(-1, 2)
+
+
+def _clean(series, cutoff):
+    """
+    Sort an (n, 2) array by timestamp, dropping datapoints at or before cutoff
+    and all but the first datapoint of each timestamp.
+    """
+    series = series[np.argsort(series[:, 0], kind='mergesort')]
+    series = series[series[:, 0] > cutoff]
+    keep = np.ones(len(series), dtype=bool)
+    keep[1:] = series[1:, 0] != series[:-1, 0]
+    return series[keep]
+
+
+def _shuffle(words):
+    """
+    Lay out the bytes of 8 byte words by significance, so that the runs of
+    zeros left by the deltas and XORs compress.
+    """
+    return words.view(np.uint8).reshape(-1, 8).T.tostring()
+
+
+def encode_block(series):
+    """
+    Compress a sorted (n, 2) array into a block.
+    """
+    timestamps = series[:, 0]
+    flags = 0
+    integral = timestamps.astype('<i8')
+    if np.array_equal(integral, timestamps):
+        flags |= INTEGRAL_TIMESTAMPS
+        # Keep the first timestamp and delta, then the delta of deltas
+        deltas = integral.copy()
+        deltas[1:] = np.diff(integral)
+        words = deltas.copy()
+        words[2:] = np.diff(deltas[1:])
+    else:
+        words = np.ascontiguousarray(timestamps, dtype='<f8').view('<u8').copy()
+        words[1:] ^= words[:-1].copy()
+
+    values = np.ascontiguousarray(series[:, 1], dtype='<f8').view('<u8')
+    xored = values.copy()
+    xored[1:] ^= values[:-1]
+
+    payload = zlib.compress(_shuffle(words) + _shuffle(xored))
+    header = BLOCK_HEADER.pack(flags, len(series), len(payload), timestamps[0], timestamps[-1])
+    return header + payload
+
+
+def _spread(firsts, starts, count, accumulate):
+    """
+    Repeat one value per block over the datapoints of the block, by
+    accumulating the differences between consecutive blocks.
+    """
+    spread = np.zeros(count, dtype=firsts.dtype)
+    spread[starts] = firsts
+    if accumulate is np.cumsum:
+        spread[starts[1:]] -= firsts[:-1]
+    else:
+        spread[starts[1:]] ^= firsts[:-1]
+    return accumulate(spread)
+
+
+def _restart(totals, starts, accumulate):
+    """
+    Turn running totals over several blocks into running totals that restart
+    with every block.
+    """
+    before = np.zeros(len(starts), dtype=totals.dtype)
+    before[1:] = totals[starts[1:] - 1]
+    return _spread(before, starts, len(totals), accumulate)
+
+
+def decode_blocks(blocks):
+    """
+    Decompress a list of blocks into a single (n, 2) array. The blocks are
+    decoded together, so the number of NumPy calls doesn't grow with them.
+    """
+    headers = [BLOCK_HEADER.unpack_from(block) for block in blocks]
+    counts = [header[1] for header in headers]
+    starts = np.zeros(len(counts), dtype=np.intp)
+    starts[1:] = np.cumsum(counts)[:-1]
+    count = sum(counts)
+
+    # Gather the byte planes of every block, transposed back into words
+    timestamp_bytes = np.empty((count, 8), dtype=np.uint8)
+    value_bytes = np.empty((count, 8), dtype=np.uint8)
+    offset = 0
+    for block, (flags, n, length, first, last) in zip(blocks, headers):
+        data = zlib.decompress(block[BLOCK_HEADER.size:BLOCK_HEADER.size + length])
+        planes = np.frombuffer(data, dtype=np.uint8).reshape(16, n)
+        timestamp_bytes[offset:offset + n] = planes[:8].T
+        value_bytes[offset:offset + n] = planes[8:].T
+        offset += n
+    words = timestamp_bytes.view('<i8').ravel()
+    xored = value_bytes.view('<u8').ravel()
+
+    series = np.empty((count, 2), dtype='<f8')
+
+    integral = [header[0] & INTEGRAL_TIMESTAMPS for header in headers]
+    if any(integral):
+        # Sum the delta of deltas back into deltas, then into timestamps
+        firsts = words[starts]
+        deltas = words.copy()
+        deltas[starts] = 0
+        deltas = np.cumsum(deltas)
+        deltas -= _spread(deltas[starts], starts, count, np.cumsum)
+        deltas[starts] = firsts
+        timestamps = np.cumsum(deltas)
+        timestamps -= _restart(timestamps, starts, np.cumsum)
+        series[:, 0] = timestamps
+    if not all(integral):
+        timestamps = np.bitwise_xor.accumulate(words.view('<u8'))
+        timestamps ^= _restart(timestamps, starts, np.bitwise_xor.accumulate)
+        floats = ~np.repeat(np.array(integral, dtype=bool), counts)
+        series[floats, 0] = timestamps.view('<f8')[floats]
+
+    values = np.bitwise_xor.accumulate(xored)
+    values ^= _restart(values, starts, np.bitwise_xor.accumulate)
+    series[:, 1] = values.view('<f8')
+    return series
+
+
+def split_series(raw):
+    """
+    Split a compressed series into its list of blocks and its tail records.
+    """
+    blocks = []
+    offset = 0
+    if len(raw) >= SERIES_HEADER.size:
+        length, version, marker = SERIES_HEADER.unpack_from(raw)
+        if marker == SERIES_MARKER:
+            offset = SERIES_HEADER.size
+            end = offset + length
+            while offset < end:
+                size = BLOCK_HEADER.size + BLOCK_HEADER.unpack_from(raw, offset)[2]
+                blocks.append(raw[offset:offset + size])
+                offset += size
+
+    return blocks, _records(buffer(raw, offset))
+
+
+def join_series(blocks):
+    """
+    Build a compressed series out of blocks, ready for the workers to append to.
+    """
+    sealed = ''.join(blocks)
+    return SERIES_HEADER.pack(len(sealed), SERIES_VERSION, SERIES_MARKER) + sealed
+
+
+def decode_array(raw, fmt=STORAGE_FORMAT, duration=None):
+    """
+    Decode a stored series into an (n, 2) float64 array of timestamps and
+    values. Binary series are not copied, the array is read-only. Rings need
+    the duration they cover, FULL_DURATION by default.
+    """
+    if fmt == BINARY:
+        return _records(raw)
+
+    if fmt == RING:
+        return linearize(_records(raw), ring_slots(duration or settings.FULL_DURATION))
+
+    if fmt == COMPRESSED:
+        blocks, tail = split_series(raw)
+        if not blocks:
+            return tail
+        series = np.concatenate([decode_blocks(blocks), tail])
+        # Datapoints that came in late can be out of order, or repeat a
+        # timestamp already sealed until the Roomba seals them too
+        if (np.diff(series[:, 0]) <= 0).any():
+            series = _clean(series, -np.inf)
+        return series
+
+    return np.array(decode_timeseries(raw, fmt), dtype='<f8').reshape(-1, 2)
+
+
+def decode_timeseries(raw, fmt=STORAGE_FORMAT, duration=None):
+    """
+    Decode a stored series into a sequence of (timestamp, value) datapoints,
+    as the algorithms expect. That is the (n, 2) array of decode_array for
+    all but msgpack series, which decode into a list of tuples; callers that
+    need lists convert it themselves.
+    """
+    if fmt in (BINARY, COMPRESSED, RING):
+        return decode_array(raw, fmt, duration)
+
+    unpacker = Unpacker(use_list=False)
+    unpacker.feed(raw)
+    return list(unpacker)
+
+
+def merge_series(old, new, fmt=STORAGE_FORMAT):
+    """
+    Merge two copies of a series, such as one moved over from another backend
+    and the one written since. In a ring the newer datapoint of each slot
+    wins, msgpack series are left for the Roomba to dedup, and other series
+    are merged as uncompressed records for the Roomba to seal again. The old
+    copy was stored first, so its datapoints are kept over new ones with the
+    same timestamp.
+    """
+    if fmt == MSGPACK:
+        return old + new
+
+    if fmt == RING:
+        old = _records(old)
+        new = _records(new)
+        merged = np.zeros((max(len(old), len(new)), 2), dtype='<f8')
+        merged[:len(old)] = old
+        newer = new[:, 0] >= merged[:len(new), 0]
+        merged[:len(new)][newer] = new[newer]
+        return merged.tostring()
+
+    series = np.concatenate([decode_array(old, fmt), decode_array(new, fmt)])
+    return _clean(series, 0).tostring()
+
+
+def newest_timestamp(raw, fmt=STORAGE_FORMAT):
+    """
+    The timestamp of the newest datapoint of a series, or 0 if it is empty.
+    """
+    if fmt == RING:
+        timestamps = _records(raw)[:, 0]
+    else:
+        timestamps = decode_array(raw, fmt)[:, 0]
+    if not len(timestamps):
+        return 0
+    return timestamps.max()
+
+
+def trim_series(raw, cutoff, fmt=STORAGE_FORMAT):
+    """
+    Sort a stored series, drop datapoints at or before cutoff and duplicate
+    timestamps, and return it encoded again. Returns None if nothing is left.
+
+    Compressed series are only trimmed a whole block at a time, and their tail
+    is sealed into blocks. Blocks that end after the oldest datapoint of the
+    tail are sealed again along with it, so that datapoints that came in late
+    are sorted and deduplicated against them.
+    """
+    if fmt == BINARY:
+        series = _clean(decode_array(raw, fmt), cutoff)
+        if not len(series):
+            return None
+        return series.tostring()
+
+    if fmt == COMPRESSED:
+        blocks, tail = split_series(raw)
+        blocks = [block for block in blocks if BLOCK_HEADER.unpack_from(block)[4] > cutoff]
+        tail = _clean(tail, cutoff)
+        if len(tail):
+            # Take in datapoints that came in late, and top up the last block
+            headers = [BLOCK_HEADER.unpack_from(block) for block in blocks]
+            reopened = [block for block, header in zip(blocks, headers) if header[4] >= tail[0, 0]]
+            blocks = [block for block, header in zip(blocks, headers) if header[4] < tail[0, 0]]
+            if not reopened and blocks and headers[-1][1] < STORAGE_BLOCK_SIZE:
+                reopened = [blocks.pop()]
+            if reopened:
+                tail = _clean(np.concatenate([decode_blocks(reopened), tail]), cutoff)
+            for i in xrange(0, len(tail), STORAGE_BLOCK_SIZE):
+                blocks.append(encode_block(tail[i:i + STORAGE_BLOCK_SIZE]))
+        if not blocks:
+            return None
+        return join_series(blocks)
+
+    timeseries = sorted(decode_timeseries(raw, fmt), key=itemgetter(0))
+    temp = set()
+    temp_add = temp.add
+    trimmed = [
+        tuple for tuple in timeseries
+        if tuple[0] > cutoff and
+        tuple[0] not in temp and
+        not temp_add(tuple[0])
+    ]
+    if not trimmed:
+        return None
+
+    # Serialize and turn the series back into not-an-array
+    btrimmed = packb(trimmed)
+    if len(trimmed) <= 15:
+        return btrimmed[1:]
+    elif len(trimmed) <= 65535:
+        return btrimmed[3:]
+    return btrimmed[5:]
@@ -0,0 +1,116 @@
+"""
+Wire format between the Relay and the Horizon workers.
+
+A message is either a single frame holding one msgpack encoded
+(name, (timestamp, value)) datapoint, or a two frame message made of
+BATCH_HEADER followed by a msgpack encoded list of datapoints. Workers accept
+both, so relays and workers can be upgraded independently.
+
+With RELAY_ROUTING = 'hash' every metric name is owned by a single worker,
+picked with worker_for, and relays address workers by worker_identity.
+"""
+from math import isinf, isnan
+from zlib import crc32
+from msgpack import packb, unpackb
+
+BATCH_HEADER = 'skyline.batch'
+
+NUMBERS = frozenset((int, long, float))
+
+
+def pack_metric(metric):
+    """
+    Frame a single datapoint.
+    """
+    return [packb(metric)]
+
+
+def pack_batch(metrics):
+    """
+    Frame a list of datapoints as one multipart message.
+    """
+    return [BATCH_HEADER, packb(metrics)]
+
+
+def unpack_frames(frames):
+    """
+    Decode a received multipart message into a list of datapoints.
+    """
+    if len(frames) == 1:
+        return [unpackb(frames[0])]
+
+    if frames[0] == BATCH_HEADER:
+        return unpackb(frames[1])
+
+    raise ValueError('unknown message header: %r' % frames[0])
+
+
+def is_number(value):
+    """
+    Whether value is a plain, finite number.
+    """
+    if type(value) not in NUMBERS:
+        return False
+    try:
+        return not isinf(value) and not isnan(value)
+    except OverflowError:
+        return False
+
+
+def is_name(name):
+    """
+    Whether name can be a metric name: a str without braces, which would
+    change the hash tag its Redis keys are routed by.
+    """
+    return type(name) is str and '{' not in name and '}' not in name
+
+
+def clean_datapoints(items, prefix=''):
+    """
+    Keep the items that are (name, (timestamp, value)) datapoints, with a
+    metric name starting with prefix and finite numbers for the timestamp and
+    value. The prefix is stripped from the names kept. Returns them and the
+    number of malformed items dropped.
+    """
+    cut = len(prefix)
+    datapoints = []
+    bad = 0
+    for item in items:
+        try:
+            name, (timestamp, value) = item
+        except (TypeError, ValueError):
+            bad += 1
+            continue
+        if not is_name(name) or not is_number(timestamp) or not is_number(value):
+            bad += 1
+            continue
+        if name[:cut] == prefix:
+            datapoints.append((name[cut:], (timestamp, value)))
+    return datapoints, bad
+
+
+def jump_hash(key, buckets):
+    """
+    Jump consistent hash (Lamping and Veach). Maps a 64 bit key to one of
+    buckets, and only moves 1/buckets of the keys when a bucket is added.
+    """
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+def worker_for(name, workers):
+    """
+    Return the index of the worker that owns a metric name.
+    """
+    return jump_hash(crc32(name) & 0xffffffff, workers)
+
+
+def worker_identity(index):
+    """
+    The ZMQ identity a worker announces to the relays.
+    """
+    return 'worker.%d' % index
@@ -10,7 +10,6 @@ import zmq
 sys.path.insert(0, dirname(dirname(abspath(__file__))))
 import settings
 
-from listen import Listen
 from roomba import Roomba
 from worker import Worker
 
@@ -32,9 +31,9 @@ class Horizon():
         # Start the workers
         for i in range(settings.WORKER_PROCESSES):
             if i == 0:
-                Worker(pid, context, canary=True).start()
+                Worker(pid, context, i, canary=True).start()
             else:
-                Worker(pid, context).start()
+                Worker(pid, context, i).start()
 
         # Start the roomba
         Roomba(pid).start()
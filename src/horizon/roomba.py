@@ -1,9 +1,12 @@
 from os import kill
 from ring import RedisRing
+from lease import Leases
 from multiprocessing import Process
 from threading import Thread
-from msgpack import Unpacker, packb
-from types import TupleType
+from redis import WatchError
+from codec import MSGPACK, COMPRESSED, STORAGE_FORMAT, STORAGE_MIGRATING, \
+    STORAGE_BLOCK_SIZE, storage_key, read_format, write_formats, trim_series
+from scripts import TRIM_SERIES, ZADD_IF_ABSENT
 from time import time, sleep
 import socket
 
@@ -12,6 +15,12 @@ import settings
 
 logger = logging.getLogger("HorizonLog")
 
+# What became of a series the Roomba trimmed
+TRIMMED = 'trimmed'
+MISSING = 'missing'
+BLOCKED = 'blocked'
+DEAD = 'dead'
+
 
 class Roomba(Thread):
     """
@@ -19,7 +28,11 @@ class Roomba(Thread):
     """
     def __init__(self, parent_pid):
         super(Roomba, self).__init__()
-        self.ring = RedisRing(settings.REDIS_BACKENDS)
+        self.ring = RedisRing(settings.REDIS_BACKENDS, logger)
+        self.trim_script = self.ring.register_script(TRIM_SERIES)
+        self.zadd_if_absent = self.ring.register_script(ZADD_IF_ABSENT)
+        self.batch_size = getattr(settings, 'ROOMBA_BATCH_SIZE', 1000)
+        self.scan_count = getattr(settings, 'ROOMBA_SCAN_COUNT', 1000)
         self.daemon = True
         self.parent_pid = parent_pid
 
@@ -32,123 +45,210 @@ class Roomba(Thread):
         except:
             exit(0)
 
-    def vacuum(self, i, namespace, duration):
+    def euthanize(self, keys, namespace):
         """
-        Trim metrics that are older than settings.FULL_DURATION and
-        purge old metrics.
+        Delete metrics in every format and forget about them.
         """
-        process_key = '.'.join(['skyline','roomba', str(namespace)])
-        hostname = socket.gethostname()
-        if self.ring.run('get', process_key) != hostname:
-            return
-        else:
-            self.ring.run('set', process_key, hostname)
-            self.ring.run('expire', process_key, 600)
+        commands = []
+        for key in keys:
+            commands.extend(('delete', storage_key(key, fmt)) for fmt in set(write_formats() + (read_format(),)))
+            commands.append(('srem', namespace + 'unique_metrics', key))
+            commands.append(('zrem', namespace + 'roomba_queue', key))
+        self.ring.run_many(commands)
 
-        begin = time()
-        # Discover assigned metrics
-        unique_metrics = list(self.ring.run('smembers', namespace + 'unique_metrics'))
-        keys_per_processor = len(unique_metrics) / settings.ROOMBA_PROCESSES
-        assigned_max = i * keys_per_processor
-        assigned_min = assigned_max - keys_per_processor
-        assigned_keys = range(assigned_min, assigned_max)
+    def seal(self, conn, skey, fmt, now, duration):
+        """
+        Trim the copy of a compressed series held by one backend, sealing its
+        tail into blocks, which the trim script can't do. Returns TRIMMED,
+        MISSING, BLOCKED if a datapoint came in meanwhile, or DEAD if nothing
+        is left of it.
+        """
+        pipe = conn.pipeline()
+        try:
+            # WATCH the key
+            pipe.watch(skey)
+
+            # Everything below NEEDS to happen before another datapoint
+            # comes in. If your data has a very small resolution (<.1s),
+            # this technique may not suit you.
+            raw_series = pipe.get(skey)
+            if raw_series is None:
+                return MISSING
 
-        # Compile assigned metrics
-        assigned_metrics = [unique_metrics[index] for index in assigned_keys]
+            # Remove old datapoints and duplicates from timeseries
+            trimmed = trim_series(raw_series, now - duration, fmt)
+            if trimmed is None:
+                return DEAD
 
+            # Put pipe back in multi mode
+            pipe.multi()
+            pipe.set(skey, trimmed)
+            pipe.execute()
+            return TRIMMED
+
+        except WatchError:
+            return BLOCKED
+        except Exception as e:
+            # If something bad happens, zap the key and hope it goes away
+            logger.info(e)
+            logger.info("Euthanizing " + skey)
+            return DEAD
+        finally:
+            pipe.reset()
+
+    def trim(self, keys, fmt, now, duration):
+        """
+        Trim every copy of a batch of series in Redis, with one pipeline of
+        trim scripts per backend. Returns, in the order of keys, the status of
+        each copy of each series and the cutoff past which the series needs
+        trimming again, or None if that isn't known.
+        """
+        commands = [(self.trim_script, storage_key(key, fmt), fmt, repr(now - duration))
+                    for key in keys]
+        results = self.ring.run_many(commands, replicas=True)
+
+        statuses = []
+        for key, replies in zip(keys, results):
+            skey = storage_key(key, fmt)
+            key_statuses = []
+            expires = None
+            for conn, reply in replies:
+                if isinstance(reply, Exception):
+                    # If something bad happens, zap the key and hope it goes away
+                    logger.info(reply)
+                    logger.info("Euthanizing " + skey)
+                    key_statuses.append(DEAD)
+                elif fmt == COMPRESSED and reply[1] >= STORAGE_BLOCK_SIZE:
+                    # A whole block's worth of datapoints to compress
+                    key_statuses.append(self.seal(conn, skey, fmt, now, duration))
+                else:
+                    key_statuses.append(reply[0])
+                if not isinstance(reply, Exception) and len(reply) > 2:
+                    expires = min(expires or float(reply[2]), float(reply[2]))
+            statuses.append((key_statuses, expires))
+        return statuses
+
+    def visit(self, keys, namespace, duration):
+        """
+        Trim a batch of metrics in every format being written, delete the
+        dead ones and queue the others again for when they next need
+        trimming. Returns the number of metrics euthanized, blocked and
+        queued again.
+        """
+        now = time()
+
+        # Once a migration is over the msgpack series are no longer written
+        if STORAGE_FORMAT != MSGPACK and not STORAGE_MIGRATING:
+            self.ring.run_many([('delete', storage_key(key, MSGPACK)) for key in keys])
+
+        # Trim every copy of the series, in every format being written
+        dead = set()
+        blocked = set()
+        expires = {}
+        for fmt in write_formats():
+            try:
+                statuses = self.trim(keys, fmt, now, duration)
+            except Exception as e:
+                logger.error('failed to trim %d %s series: %s' % (len(keys), fmt, e))
+                continue
+            for key, (key_statuses, key_expires) in zip(keys, statuses):
+                if BLOCKED in key_statuses:
+                    blocked.add(key)
+                # Series in the format being migrated to may not exist yet,
+                # but one with nothing left in the format read from is dead
+                if all(status in (DEAD, MISSING) for status in key_statuses):
+                    if DEAD in key_statuses or fmt == read_format():
+                        dead.add(key)
+                if key_expires is not None:
+                    expires[key] = min(expires.get(key, key_expires), key_expires)
+
+        if dead:
+            self.euthanize(dead, namespace)
+
+        # Blocked metrics keep their place, and are trimmed again next time
+        requeue = [('zadd', namespace + 'roomba_queue', repr(expires[key]), key)
+                   for key in keys if key in expires and key not in dead and key not in blocked]
+        if requeue:
+            self.ring.run_many(requeue)
+
+        return len(dead), len(blocked - dead), len(requeue)
+
+    def backfill(self, namespace):
+        """
+        Queue the next few unique_metrics to be trimmed straight away, unless
+        they are queued already, carrying on with the SSCAN where the last
+        pass left off. Catches metrics that never made it to the queue, such
+        as those written before it existed.
+        """
+        cursor_key = '.'.join(['skyline', 'roomba', 'cursor', str(namespace)])
+        ukey = namespace + 'unique_metrics'
+        cursor = int(self.ring.run('get', cursor_key) or 0)
+        # The cursor only makes sense to the replica it came from
+        conn = self.ring.get_connections(ukey)[0]
+        cursor, keys = conn.sscan(ukey, cursor, count=self.scan_count)
+        if keys:
+            self.ring.run_many([(self.zadd_if_absent, namespace + 'roomba_queue', 0, key)
+                                for key in keys])
+        self.ring.run('set', cursor_key, cursor)
+
+    def sweep(self, namespace, duration, leases, partitions):
+        """
+        Trim the metrics of partitions whose oldest datapoint has expired.
+        Returns the number of metrics visited, euthanized and blocked.
+        """
+        partitions = set(partitions)
+        cutoff = time() - duration
+        queue = namespace + 'roomba_queue'
+        renewed = time()
+        offset = 0
+        visited = 0
         euthanized = 0
         blocked = 0
-        for i in xrange(len(assigned_metrics)):
+        while partitions:
             self.check_if_parent_is_alive()
 
-            now = time()
-            key = assigned_metrics[i]
+            if time() - renewed > leases.ttl / 3:
+                partitions.intersection_update(leases.renew(list(partitions)))
+                renewed = time()
 
-            try:
-                # WATCH the key
-                pipe.watch(key)
-
-                # Everything below NEEDS to happen before another datapoint
-                # comes in. If your data has a very small resolution (<.1s),
-                # this technique may not suit you.
-                raw_series = self.ring.run('get', key)
-                unpacker = Unpacker(use_list = False)
-                unpacker.feed(raw_series)
-                timeseries = sorted([unpacked for unpacked in unpacker])
-
-                # Put pipe back in multi mode
-                pipe.multi()
-
-                # There's one value. Purge if it's too old
-                try:
-                    if not isinstance(timeseries[0], TupleType):
-                        if timeseries[0] < now - duration:
-                            self.ring.run('delete', key)
-                            self.ring.run('srem', namespace + 'unique_metrics', key)
-                            euthanized += 1
-                        continue
-                except IndexError:
-                    continue
-
-                # Check if the last value is too old and purge
-                if timeseries[-1][0] < now - duration:
-                    self.ring.run('delete', key)
-                    self.ring.run('srem', namespace + 'unique_metrics', key)
-                    euthanized += 1
-                    continue
-
-                # Remove old datapoints and duplicates from timeseries
-                temp = set()
-                temp_add = temp.add
-                delta = now - duration
-                trimmed = [
-<<<<<<< HEAD
-                            tuple for tuple in timeseries
-                            if tuple[0] > delta
-                            and tuple[0] not in temp
-                            and not temp_add(tuple[0])
-                        ]
-=======
-                    tuple for tuple in timeseries
-                    if tuple[0] > delta
-                    and tuple[0] not in temp
-                    and not temp_add(tuple[0])
-                ]
->>>>>>> bcb25d59fa66f2f6261386b406941623c10ebe49
-
-                # Purge if everything was deleted, set key otherwise
-                if len(trimmed) > 0:
-                    # Serialize and turn key back into not-an-array
-                    btrimmed = packb(trimmed)
-                    if len(trimmed) <= 15:
-                        value = btrimmed[1:]
-                    elif len(trimmed) <= 65535:
-                        value = btrimmed[3:]
-                    else:
-                        value = btrimmed[5:]
-                    pipe.set(key, value)
-                else:
-                    self.ring.run('delete', key)
-                    self.ring.run('srem', namespace + 'unique_metrics', key)
-                    euthanized += 1
+            page = self.ring.run('zrangebyscore', queue, '-inf', repr(cutoff), offset, self.batch_size)
+            if not page:
+                break
+            keys = [key for key in page if leases.partition(key) in partitions]
+            dead, key_blocked, requeued = self.visit(keys, namespace, duration) if keys else (0, 0, 0)
+            visited += len(keys)
+            euthanized += dead
+            blocked += key_blocked
 
-                pipe.execute()
+            # Metrics that were trimmed or deleted left the expired range
+            offset += len(page) - dead - requeued
 
-            except WatchError:
-                blocked += 1
-                assigned_metrics.append(key)
-            except Exception as e:
-                # If something bad happens, zap the key and hope it goes away
-                self.ring.run('delete', key)
-                self.ring.run('srem', namespace + 'unique_metrics', key)
-                euthanized += 1
-                logger.info(e)
-                logger.info("Euthanizing " + key)
-            finally:
-                pipe.reset()
+        return visited, euthanized, blocked
+
+    def vacuum(self, i, namespace, duration):
+        """
+        Trim metrics that are older than settings.FULL_DURATION and
+        purge old metrics.
+        """
+        begin = time()
+        leases = Leases(self.ring, 'roomba.' + namespace.strip('.'),
+                        '%s:%d' % (socket.gethostname(), i))
+        partitions = leases.acquire()
+        # Help out with partitions whose holder has fallen behind
+        stolen = leases.steal()
+
+        if 0 in partitions:
+            self.backfill(namespace)
+
+        visited, euthanized, blocked = self.sweep(namespace, duration, leases, partitions + stolen)
+        leases.finish(partitions + stolen)
+        if stolen:
+            leases.release(stolen)
 
         logger.info('operated on %s in %f seconds' % (namespace, time() - begin))
-        logger.info('%s keyspace is %d' % (namespace, (len(assigned_metrics) - euthanized)))
+        logger.info('%s keyspace is %d' % (namespace, self.ring.run('zcard', namespace + 'roomba_queue')))
+        logger.info('held %d partitions and stole %d' % (len(partitions), len(stolen)))
+        logger.info('visited %d expired keys' % visited)
         logger.info('blocked %d times' % blocked)
         logger.info('euthanized %d geriatric keys' % euthanized)
 
@@ -170,7 +270,6 @@ class Roomba(Thread):
                 self.ring.check_connections()
             except:
                 sleep(10)
-                self.ring = RedisRing(settings.REDIS_BACKENDS)
                 continue
 
             # Spawn processes
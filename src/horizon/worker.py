@@ -1,10 +1,18 @@
 from os import kill, system
-from redis import StrictRedis, WatchError
+from redis import StrictRedis, WatchError, ResponseError
+from redis.client import Script
+from collections import defaultdict
 from multiprocessing import Process
 from Queue import Empty
-from msgpack import packb
 from time import time, sleep
+from random import random
 from ring import RedisRing
+from lru import LRUCache
+from skip_list import SkipList
+from framing import unpack_frames, worker_identity, is_name
+from codec import RING, storage_key, write_formats, encode_datapoint, \
+    ring_slots, ring_offset
+from scripts import ZADD_IF_ABSENT
 import zmq
 
 import logging
@@ -18,13 +26,32 @@ class Worker(Process):
     The worker processes chunks from the queue and appends
     the latest datapoints to their respective timesteps in Redis.
     """
-    def __init__(self, parent_pid, context, canary=False):
+    def __init__(self, parent_pid, context, index=0, canary=False):
         super(Worker, self).__init__()
         self.context = context
-        self.ring = RedisRing(settings.REDIS_BACKENDS)
+        self.index = index
+        self.ring = RedisRing(settings.REDIS_BACKENDS, logger)
+        self.zadd_if_absent = self.ring.register_script(ZADD_IF_ABSENT)
         self.parent_pid = parent_pid
         self.daemon = True
         self.canary = canary
+        self.skip_list = SkipList(settings.SKIP_LIST)
+
+        # Commands waiting to be written, grouped by the backends owning the key
+        self.pending = defaultdict(list)
+        self.pending_points = 0
+        self.oldest_pending = None
+        # Datapoints waiting to be appended, coalesced by key
+        self.appends = {}
+        self.appended_bytes = 0
+        self.flush_size = getattr(settings, 'WORKER_FLUSH_SIZE', 1000)
+        self.flush_bytes = getattr(settings, 'WORKER_FLUSH_BYTES', 1024 * 1024)
+        self.flush_interval = getattr(settings, 'WORKER_FLUSH_INTERVAL', 500) / 1000.0
+        self.flush_retries = getattr(settings, 'WORKER_FLUSH_RETRIES', 3)
+
+        # Metrics this worker has added to unique_metrics, and when to do so again
+        self.known = LRUCache(getattr(settings, 'WORKER_KNOWN_METRICS', 1000000))
+        self.known_ttl = getattr(settings, 'WORKER_KNOWN_METRIC_TTL', 600)
 
     def check_if_parent_is_alive(self):
         """
@@ -39,11 +66,100 @@ class Worker(Process):
         """
         Check if the metric is in SKIP_LIST.
         """
-        for to_skip in settings.SKIP_LIST:
-            if to_skip in metric_name:
-                return True
+        return metric_name in self.skip_list
 
-        return False
+    def queue(self, func, key, *args, **kwargs):
+        """
+        Queue a command for every replica of key, or only for conn if given.
+        """
+        attempts = kwargs.get('attempts', 0)
+        if kwargs.get('conn'):
+            conns = [kwargs['conn']]
+        else:
+            conns = self.ring.get_connections(key)
+        for conn in conns:
+            self.pending[conn].append((func, key, args, attempts))
+        if self.oldest_pending is None:
+            self.oldest_pending = time()
+
+    def append(self, key, value):
+        """
+        Buffer a packed datapoint. Everything buffered for a key between two
+        flushes goes out as a single APPEND.
+        """
+        chunks = self.appends.get(key)
+        if chunks is None:
+            self.appends[key] = [value]
+        else:
+            chunks.append(value)
+        self.appended_bytes += len(value)
+        if self.oldest_pending is None:
+            self.oldest_pending = time()
+
+    def register(self, namespace, key, timestamp, now):
+        """
+        Add a metric to unique_metrics the first time it is seen, and again
+        every WORKER_KNOWN_METRIC_TTL seconds in case the Roomba removed it.
+        New metrics are queued for the Roomba to trim once their first
+        datapoint expires.
+        """
+        expires = self.known.get(key)
+        if expires is None or now >= expires:
+            self.queue('sadd', namespace + 'unique_metrics', key)
+            self.queue(self.zadd_if_absent, namespace + 'roomba_queue', repr(timestamp), key)
+            # Spread the refreshes out so they don't all come due at once
+            self.known[key] = now + self.known_ttl * (0.5 + random() / 2)
+
+    def flush(self):
+        """
+        Write every queued command with one pipeline per backend. A batch that
+        fails is queued again for the same backend, up to WORKER_FLUSH_RETRIES
+        times, so that replicas which took it aren't written twice.
+        """
+        for key, chunks in self.appends.iteritems():
+            self.queue('append', key, ''.join(chunks))
+        self.appends = {}
+        self.appended_bytes = 0
+
+        batches = self.pending
+        self.pending = defaultdict(list)
+        self.pending_points = 0
+        self.oldest_pending = None
+
+        for conn, commands in batches.iteritems():
+            pipe = conn.pipeline(transaction=False)
+            for func, key, args, attempts in commands:
+                if isinstance(func, Script):
+                    func(keys=[key], args=args, client=pipe)
+                else:
+                    getattr(pipe, func)(key, *args)
+
+            try:
+                results = pipe.execute(raise_on_error=False)
+            except Exception as e:
+                retried = 0
+                for func, key, args, attempts in commands:
+                    if attempts + 1 < self.flush_retries:
+                        self.queue(func, key, *args, attempts=attempts + 1, conn=conn)
+                        retried += 1
+                logger.error('worker error: batch of %d commands failed (%s), retrying %d' %
+                             (len(commands), e, retried))
+                continue
+
+            errors = [result for result in results if isinstance(result, ResponseError)]
+            if errors:
+                logger.error('worker error: %d of %d commands failed: %s' %
+                             (len(errors), len(commands), errors[0]))
+
+    def flush_due(self):
+        """
+        Whether there are enough, or old enough, queued commands to write.
+        """
+        if self.oldest_pending is None:
+            return False
+        return self.pending_points >= self.flush_size or \
+            self.appended_bytes >= self.flush_bytes or \
+            time() - self.oldest_pending >= self.flush_interval
 
     def run(self):
         """
@@ -54,44 +170,75 @@ class Worker(Process):
         FULL_NAMESPACE = settings.FULL_NAMESPACE
         MINI_NAMESPACE = settings.MINI_NAMESPACE
         MAX_RESOLUTION = settings.MAX_RESOLUTION
-
-        self.conn = self.context.socket(zmq.PULL)
-        self.conn.connect(
-            '{0}:{0}'.format(settings.RELAY_HOST, settings.RELAY_PUBLISH_PORT))
+        formats = write_formats()
+        slots = {
+            FULL_NAMESPACE: ring_slots(settings.FULL_DURATION),
+            MINI_NAMESPACE: ring_slots(settings.MINI_DURATION),
+        }
+
+        # Pull from every relay process, each one publishes on its own port.
+        # With hash routing the relays address this worker by its identity.
+        if getattr(settings, 'RELAY_ROUTING', 'round_robin') == 'hash':
+            self.conn = self.context.socket(zmq.DEALER)
+            self.conn.setsockopt(zmq.IDENTITY, worker_identity(self.index))
+        else:
+            self.conn = self.context.socket(zmq.PULL)
+        for i in range(getattr(settings, 'RELAY_PROCESSES', 1)):
+            self.conn.connect(
+                '{0}:{1}'.format(settings.RELAY_HOST, settings.RELAY_PUBLISH_PORT + i))
         self.poller = zmq.Poller()
         self.poller.register(self.conn, zmq.POLLIN)
 
         while 1:
-            sockets = dict(self.poller.poll())
+            self.check_if_parent_is_alive()
+
+            # Wait for a message from the relay, but not past the next flush
+            sockets = dict(self.poller.poll(self.flush_interval * 1000 if self.oldest_pending else 15000))
             if self.conn in sockets and sockets[self.conn] == zmq.POLLIN:
-            # Make sure Redis is up
+                # Make sure Redis is up
                 try:
                     self.ring.check_connections()
                 except:
                     sleep(10)
-                    self.ring = RedisRing(settings.REDIS_BACKENDS)
                     continue
 
                 try:
-                    # Get a chunk from the queue with a 15 second timeout
-                    chunk = self.q.get(True, 15)
-                    now = time()
-
-                    for metric in chunk:
-
-                        # Check if we should skip it
-                        if self.in_skip_list(metric[0]):
+                    # A message holds either one datapoint or a whole batch
+                    chunk = unpack_frames(self.conn.recv_multipart())
+                except Exception as e:
+                    logger.error("worker error: " + str(e))
+                    chunk = []
+                now = time()
+
+                for metric in chunk:
+                    # A bad datapoint only costs itself, not the rest of the
+                    # batch
+                    try:
+                        # Check if we should skip it, or if relays that
+                        # don't check names passed on one with braces
+                        if not is_name(metric[0]) or self.in_skip_list(metric[0]):
                             continue
 
-                        # Bad data coming in
-                        if metric[1][0] < now - MAX_RESOLUTION:
+                        # Bad data coming in, too old, too far in the future
+                        # or not a number. A future timestamp would take over
+                        # its ring slot until real time caught up with it.
+                        if not now - MAX_RESOLUTION <= metric[1][0] <= now + MAX_RESOLUTION:
                             continue
 
                         for ns in [FULL_NAMESPACE, MINI_NAMESPACE]:
                             key = ''.join((ns, metric[0]))
-                            self.ring.run('append', key, packb(metric[1]))
-                            ukey = ''.join((ns,'unique_metrics.',metric[0]))
-                            self.ring.run('sadd', ukey, key)
-
-                except Exception as e:
-                    logger.error("worker error: " + str(e))
\ No newline at end of file
+                            for fmt in formats:
+                                value = encode_datapoint(metric[1], fmt)
+                                if fmt == RING:
+                                    offset = ring_offset(metric[1][0], slots[ns])
+                                    self.queue('setrange', storage_key(key, fmt), offset, value)
+                                else:
+                                    self.append(storage_key(key, fmt), value)
+                            self.register(ns, key, metric[1][0], now)
+                        self.pending_points += 1
+
+                    except Exception as e:
+                        logger.error("worker error: " + str(e))
+
+            if self.flush_due():
+                self.flush()
@@ -0,0 +1,126 @@
+from zlib import crc32
+from hashlib import md5
+from time import time
+
+import settings
+from scripts import CLAIM_LEASE, FINISH_LEASE, RELEASE_LEASE
+
+
+class Leases:
+    """
+    Splits a keyspace into a fixed number of partitions, and hands them out
+    to processes on any host with leases kept in Redis.
+
+    Every process sends a heartbeat to a sorted set of members. Partitions
+    go to members by rendezvous hashing, so a member joining or leaving only
+    moves its own share of them. A member renews the leases of its
+    partitions, and gives up those that belong to someone else now. It can
+    also steal partitions whose holder hasn't finished them for
+    LEASE_STEAL_AFTER seconds.
+    """
+    def __init__(self, ring, name, owner):
+        self.ring = ring
+        self.name = name
+        self.owner = owner
+        self.partitions = getattr(settings, 'LEASE_PARTITIONS', 128)
+        self.ttl = getattr(settings, 'LEASE_TTL', 60)
+        self.steal_after = getattr(settings, 'LEASE_STEAL_AFTER', 300)
+        self.members_key = '.'.join(['skyline', 'lease', name, 'members'])
+        self.keys = ['.'.join(['skyline', 'lease', name, str(partition)])
+                     for partition in xrange(self.partitions)]
+
+        self.claim_script = ring.register_script(CLAIM_LEASE)
+        self.finish_script = ring.register_script(FINISH_LEASE)
+        self.release_script = ring.register_script(RELEASE_LEASE)
+
+    def partition(self, key):
+        """
+        The partition key belongs to.
+        """
+        return (crc32(key) & 0xffffffff) % self.partitions
+
+    def members(self, now):
+        """
+        Send a heartbeat, and return the members that sent one within
+        LEASE_TTL seconds.
+        """
+        self.ring.run_many([
+            ('zadd', self.members_key, now, self.owner),
+            ('zremrangebyscore', self.members_key, '-inf', now - self.ttl),
+            ('expire', self.members_key, self.ttl),
+        ])
+        return self.ring.run('zrange', self.members_key, 0, -1)
+
+    def preferred(self, partition, members):
+        """
+        The member a partition belongs to.
+        """
+        return max(members, key=lambda member: md5('%s-%s' % (member, partition)).digest())
+
+    def _run(self, script, partitions, now, steal=False):
+        """
+        Run a lease script for each of partitions, and return those it
+        succeeded for.
+        """
+        if not partitions:
+            return []
+        steal_after = self.steal_after if steal else ''
+        results = self.ring.run_many([
+            (script, self.keys[partition], self.owner, self.ttl, repr(now), steal_after)
+            for partition in partitions])
+        return [partition for partition, result in zip(partitions, results) if result == 1]
+
+    def acquire(self):
+        """
+        Renew or take the leases of the partitions that belong to this
+        member, give up the others, and return the partitions held.
+        """
+        now = time()
+        members = self.members(now)
+        if self.owner not in members:
+            members.append(self.owner)
+
+        owners = self.ring.run_many([('hget', key, 'owner') for key in self.keys])
+        mine = []
+        surplus = []
+        for partition, owner in enumerate(owners):
+            if self.preferred(partition, members) == self.owner:
+                mine.append(partition)
+            elif owner == self.owner:
+                surplus.append(partition)
+
+        self._run(self.release_script, surplus, now)
+        return self._run(self.claim_script, mine, now)
+
+    def renew(self, partitions):
+        """
+        Renew the leases of partitions, for work that takes a while, and
+        return those still held.
+        """
+        now = time()
+        self.members(now)
+        return self._run(self.claim_script, partitions, now)
+
+    def finish(self, partitions):
+        """
+        Record that partitions have been worked through, and return those
+        still held.
+        """
+        return self._run(self.finish_script, partitions, time())
+
+    def steal(self):
+        """
+        Take over partitions whose holder has fallen behind, and return them.
+        Partitions nobody holds are left for the member they belong to.
+        """
+        now = time()
+        leases = self.ring.run_many([('hmget', key, 'owner', 'done') for key in self.keys])
+        behind = [partition for partition, (owner, done) in enumerate(leases)
+                  if owner not in (None, self.owner) and now - float(done or 0) >= self.steal_after]
+        return self._run(self.claim_script, behind, now, steal=True)
+
+    def release(self, partitions):
+        """
+        Give up the leases of partitions.
+        """
+        self._run(self.release_script, partitions, time())
@@ -0,0 +1,47 @@
+class LRUCache(object):
+    """
+    A dict that holds at most maxsize entries, dropping the least recently
+    used ones first.
+
+    To keep every operation down to a couple of plain dict lookups the
+    eviction is generational rather than exact: entries live in a young and an
+    old generation, and when the young one fills up the old one is dropped
+    wholesale. Anything used since the last turnover survives it.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.generation_size = max(maxsize / 2, 1)
+        self.young = {}
+        self.old = {}
+
+    def get(self, key, default=None):
+        try:
+            return self.young[key]
+        except KeyError:
+            pass
+
+        try:
+            value = self.old.pop(key)
+        except KeyError:
+            return default
+
+        # Promote it so it survives the next turnover
+        self[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in self.young and len(self.young) >= self.generation_size:
+            self.old = self.young
+            self.young = {}
+        self.young[key] = value
+        self.old.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self.young or key in self.old
+
+    def __len__(self):
+        return len(self.young) + len(self.old)
+
+    def clear(self):
+        self.young = {}
+        self.old = {}
@@ -22,12 +22,23 @@ class RelayAgent():
         self.pidfile_path = settings.PID_PATH + '/relay.pid'
         self.pidfile_timeout = 5
 
+    def spawn(self, pid, index):
+        relay = Relay(pid, index)
+        relay.start()
+        return relay
+
     def run(self):
         logger.info('starting relay agent')
         pid = getpid()
-        Relay().start()
+        relays = [self.spawn(pid, i) for i in range(getattr(settings, 'RELAY_PROCESSES', 1))]
+
+        # Restart any relay that dies
         while 1:
-            time.sleep(100)
+            for i, relay in enumerate(relays):
+                if not relay.is_alive():
+                    logger.info('relay %d exited with code %s, restarting' % (i, relay.exitcode))
+                    relays[i] = self.spawn(pid, i)
+            time.sleep(1)
 
 if __name__ == "__main__":
     """
@@ -1,19 +1,415 @@
 import zmq
 
+import sys
+import mmap
 import socket
-from os import kill, getpid
-from Queue import Full
+import select
+import logging
+from errno import EAGAIN, EWOULDBLOCK, EINTR, EHOSTUNREACH, EMFILE, ENFILE, ECONNABORTED
+from os import kill, getpid, fstat, listdir, makedirs, remove
+from os.path import join, isdir
+from collections import defaultdict, deque
 from multiprocessing import Process
-from struct import Struct, unpack
-from msgpack import unpackb
-from cPickle import loads
-import re
+from struct import Struct
+from msgpack import Unpacker, packb, unpackb
+from time import time
+
+import settings
+from framing import pack_metric, pack_batch, worker_for, worker_identity, \
+    clean_datapoints, is_name, is_number
+from unpickler import decode_pickle
+from skip_list import SkipList
+
+logger = logging.getLogger("RelayLog")
+
+# Errors that only mean a non-blocking call has nothing to do right now
+RETRY_ERRNOS = (EAGAIN, EWOULDBLOCK, EINTR)
+
+# Seconds to stop accepting connections for when out of file descriptors
+ACCEPT_BACKOFF = 1
+
+# Python 2 doesn't expose SO_REUSEPORT, fall back to the platform's value
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 0x200 if sys.platform == 'darwin' or 'bsd' in sys.platform else 15)
+
+
+class Poller(object):
+    """
+    A thin wrapper around epoll, falling back to poll where epoll is missing.
+    Timeouts are in seconds either way.
+    """
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.scale = 1
+        else:
+            self.poller = select.poll()
+            self.scale = 1000
+
+    def register(self, fd):
+        self.poller.register(fd, select.POLLIN)
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+
+    def poll(self, timeout):
+        return self.poller.poll(timeout * self.scale)
+
+
+def udp_drops(sock):
+    """
+    Return how many datagrams the kernel dropped on sock because its receive
+    buffer was full, or None where /proc/net/udp isn't available.
+    """
+    try:
+        inode = str(fstat(sock.fileno()).st_ino)
+        for path in ('/proc/net/udp', '/proc/net/udp6'):
+            with open(path) as f:
+                f.readline()
+                for line in f:
+                    fields = line.split()
+                    if fields[9] == inode:
+                        return int(fields[-1])
+    except (IOError, OSError, IndexError, ValueError):
+        pass
+    return None
+
+
+def unpack_datagram(data, prefix=''):
+    """
+    Decode a MessagePack datagram. A datagram holds one or more objects, each
+    either a single (name, datapoint) pair or an array of them. Only names
+    starting with prefix are kept, with the prefix stripped. Returns the
+    datapoints and the number of malformed ones.
+    """
+    unpacker = Unpacker(use_list=False)
+    unpacker.feed(data)
+    metrics = []
+    for item in unpacker:
+        if isinstance(item, tuple) and item and isinstance(item[0], tuple):
+            metrics.extend(item)
+        else:
+            metrics.append(item)
+    return clean_datapoints(metrics, prefix)
+
+
+def parse_lines(data, prefix=''):
+    """
+    Parse Graphite plaintext 'name value timestamp' lines into datapoints.
+    Only names starting with prefix are kept, with the prefix stripped.
+    Returns the datapoints and the number of malformed lines.
+    """
+    cut = len(prefix)
+    metrics = []
+    bad = 0
+    for line in data.splitlines():
+        fields = line.split()
+        if len(fields) != 3:
+            if fields:
+                bad += 1
+            continue
+        if not fields[0].startswith(prefix):
+            continue
+        try:
+            timestamp, value = float(fields[2]), float(fields[1])
+        except ValueError:
+            bad += 1
+            continue
+        if not is_name(fields[0]) or not is_number(timestamp) or not is_number(value):
+            bad += 1
+            continue
+        metrics.append((fields[0][cut:], (timestamp, value)))
+    return metrics, bad
+
+
+class StreamConnection(object):
+    """
+    One sender connection, and its throughput stats. Subclasses decode the
+    bytes received with feed, into the datapoints under prefix.
+    """
+    def __init__(self, sock, address, max_frame_size, prefix=''):
+        self.sock = sock
+        self.address = address
+        self.max_frame_size = max_frame_size
+        self.prefix = prefix
+        self.connected_at = time()
+        self.bytes = 0
+        self.frames = 0
+        self.datapoints = 0
+        self.dropped = 0
+        self.reported = (self.connected_at, 0)
+
+    def report(self, now):
+        """
+        Log throughput since the last report
+        """
+        since, datapoints = self.reported
+        rate = (self.datapoints - datapoints) / max(now - since, 1e-3)
+        logger.info('connection %s:%s :: %.1f datapoints/s, %d frames, %d dropped frames' %
+                    (self.address[0], self.address[1], rate, self.frames, self.dropped))
+        self.reported = (now, self.datapoints)
+
+
+class PickleConnection(StreamConnection):
+    """
+    A carbon pickle connection. Incoming bytes are buffered until a complete
+    length prefixed frame is available.
+    """
+    header = Struct('!I')
+
+    def __init__(self, sock, address, max_frame_size, prefix=''):
+        super(PickleConnection, self).__init__(sock, address, max_frame_size, prefix)
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.bytes += len(data)
+        self.buffer.extend(data)
+
+        metrics = []
+        offset = 0
+        end = len(self.buffer)
+        while end - offset >= 4:
+            length = self.header.unpack_from(self.buffer, offset)[0]
+            if length > self.max_frame_size:
+                raise ValueError('frame of %d bytes is over the limit' % length)
+            if end - offset - 4 < length:
+                break
+            try:
+                datapoints, bad = decode_pickle(str(self.buffer[offset + 4:offset + 4 + length]), self.prefix)
+                metrics.extend(datapoints)
+                self.frames += 1
+                self.dropped += bad
+            except Exception:
+                self.dropped += 1
+            offset += 4 + length
+
+        # Drop consumed frames in one go rather than per frame
+        if offset:
+            del self.buffer[:offset]
+
+        self.datapoints += len(metrics)
+        return metrics
+
+
+class LineConnection(StreamConnection):
+    """
+    A Graphite plaintext connection. Every complete line received is parsed,
+    a trailing partial line is held until the rest of it arrives.
+    """
+    def __init__(self, sock, address, max_frame_size, prefix=''):
+        super(LineConnection, self).__init__(sock, address, max_frame_size, prefix)
+        # The reads since the last newline, only joined once a newline
+        # arrives so a long line isn't copied over again on every read
+        self.partial = []
+        self.partial_size = 0
+
+    def feed(self, data):
+        self.bytes += len(data)
+        end = data.rfind('\n') + 1
+        if not end:
+            self.partial.append(data)
+            self.partial_size += len(data)
+            if self.partial_size > self.max_frame_size:
+                raise ValueError('line of over %d bytes' % self.partial_size)
+            return []
+
+        if self.partial:
+            self.partial.append(data[:end])
+            lines = ''.join(self.partial)
+        else:
+            lines = data[:end]
+
+        tail = data[end:]
+        self.partial = [tail] if tail else []
+        self.partial_size = len(tail)
+        if self.partial_size > self.max_frame_size:
+            raise ValueError('line of over %d bytes' % self.partial_size)
+
+        return self.count(*parse_lines(lines, self.prefix))
+
+    def feed_datagram(self, data):
+        """
+        Parse a datagram, which only ever holds complete lines
+        """
+        self.bytes += len(data)
+        return self.count(*parse_lines(data, self.prefix))
+
+    def count(self, metrics, bad):
+        self.frames += len(metrics)
+        self.datapoints += len(metrics)
+        self.dropped += bad
+        return metrics
+
+
+class SpillSegment(object):
+    """
+    A fixed size, memory-mapped file of length prefixed records. A zeroed
+    header marks the end of the records, so a segment left behind by a crashed
+    relay can be scanned and replayed. Delivered records have their count set
+    to DELIVERED, so a restarted relay doesn't replay them again.
+    """
+    header = Struct('!II')
+    DELIVERED = 0xffffffff
+
+    def __init__(self, path, size=None):
+        self.path = path
+        if size is not None:
+            # Truncating gives a sparse, zeroed file
+            with open(path, 'wb') as f:
+                f.truncate(size)
+        self.file = open(path, 'r+b')
+        try:
+            self.size = fstat(self.file.fileno()).st_size
+            self.map = mmap.mmap(self.file.fileno(), self.size)
+        except:
+            self.file.close()
+            raise
+        self.read_offset = 0
+        self.write_offset = 0
+        self.datapoints = 0
+
+        # Find the first record not delivered yet, and the end of whatever is
+        # already in the file
+        record = self.peek(0)
+        while record is not None:
+            if record[1] == self.DELIVERED:
+                self.read_offset = record[2]
+            else:
+                self.datapoints += record[1]
+            self.write_offset = record[2]
+            record = self.peek(self.write_offset)
+
+    def append(self, payload, count):
+        """
+        Write a record, returns False when the segment is full
+        """
+        end = self.write_offset + self.header.size + len(payload)
+        if end > self.size:
+            return False
+        # Write the header last so a torn record is never read back
+        self.map[self.write_offset + self.header.size:end] = payload
+        self.header.pack_into(self.map, self.write_offset, len(payload), count)
+        self.write_offset = end
+        self.datapoints += count
+        return True
+
+    def peek(self, offset=None):
+        """
+        Return the record at offset (the read offset by default) and the
+        offset of the one after it, or None if there is no record there
+        """
+        if offset is None:
+            offset = self.read_offset
+        if offset + self.header.size > self.size:
+            return None
+        length, count = self.header.unpack_from(self.map, offset)
+        start = offset + self.header.size
+        if length == 0 or start + length > self.size:
+            return None
+        return self.map[start:start + length], count, start + length
+
+    def commit(self):
+        """
+        Mark the record at the read offset delivered and move past it.
+        Returns its count.
+        """
+        payload, count, end = self.peek()
+        self.header.pack_into(self.map, self.read_offset, len(payload), self.DELIVERED)
+        self.read_offset = end
+        return count
+
+    def delete(self):
+        self.map.close()
+        self.file.close()
+        remove(self.path)
+
+
+class SpillQueue(object):
+    """
+    Messages the workers couldn't take yet, kept in order on local disk until
+    they can be replayed. The queue is bounded to max_bytes of segments, past
+    which new messages are dropped.
+    """
+    def __init__(self, path, segment_size, max_bytes):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_segments = max(max_bytes / segment_size, 1)
+        self.spilled = 0
+        self.replayed = 0
+        self.dropped = 0
+
+        if not isdir(path):
+            makedirs(path)
+
+        # Pick up anything a previous run left behind
+        names = sorted(name for name in listdir(path) if name.endswith('.spill'))
+        self.segments = deque()
+        for name in names:
+            try:
+                self.segments.append(SpillSegment(join(path, name)))
+            except (ValueError, EnvironmentError) as e:
+                logger.warning('skipping spill segment %s, it can\'t be read: %s' % (name, e))
+                try:
+                    remove(join(path, name))
+                except EnvironmentError:
+                    pass
+        self.sequence = int(names[-1].split('.')[0]) + 1 if names else 0
+        self.pending = sum(segment.datapoints for segment in self.segments)
+        if not self.segments:
+            self.add_segment()
+
+    def add_segment(self):
+        path = join(self.path, '%020d.spill' % self.sequence)
+        self.segments.append(SpillSegment(path, self.segment_size))
+        self.sequence += 1
+
+    def put(self, worker, frames, count):
+        """
+        Spill a message, dropping it if the queue is full
+        """
+        payload = packb((worker, frames))
+        if not self.segments[-1].append(payload, count):
+            if len(self.segments) >= self.max_segments or \
+                    len(payload) + SpillSegment.header.size > self.segment_size:
+                self.dropped += count
+                return
+            self.add_segment()
+            self.segments[-1].append(payload, count)
+        self.spilled += count
+        self.pending += count
+
+    def peek(self):
+        """
+        Return the oldest message as (worker, frames, count), or None
+        """
+        while 1:
+            segment = self.segments[0]
+            record = segment.peek()
+            if record is not None:
+                worker, frames = unpackb(record[0])
+                return worker, frames, record[1]
+
+            # Fully replayed, recycle the segment
+            if segment.write_offset == 0:
+                return None
+            segment.delete()
+            self.segments.popleft()
+            if not self.segments:
+                self.add_segment()
+
+    def commit(self):
+        """
+        Mark the message returned by peek as delivered
+        """
+        count = self.segments[0].commit()
+        self.replayed += count
+        self.pending -= count
+
 
 class Relay(Process):
     """
     The listener is responsible for listening on a port.
     """
-    def __init__(self, parent_pid):
+    def __init__(self, parent_pid, index=0):
         super(Relay, self).__init__()
         try:
             self.ip = settings.RELAY_IP
@@ -21,17 +417,77 @@ class Relay(Process):
             # Default for backwards compatibility
             self.ip = socket.gethostname()
         self.parent_pid = parent_pid
-        self.port = settings.get('RELAY_LISTEN_PORT', 2702)
-        self.queue_port = settings.get('RELAY_PUBLISH_PORT', 2703)
+        self.current_pid = getpid()
+        self.port = getattr(settings, 'RELAY_LISTEN_PORT', 2702)
+        self.index = index
+        self.processes = getattr(settings, 'RELAY_PROCESSES', 1)
+        # Every relay process publishes on its own port
+        self.queue_port = getattr(settings, 'RELAY_PUBLISH_PORT', 2703) + index
         self.daemon = True
-        self.type = settings.get('RELAY_TYPE', 'pickle')
-        self.key = settings.get('ACCESS_KEY', '')
-        self._connect()
+        self.type = getattr(settings, 'RELAY_TYPE', 'pickle')
+        self.key = getattr(settings, 'ACCESS_KEY', '')
+        # Only metrics under ACCESS_KEY are accepted, stripped of the key
+        self.prefix = self.key + '.' if self.key else ''
+
+        # Optionally drop SKIP_LIST metrics here rather than in the workers
+        self.skip_list = None
+        if getattr(settings, 'RELAY_SKIP', False):
+            self.skip_list = SkipList(settings.SKIP_LIST)
+
+        # A batch size of 1 keeps the legacy one message per datapoint format
+        self.batch_size = getattr(settings, 'RELAY_BATCH_SIZE', 1)
+        self.batch_interval = getattr(settings, 'RELAY_BATCH_INTERVAL', 50) / 1000.0
+        self.batches = defaultdict(list)
+        self.last_flush = time()
+
+        # Round robin leaves the pick to ZMQ, hash pins each metric to a worker
+        self.routing = getattr(settings, 'RELAY_ROUTING', 'round_robin')
+        self.workers = [worker_identity(i) for i in range(settings.WORKER_PROCESSES)]
+        self.undeliverable = 0
+
+        # Messages are spilled to disk when the workers push back
+        self.send_hwm = getattr(settings, 'RELAY_SEND_HWM', 1000)
+        self.spill_path = getattr(settings, 'RELAY_SPILL_PATH', None)
+        self.spill_segment_size = getattr(settings, 'RELAY_SPILL_SEGMENT_SIZE', 64 * 1024 * 1024)
+        self.spill_max_bytes = getattr(settings, 'RELAY_SPILL_MAX_BYTES', 1024 * 1024 * 1024)
+        self.spill = None
+
+        self.max_frame_size = getattr(settings, 'RELAY_MAX_FRAME_SIZE', 16 * 1024 * 1024)
+        self.accept_errors = 0
+        self.accept_paused = None
+        self.stats_interval = getattr(settings, 'RELAY_STATS_INTERVAL', 60)
+        self.udp_buffer = getattr(settings, 'RELAY_UDP_RCVBUF', None)
 
     def _connect(self):
         self.context = zmq.Context()
-        self.publisher = self.context.socket(zmq.PUSH)
-        self.publisher.bind(self.queue_port)
+        if self.routing == 'hash':
+            self.publisher = self.context.socket(zmq.ROUTER)
+            # Fail loudly rather than silently drop messages for absent workers
+            self.publisher.setsockopt(zmq.ROUTER_MANDATORY, 1)
+        else:
+            self.publisher = self.context.socket(zmq.PUSH)
+        self.publisher.setsockopt(zmq.SNDHWM, self.send_hwm)
+        self.publisher.bind('tcp://*:%s' % self.queue_port)
+
+        if self.spill_path:
+            self.spill = SpillQueue(join(self.spill_path, 'relay.%d' % self.index),
+                                    self.spill_segment_size, self.spill_max_bytes)
+            if self.spill.pending:
+                logger.info('%d spilled datapoints to replay' % self.spill.pending)
+
+    def listen_socket(self, kind):
+        """
+        Create a socket bound to the listen port. When several relay processes
+        run they share the port and the kernel spreads the load between them.
+        """
+        s = socket.socket(socket.AF_INET, kind)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.processes > 1:
+            s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        if kind == socket.SOCK_DGRAM and self.udp_buffer:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.udp_buffer)
+        s.bind((self.ip, self.port))
+        return s
 
     def check_if_parent_is_alive(self):
         """
@@ -43,75 +499,271 @@ class Relay(Process):
         except:
             exit(0)
 
-    def gen_unpickle(self, infile):
+    def route(self, name):
         """
-        Generate a pickle from a stream
+        Pick the worker a metric goes to, None lets ZMQ choose
+        """
+        if self.routing == 'hash':
+            return self.workers[worker_for(name, len(self.workers))]
+        return None
+
+    def deliver(self, worker, frames, count, flags=0):
+        """
+        Send a message to a worker, or to any worker if worker is None.
+        Returns False if the send would block, or if the worker isn't
+        connected and the message can be spilled until it is.
         """
         try:
-            bunch = loads(infile)
-            yield bunch
-        except EOFError:
+            if worker is None:
+                self.publisher.send_multipart(frames, flags)
+            else:
+                self.publisher.send_multipart([worker] + frames, flags)
+        except zmq.Again:
+            return False
+        except zmq.ZMQError as e:
+            if e.errno != EHOSTUNREACH:
+                raise
+            # The owning worker isn't connected (yet), or is restarting
+            if self.spill is not None:
+                return False
+            self.undeliverable += count
+        return True
+
+    def send(self, worker, frames, count):
+        """
+        Hand a message over to the workers. Without a spill queue this blocks
+        at the high water mark, with one the message goes to disk instead.
+        """
+        if self.spill is None:
+            self.deliver(worker, frames, count)
+            return
+
+        # Nothing jumps the queue while spilled messages are waiting
+        if not self.spill.pending and self.deliver(worker, frames, count, zmq.NOBLOCK):
             return
+        self.spill.put(worker, frames, count)
 
-    def read_all(self, sock, n):
+    def replay(self):
         """
-        Read n bytes from a stream
+        Replay spilled messages until the workers push back again
         """
-        data = ''
-        while n > 0:
-            buf = sock.recv(n)
-            n -= len(buf)
-            data += buf
-        return data
+        while self.spill.pending:
+            worker, frames, count = self.spill.peek()
+            if not self.deliver(worker, frames, count, zmq.NOBLOCK):
+                return
+            self.spill.commit()
 
-    def white_list_rewrite(self, metric):
-        if not metric[0].starts with self.key:
-            return None
-        else:
-            return metric[0] = metric[0].replace('{0}.'.format(self.key ,'')
+    def publish(self, metric):
+        """
+        Hand a datapoint to the workers, batching it if batching is enabled
+        """
+        if self.skip_list is not None and metric[0] in self.skip_list:
+            return
+
+        worker = self.route(metric[0])
+        if self.batch_size <= 1:
+            self.send(worker, pack_metric(metric), 1)
+            return
+
+        batch = self.batches[worker]
+        batch.append(metric)
+        if len(batch) >= self.batch_size:
+            self.send(worker, pack_batch(batch), len(batch))
+            del self.batches[worker]
 
-    def listen_pickle(self):
+    def flush(self):
+        """
+        Send every pending batch, one message per worker
         """
-        Listen for pickles over tcp
+        if self.spill is not None:
+            self.replay()
+
+        for worker, batch in self.batches.iteritems():
+            self.send(worker, pack_batch(batch), len(batch))
+        self.batches.clear()
+        self.last_flush = time()
+
+    def report_publisher(self):
+        """
+        Log what couldn't be handed to the workers
+        """
+        if self.undeliverable:
+            logger.info('%d datapoints had no worker to go to' % self.undeliverable)
+        if self.spill is not None:
+            logger.info('spill queue :: %d spilled, %d replayed, %d dropped, %d pending datapoints' %
+                        (self.spill.spilled, self.spill.replayed, self.spill.dropped, self.spill.pending))
+
+    def flush_if_due(self):
+        """
+        Flush the pending batch if it has been held for batch_interval
+        """
+        if time() - self.last_flush >= self.batch_interval:
+            self.flush()
+
+    def publish_all(self, metrics):
+        """
+        Publish decoded datapoints
+        """
+        for metric in metrics:
+            self.publish(metric)
+
+    def accept(self, server, poller, connections, connection_class):
+        """
+        Accept every pending connection. Errors are logged and counted, they
+        never stop the relay. Out of file descriptors, the listener is left
+        out of the poller for ACCEPT_BACKOFF seconds, as it stays readable
+        until some are freed.
         """
         while 1:
             try:
-                # Set up the TCP listening socket
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-                s.bind((self.ip, self.port))
-                s.setblocking(1)
-                s.listen(5)
-                logger.info('listening over tcp for pickles on %s' % self.port)
-
-                (conn, address) = s.accept()
-                logger.info('connection from %s:%s' % (address[0], self.port))
-
-<<<<<<< HEAD:src/relay/relay.py
-=======
-                chunk = []
->>>>>>> bcb25d59fa66f2f6261386b406941623c10ebe49:src/horizon/listen.py
-                while 1:
-                    self.check_if_parent_is_alive()
-                    try:
-                        length = Struct('!I').unpack(self.read_all(conn, 4))
-                        body = self.read_all(conn, length[0])
-
-                        # Iterate and chunk each individual datapoint
-                        for bunch in self.gen_unpickle(body):
-                            for metric in bunch:
-                                metric = white_list_rewrite(metric)
-                                if metric:
-                                    self.publisher.send(metric)
-
-                    except Exception as e:
-                        logger.info(e)
-                        logger.info('incoming connection dropped, attempting to reconnect')
-                        break
+                sock, address = server.accept()
+            except socket.error as e:
+                if e.errno in RETRY_ERRNOS:
+                    return
+                self.accept_errors += 1
+                # The client hung up before it was accepted
+                if e.errno == ECONNABORTED:
+                    continue
+                logger.error('can\'t accept connections on port %s: %s' % (self.port, e))
+                if e.errno in (EMFILE, ENFILE):
+                    poller.unregister(server.fileno())
+                    self.accept_paused = time() + ACCEPT_BACKOFF
+                return
+            sock.setblocking(0)
+            connections[sock.fileno()] = connection_class(sock, address, self.max_frame_size, self.prefix)
+            poller.register(sock.fileno())
+            logger.info('connection from %s:%s' % (address[0], address[1]))
 
-            except Exception as e:
-                logger.info('can\'t connect to socket: ' + str(e))
-                break
+    def close(self, conn, poller, connections):
+        """
+        Forget about a connection, logging its lifetime stats
+        """
+        fd = conn.sock.fileno()
+        poller.unregister(fd)
+        del connections[fd]
+        conn.sock.close()
+        logger.info('connection from %s:%s closed after %d seconds :: %d bytes, %d frames, %d datapoints, %d dropped frames' %
+                    (conn.address[0], conn.address[1], time() - conn.connected_at,
+                     conn.bytes, conn.frames, conn.datapoints, conn.dropped))
+
+    def read_datagrams(self, udp, stats):
+        """
+        Drain every pending plaintext datagram
+        """
+        while 1:
+            try:
+                data, addr = udp.recvfrom(65536)
+            except socket.error as e:
+                if e.errno in RETRY_ERRNOS:
+                    return
+                raise
+            self.publish_all(stats.feed_datagram(data))
+
+    def serve(self, connection_class, udp=False):
+        """
+        Serve every tcp connection, and datagrams if udp is set, from a single
+        event loop
+        """
+        try:
+            # Set up the listening sockets
+            server = self.listen_socket(socket.SOCK_STREAM)
+            server.setblocking(0)
+            server.listen(socket.SOMAXCONN)
+            logger.info('listening over tcp for %s on %s' % (self.type, self.port))
+            if udp:
+                datagrams = self.listen_socket(socket.SOCK_DGRAM)
+                datagrams.setblocking(0)
+                datagram_stats = LineConnection(datagrams, ('udp', self.port), self.max_frame_size, self.prefix)
+                logger.info('listening over udp for %s on %s' % (self.type, self.port))
+        except Exception as e:
+            logger.info('can\'t connect to socket: ' + str(e))
+            return
+
+        poller = Poller()
+        poller.register(server.fileno())
+        if udp:
+            poller.register(datagrams.fileno())
+        connections = {}
+        last_report = time()
+
+        while 1:
+            self.check_if_parent_is_alive()
+
+            if self.accept_paused is not None and time() >= self.accept_paused:
+                poller.register(server.fileno())
+                self.accept_paused = None
+
+            for fd, event in poller.poll(1):
+                if fd == server.fileno():
+                    self.accept(server, poller, connections, connection_class)
+                    continue
+
+                if udp and fd == datagrams.fileno():
+                    self.read_datagrams(datagrams, datagram_stats)
+                    continue
+
+                conn = connections.get(fd)
+                if conn is None:
+                    continue
+
+                try:
+                    data = conn.sock.recv(65536)
+                except socket.error as e:
+                    if e.errno in RETRY_ERRNOS:
+                        continue
+                    data = ''
+
+                # An empty read means the sender hung up
+                if not data:
+                    self.close(conn, poller, connections)
+                    continue
+
+                try:
+                    self.publish_all(conn.feed(data))
+                except ValueError as e:
+                    logger.info('dropping connection from %s:%s: %s' % (conn.address[0], conn.address[1], e))
+                    conn.dropped += 1
+                    self.close(conn, poller, connections)
+
+            # Everything read in this pass goes out as (at most) one message
+            self.flush()
+
+            now = time()
+            if now - last_report >= self.stats_interval:
+                logger.info('serving %d %s connections, %d accept errors' % (len(connections), self.type, self.accept_errors))
+                for conn in connections.itervalues():
+                    conn.report(now)
+                if udp:
+                    datagram_stats.report(now)
+                    self.report_drops(datagrams)
+                self.report_publisher()
+                last_report = now
+
+    def report_drops(self, sock):
+        """
+        Log the datagrams the kernel dropped on the udp socket
+        """
+        drops = udp_drops(sock)
+        if drops is not None:
+            logger.info('kernel dropped %d datagrams on udp port %s' % (drops, self.port))
+
+    def handle_datagram(self, data, stats):
+        """
+        Decode and publish a MessagePack datagram. One that can't be decoded
+        or routed is counted and dropped, it never stops the listener.
+        """
+        stats.bytes += len(data)
+        try:
+            metrics, bad = unpack_datagram(data, self.prefix)
+            self.publish_all(metrics)
+        except Exception as e:
+            stats.dropped += 1
+            logger.debug('dropping datagram: %s' % e)
+            return
+
+        stats.frames += 1
+        stats.dropped += bad
+        stats.datapoints += len(metrics)
 
     def listen_udp(self):
         """
@@ -119,35 +771,53 @@ class Relay(Process):
         """
         while 1:
             try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                s.bind((self.ip, self.port))
-                logger.info('listening over udp for messagepack on %s' % self.port)
-
-                while 1:
-                    self.check_if_parent_is_alive()
-                    data, addr = s.recvfrom(1024)
-                    metric = unpackb(data)
-                    metric = white_list_rewrite(metric)
-                        if metric:
-                            self.publisher.send(metric)
-
+                s = self.listen_socket(socket.SOCK_DGRAM)
+                if self.batch_size > 1:
+                    # Wake up regularly so a quiet sender can't hold a batch
+                    s.settimeout(self.batch_interval)
+                logger.info('listening over udp for messagepack on %s with a %d byte receive buffer' %
+                            (self.port, s.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)))
             except Exception as e:
                 logger.info('can\'t connect to socket: ' + str(e))
                 break
 
+            stats = StreamConnection(s, ('udp', self.port), self.max_frame_size)
+            last_report = time()
+
+            while 1:
+                self.check_if_parent_is_alive()
+
+                now = time()
+                if now - last_report >= self.stats_interval:
+                    stats.report(now)
+                    self.report_drops(s)
+                    self.report_publisher()
+                    last_report = now
+
+                try:
+                    # Take the largest possible payload so nothing is truncated
+                    data, addr = s.recvfrom(65536)
+                except socket.timeout:
+                    self.flush()
+                    continue
+
+                self.handle_datagram(data, stats)
+                self.flush_if_due()
+
     def run(self):
         """
         Called when process intializes.
         """
-        logger.info('started listener')
+        logger.info('started listener %d' % self.index)
+
+        # ZMQ sockets can't cross a fork, so connect in the child
+        self._connect()
 
         if self.type == 'pickle':
-<<<<<<< HEAD:src/relay/relay.py
-                self.listen_pickle()
-=======
-            self.listen_pickle()
->>>>>>> bcb25d59fa66f2f6261386b406941623c10ebe49:src/horizon/listen.py
+            self.serve(PickleConnection)
+        elif self.type == 'line':
+            self.serve(LineConnection, udp=True)
         elif self.type == 'udp':
             self.listen_udp()
         else:
-            logging.error('unknown listener format')
+            logger.error('unknown listener format')
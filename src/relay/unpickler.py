@@ -0,0 +1,23 @@
+from cPickle import Unpickler, UnpicklingError
+from cStringIO import StringIO
+
+from framing import clean_datapoints
+
+
+def decode_pickle(frame, prefix=''):
+    """
+    Decode a carbon pickle frame, a list of (name, (timestamp, value)) tuples.
+
+    Only plain lists, tuples, strings and numbers are accepted, anything that
+    would make the unpickler import a global is refused, so frames from an open
+    port can't run code. Datapoints whose name doesn't start with prefix are
+    dropped and the prefix is stripped from the others as they are decoded.
+    Returns the datapoints, and the number of malformed ones that were dropped.
+    """
+    unpickler = Unpickler(StringIO(frame))
+    unpickler.find_global = None
+    datapoints = unpickler.load()
+
+    if not isinstance(datapoints, (list, tuple)):
+        raise UnpicklingError('%r is not a list of carbon datapoints' % (datapoints,))
+    return clean_datapoints(datapoints, prefix)
@@ -1,61 +1,363 @@
+from os import getpid
+from re import sub
+from hashlib import md5
+from math import floor
+from struct import unpack_from
+from bisect import bisect
+from random import choice
+from time import time, sleep
+from threading import Thread
+from multiprocessing.pool import ThreadPool
+from redis import StrictRedis
+from redis.client import Script
+from lru import LRUCache
+
+import logging
+import settings
+
+# Circuit breaker states. A closed node takes traffic, an open one is out of
+# the ring and only probed every REDIS_BREAKER_TIMEOUT seconds.
+CLOSED = 'closed'
+OPEN = 'open'
+
+# Commands that only read, and can be sent to any one replica of a key.
+# Everything else is sent to every replica.
+READS = frozenset([
+    'get', 'mget', 'getrange', 'strlen', 'exists', 'type', 'ttl', 'pttl', 'dump',
+    'smembers', 'sismember', 'scard', 'srandmember', 'sscan',
+    'zrange', 'zrangebyscore', 'zrank', 'zscore', 'zcard', 'zscan',
+])
+
+
+class ConsistentHash(object):
+    """
+    Ketama style consistent hashing over weighted nodes. Each node gets
+    points on the ring in proportion to its weight. Points are laid out like
+    the hash_ring package, so keys stay on the backends earlier releases put
+    them on.
+
+    As in Redis Cluster, only the part of a key between the first { and the
+    next } is hashed, if it isn't empty. Keys sharing that hash tag land on
+    the same nodes, and can share a pipeline or a transaction.
+    """
+    def __init__(self, nodes, weights=None, vnodes=40):
+        weights = weights or {}
+        total = sum(weights.get(node, 1) for node in nodes)
+        owners = {}
+        for node in sorted(nodes):
+            factor = int(floor(vnodes * len(nodes) * weights.get(node, 1) / total))
+            for j in xrange(factor):
+                digest = md5('%s-%s' % (node, j)).digest()
+                for i in xrange(3):
+                    owners[unpack_from('<I', digest, i * 4)[0]] = node
+        self.points = sorted(owners)
+
+        # The distinct nodes met walking clockwise from every point. A key's
+        # replicas are the first live ones from the point after its hash.
+        ring = [owners[point] for point in self.points]
+        distinct = len(set(ring))
+        self.preferences = []
+        for start in xrange(len(ring)):
+            preference = []
+            position = start
+            while len(preference) < distinct:
+                node = ring[position % len(ring)]
+                if node not in preference:
+                    preference.append(node)
+                position += 1
+            self.preferences.append(preference)
+
+    def nodes(self, key):
+        """
+        Every node, in the order key prefers them.
+        """
+        start = key.find('{')
+        if start != -1:
+            end = key.find('}', start + 1)
+            if end > start + 1:
+                key = key[start + 1:end]
+        position = bisect(self.points, unpack_from('<I', md5(key).digest())[0])
+        if position == len(self.points):
+            position = 0
+        return self.preferences[position]
 
-from hash_ring import HashRing
-from redis import StrictRedis, WatchError
 
-MAX_FAILURES = 3
 class RedisRing:
-	def __init__(self, backends):
-		self.map = HashRing()
-		self.state = {
-			'live': {},
-			'failed': {},
-		}
+    """
+    Spreads keys over REDIS_BACKENDS with consistent hashing, storing each
+    key on REDIS_REPLICATION of them.
+
+    A monitor thread pings every backend in the background and takes failing
+    or slow ones out of the ring, so that callers never wait on a ping. Keys
+    of a backend that is out fall to the next live one on the ring.
+    """
+    def __init__(self, backends, logger=None):
+        self.backends = backends
+        self.hash = ConsistentHash(backends, getattr(settings, 'REDIS_WEIGHTS', {}),
+                                   getattr(settings, 'REDIS_VNODES', 40))
+        self.replication = getattr(settings, 'REDIS_REPLICATION', 1)
+        self.route_cache_size = getattr(settings, 'REDIS_ROUTE_CACHE', 250000)
+        self.logger = logger or logging.getLogger("RedisLog")
+        self.pool = None
+        self.pool_pid = None
+        self.monitor_pid = None
+
+        self.interval = getattr(settings, 'REDIS_HEALTH_INTERVAL', 1)
+        self.timeout = getattr(settings, 'REDIS_HEALTH_TIMEOUT', 500) / 1000.0
+        self.slow = getattr(settings, 'REDIS_SLOW_LATENCY', 250) / 1000.0
+        self.max_failures = getattr(settings, 'REDIS_MAX_FAILURES', 3)
+        self.breaker_timeout = getattr(settings, 'REDIS_BREAKER_TIMEOUT', 30)
+
+        self.connections = {}
+        self.probes = {}
+        self.health = {}
         for backend in backends:
-        	self._connect(backend)
+            self.connections[backend] = self._connect(backend)
+            # Pings get their own short timeout, so a hung node can't hold up
+            # the monitor for long
+            self.probes[backend] = self._connect(backend, socket_timeout=self.timeout)
+            self.health[backend] = {
+                'state': CLOSED,
+                'failures': 0,
+                'latency': None,
+                'opened': None,
+            }
+        self._build()
 
-    def _connect(self, connection_string):
-    	self.live.append(connection_string)
+    def _connect(self, connection_string, **kwargs):
         if connection_string.startswith('unix://'):
-            socket = connection_string.replace('unix://','')
-            conn = StrictRedis(unix_socket_path=socket)
-        else:
-            conn = StrictRedis.from_url(connection_string)
-        self.state['live'][conn]= backend
-        self.map.add_node(conn)
+            socket = connection_string.replace('unix://', '')
+            return StrictRedis(unix_socket_path=socket, **kwargs)
+        return StrictRedis.from_url(connection_string, **kwargs)
+
+    def _build(self):
+        live = dict((backend, self.connections[backend]) for backend in self.backends
+                    if self.health[backend]['state'] == CLOSED)
+        failed = dict((backend, self.health[backend]['failures']) for backend in self.backends
+                      if self.health[backend]['state'] != CLOSED)
+        # The state is swapped in whole, as the monitor thread rebuilds it.
+        # Keys are looked up over and over again, so their replicas are
+        # remembered until the live backends change.
+        self.state = {
+            'live': live,
+            'failed': failed,
+            'routes': LRUCache(self.route_cache_size),
+        }
+
+    def get_connections(self, string_key):
+        """
+        The connections to every replica of a key, to write to.
+        """
+        state = self.state
+        conns = state['routes'].get(string_key)
+        if conns is None:
+            live = state['live']
+            conns = [live[node] for node in self.hash.nodes(string_key) if node in live]
+            if not conns:
+                raise Exception('No live redis backends!')
+            conns = conns[:self.replication]
+            state['routes'][string_key] = conns
+        return conns
 
     def get_connection(self, string_key):
-    	return self.map.get_node(string_key)
-
-   	def check_connections(self):
-   		for conn in self.map.nodes:
-   			while True:
-	   			try:
-	   				conn.ping()
-	   				break
-	   			except:
-	   				self.map.remove_node(conn)
-	   				backend = self.state['live'].get(conn)
-	   				del(self.state['live'][conn])
-	   				failures = self.state['failed'].get(backend, 0)
-	   				failures += 1
-	   				self.state['failed'][backend] = failures
-	   				if failures < MAX_FAILURES:
-	   					self._connect(backend)
-	   				else:
-	   					break
-	   	if len(self.state['live']) == 0:
-	   		raise Exception('No live redis backends!')
-
-	def run(self, func, key, *args):
-		conn = self.hash_ring.get_node(key)
-		try:
-			if hashattr(conn, func):
-				method = getattr(conn, func)
-				if callable(method):
-					if args:
-						return method(key, *args)
-					else:
-						return method(key)
-		except:
-			raise
+        """
+        The connection to one replica of a key, to read from. Reads are
+        spread over the replicas.
+        """
+        conns = self.state['routes'].get(string_key) or self.get_connections(string_key)
+        if len(conns) == 1:
+            return conns[0]
+        return choice(conns)
+
+    def probe(self, backend, now):
+        """
+        Ping a backend and update its health. Returns True if its breaker
+        opened or closed.
+        """
+        health = self.health[backend]
+        if health['state'] == OPEN and now - health['opened'] < self.breaker_timeout:
+            return False
+
+        try:
+            start = time()
+            self.probes[backend].ping()
+            latency = time() - start
+            if health['latency'] is None:
+                health['latency'] = latency
+            else:
+                health['latency'] = 0.8 * health['latency'] + 0.2 * latency
+            healthy = latency < self.slow
+        except Exception:
+            healthy = False
+
+        if healthy:
+            health['failures'] = 0
+            if health['state'] == OPEN:
+                health['state'] = CLOSED
+                self.logger.info('redis backend %s is back, closing its breaker' % backend)
+                return True
+            return False
+
+        health['failures'] += 1
+        if health['state'] == OPEN:
+            # Still down, wait another REDIS_BREAKER_TIMEOUT
+            health['opened'] = now
+        elif health['failures'] >= self.max_failures:
+            health['state'] = OPEN
+            health['opened'] = now
+            self.logger.error('redis backend %s failed %d pings, opening its breaker' %
+                              (backend, health['failures']))
+            return True
+        return False
+
+    def monitor(self):
+        """
+        Probe every backend each REDIS_HEALTH_INTERVAL seconds, and rebuild
+        the ring when one changes state.
+        """
+        while 1:
+            now = time()
+            changed = False
+            for backend in self.backends:
+                changed = self.probe(backend, now) or changed
+            if changed:
+                self._build()
+            sleep(max(0, self.interval - (time() - now)))
+
+    def check_connections(self):
+        """
+        Make sure this process has a monitor, and raise if no backend is up.
+        Only reads the monitor's cached state, so it is cheap to call often.
+        """
+        if self.monitor_pid != getpid():
+            self.monitor_pid = getpid()
+            thread = Thread(target=self.monitor)
+            thread.daemon = True
+            thread.start()
+
+        if not self.state['live']:
+            raise Exception('No live redis backends!')
+
+    def health_metrics(self, prefix='skyline.redis'):
+        """
+        The health of every backend, as (name, value) pairs to send to
+        Graphite.
+        """
+        metrics = []
+        for backend in self.backends:
+            health = self.health[backend]
+            name = '.'.join([prefix, sub('[^a-zA-Z0-9]+', '_', backend).strip('_')])
+            metrics.append((name + '.up', int(health['state'] == CLOSED)))
+            metrics.append((name + '.failures', health['failures']))
+            if health['latency'] is not None:
+                metrics.append((name + '.latency', health['latency'] * 1000))
+        return metrics
+
+    def register_script(self, source):
+        """
+        A Lua script for run_many. Pipelines load it with SCRIPT LOAD on the
+        backends that don't have it yet, and run it with EVALSHA.
+        """
+        return Script(self.connections[self.backends[0]], source)
+
+    def run(self, func, key, *args):
+        """
+        Run a command on one replica of key if it only reads, on all of them
+        otherwise. Returns the result from the first replica.
+        """
+        if func in READS:
+            conns = [self.get_connection(key)]
+        else:
+            conns = self.get_connections(key)
+        results = [getattr(conn, func)(key, *args) for conn in conns]
+        return results[0]
+
+    def _pool(self):
+        """
+        Threads to talk to every backend at once. Made on first use in each
+        process, as threads don't survive the fork into analyzer and Roomba
+        processes.
+        """
+        if self.pool is None or self.pool_pid != getpid():
+            self.pool = ThreadPool(len(self.backends))
+            self.pool_pid = getpid()
+        return self.pool
+
+    def partition(self, keys, writes=None):
+        """
+        Group keys by the connection owning them. Returns a dict of connection
+        to the positions of its keys in keys. Keys are read from one replica,
+        except for those at the positions flagged in writes.
+        """
+        partitions = {}
+        for position, key in enumerate(keys):
+            if writes and writes[position]:
+                conns = self.get_connections(key)
+            else:
+                conns = [self.get_connection(key)]
+            for conn in conns:
+                partitions.setdefault(conn, []).append(position)
+        return partitions
+
+    def _scatter(self, func, keys, items, writes=None, replicas=False):
+        """
+        Call func(conn, items) with the items whose key each connection owns,
+        for every connection in parallel, and gather the results back in the
+        order of items. Writes sent to several replicas return one result,
+        or with replicas a list of (connection, result) pairs, one for each.
+        """
+        partitions = self.partition(keys, writes).items()
+
+        def call(partition):
+            conn, positions = partition
+            return func(conn, [items[position] for position in positions])
+
+        if len(partitions) > 1:
+            replies = self._pool().map(call, partitions)
+        else:
+            replies = map(call, partitions)
+
+        if replicas:
+            results = [[] for item in items]
+            for (conn, positions), reply in zip(partitions, replies):
+                for position, result in zip(positions, reply):
+                    results[position].append((conn, result))
+            return results
+
+        results = [None] * len(items)
+        gathered = [False] * len(items)
+        for (conn, positions), reply in zip(partitions, replies):
+            for position, result in zip(positions, reply):
+                if not gathered[position]:
+                    results[position] = result
+                    gathered[position] = True
+        return results
+
+    def mget(self, keys):
+        """
+        Get many keys, with one MGET per backend.
+        """
+        if not keys:
+            return []
+        return self._scatter(lambda conn, node_keys: conn.mget(node_keys), keys, keys)
+
+    def run_many(self, commands, replicas=False):
+        """
+        Run many (func, key, *args) commands, with one pipeline per backend,
+        and return their results in order. func can also be a script from
+        register_script, which gets key as its only key. With replicas, each
+        result is a list of (connection, result) pairs for every replica the
+        command ran on, and errors are returned rather than raised.
+        """
+        def execute(conn, node_commands):
+            pipe = conn.pipeline(transaction=False)
+            for command in node_commands:
+                if isinstance(command[0], Script):
+                    command[0](keys=command[1:2], args=command[2:], client=pipe)
+                else:
+                    getattr(pipe, command[0])(*command[1:])
+            return pipe.execute(raise_on_error=not replicas)
 
+        keys = [command[1] for command in commands]
+        writes = [command[0] not in READS for command in commands]
+        return self._scatter(execute, keys, commands, writes, replicas)
@@ -0,0 +1,250 @@
+"""
+Lua scripts run on the Redis backends.
+
+Scripts are registered with RedisRing.register_script and run with EVALSHA,
+usually many at a time in pipelines. They rely on the struct and cmsgpack
+libraries Redis ships with its Lua interpreter.
+"""
+from codec import BINARY, COMPRESSED, RING, RECORD, SERIES_HEADER, \
+    SERIES_MARKER, BLOCK_HEADER
+
+# Trim the series in KEYS[1], stored in format ARGV[1], of datapoints at or
+# before the cutoff in ARGV[2] and of all but one datapoint of each timestamp,
+# as trim_series does. Returns what became of the series, how many datapoints
+# are left uncompressed and, unless it is dead, the cutoff past which the
+# series will need trimming again.
+#
+# Series are nearly always in order already, so the records after the cutoff
+# are found in the same pass that checks the order, and taken as they are.
+# Only a series that is out of order is sorted. Compressed series lose their
+# expired blocks and have their tail trimmed, but sealing the tail needs zlib
+# and is left to the caller. Rings are only checked for a datapoint after the
+# cutoff, and need visiting again once that datapoint expires.
+TRIM_SERIES = """
+local raw = redis.call('GET', KEYS[1])
+if not raw then
+    return {'missing', 0}
+end
+local fmt = ARGV[1]
+local cutoff = tonumber(ARGV[2])
+
+if fmt == '%(ring)s' then
+    for offset = 1, #raw - %(record)d + 1, %(record)d do
+        local timestamp = struct.unpack('<d', raw, offset)
+        if timestamp > cutoff then
+            return {'trimmed', 0, string.format('%%.17g', timestamp)}
+        end
+    end
+    return {'dead', 0}
+end
+
+-- Keep the items after cutoff from count items, given their timestamps and
+-- a way to slice them out of raw. Duplicates keep the item stored first.
+-- Returns what is left, how many items that is, whether anything changed and
+-- the oldest timestamp left.
+local function clean(count, timestamp, slice)
+    local cut = count
+    local ordered = true
+    local previous
+    for i = 0, count - 1 do
+        local current = timestamp(i)
+        if current > cutoff then
+            if cut == count then
+                cut = i
+            elseif not (current > previous) then
+                ordered = false
+                break
+            end
+            previous = current
+        elseif cut < count or current ~= current then
+            ordered = false
+            break
+        end
+    end
+    if ordered then
+        return slice(cut, count), count - cut, cut > 0, cut < count and timestamp(cut) or nil
+    end
+
+    local kept = {}
+    for i = 0, count - 1 do
+        local current = timestamp(i)
+        if current > cutoff then
+            kept[#kept + 1] = {current, i}
+        end
+    end
+    table.sort(kept, function(a, b)
+        if a[1] ~= b[1] then
+            return a[1] < b[1]
+        end
+        return a[2] < b[2]
+    end)
+    local items = {}
+    previous = nil
+    for _, item in ipairs(kept) do
+        if item[1] ~= previous then
+            items[#items + 1] = slice(item[2], item[2] + 1)
+            previous = item[1]
+        end
+    end
+    return table.concat(items), #items, true, kept[1] and kept[1][1]
+end
+
+-- Clean the binary records from byte offset on, ignoring a partial one
+local function clean_records(offset)
+    local count = math.floor((#raw - offset) / %(record)d)
+    local function timestamp(i)
+        return (struct.unpack('<d', raw, offset + i * %(record)d + 1))
+    end
+    local function slice(first, last)
+        return string.sub(raw, offset + first * %(record)d + 1, offset + last * %(record)d)
+    end
+    local records, left, changed, oldest = clean(count, timestamp, slice)
+    return records, left, changed or (#raw - offset) %% %(record)d ~= 0, oldest
+end
+
+if fmt == '%(binary)s' then
+    local records, left, changed, oldest = clean_records(0)
+    if left == 0 then
+        return {'dead', 0}
+    end
+    if changed then
+        redis.call('SET', KEYS[1], records)
+    end
+    return {'trimmed', left, string.format('%%.17g', oldest)}
+end
+
+if fmt == '%(compressed)s' then
+    -- Blocks go once their last datapoint expires
+    local sealed = {}
+    local expires
+    local dropped = false
+    local version
+    local offset = 0
+    if #raw >= %(header)d then
+        local length, marker
+        length, version, marker = struct.unpack('<IHH', raw)
+        if marker == %(marker)d then
+            offset = %(header)d
+            while offset < %(header)d + length do
+                local flags, count, size, first, last = struct.unpack('<BIIdd', raw, offset + 1)
+                local stop = offset + %(block)d + size
+                if last > cutoff then
+                    sealed[#sealed + 1] = string.sub(raw, offset + 1, stop)
+                    expires = math.min(expires or last, last)
+                else
+                    dropped = true
+                end
+                offset = stop
+            end
+        end
+    end
+
+    local tail, left, changed, oldest = clean_records(offset)
+    if oldest then
+        expires = math.min(expires or oldest, oldest)
+    end
+    if #sealed == 0 and left == 0 then
+        return {'dead', 0}
+    end
+    if dropped or changed then
+        if offset > 0 then
+            sealed = table.concat(sealed)
+            tail = struct.pack('<IHH', #sealed, version, %(marker)d) .. sealed .. tail
+        end
+        redis.call('SET', KEYS[1], tail)
+    end
+    return {'trimmed', left, string.format('%%.17g', expires)}
+end
+
+-- Msgpack datapoints vary in length, so they are all decoded to find where
+-- each one starts. A partial datapoint at the end is dropped.
+local starts = {}
+local points = {}
+local stop = 0
+while stop < #raw do
+    local ok, next_offset, point = pcall(cmsgpack.unpack_one, raw, stop)
+    if not ok then
+        break
+    end
+    starts[#starts + 1] = stop
+    points[#points + 1] = point
+    if next_offset == -1 then
+        stop = #raw
+    else
+        stop = next_offset
+    end
+end
+starts[#starts + 1] = stop
+
+local function timestamp(i)
+    local point = points[i + 1]
+    if type(point) == 'table' and type(point[1]) == 'number' then
+        return point[1]
+    end
+    return 0 / 0
+end
+local function slice(first, last)
+    return string.sub(raw, starts[first + 1] + 1, starts[last + 1])
+end
+local series, left, changed, oldest = clean(#points, timestamp, slice)
+if left == 0 then
+    return {'dead', 0}
+end
+if changed or stop < #raw then
+    redis.call('SET', KEYS[1], series)
+end
+return {'trimmed', left, string.format('%%.17g', oldest)}
+""" % {
+    'binary': BINARY,
+    'compressed': COMPRESSED,
+    'ring': RING,
+    'record': RECORD.size,
+    'header': SERIES_HEADER.size,
+    'marker': SERIES_MARKER,
+    'block': BLOCK_HEADER.size,
+}
+
+# Add the member ARGV[2] to the sorted set in KEYS[1] with the score ARGV[1],
+# unless it is already in there. Returns 1 if it was added.
+ZADD_IF_ABSENT = """
+if redis.call('ZSCORE', KEYS[1], ARGV[2]) then
+    return 0
+end
+return redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+"""
+
+# Take or renew the lease in KEYS[1] for the owner ARGV[1], for ARGV[2]
+# seconds, at the time ARGV[3]. A lease held by someone else is only taken if
+# ARGV[4] is given and they haven't finished its partition for that many
+# seconds. Returns 1 if the owner holds the lease.
+CLAIM_LEASE = """
+local owner, done = unpack(redis.call('HMGET', KEYS[1], 'owner', 'done'))
+if owner ~= ARGV[1] then
+    if owner and (ARGV[4] == '' or tonumber(ARGV[3]) - tonumber(done or 0) < tonumber(ARGV[4])) then
+        return 0
+    end
+    redis.call('HMSET', KEYS[1], 'owner', ARGV[1], 'done', ARGV[3])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# Record that the owner ARGV[1] finished the partition of the lease in KEYS[1]
+# at the time ARGV[3], and renew it for ARGV[2] seconds. Returns 1 if the
+# owner still held the lease.
+FINISH_LEASE = """
+if redis.call('HGET', KEYS[1], 'owner') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'done', ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# Give up the lease in KEYS[1], if the owner ARGV[1] holds it.
+RELEASE_LEASE = """
+if redis.call('HGET', KEYS[1], 'owner') ~= ARGV[1] then
+    return 0
+end
+return redis.call('DEL', KEYS[1])
+"""
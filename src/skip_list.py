@@ -0,0 +1,48 @@
+import re
+
+from lru import LRUCache
+
+
+def trie_pattern(strings):
+    """
+    Build a regular expression matching any of strings, with the alternatives
+    folded into a trie so the engine only follows branches that match the
+    text so far instead of trying every string at every offset.
+    """
+    trie = {}
+    for string in strings:
+        node = trie
+        for char in string:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def pattern(node):
+        # A complete string is enough, longer ones sharing its prefix can't
+        # change the verdict
+        if '' in node:
+            return ''
+        branches = [re.escape(char) + pattern(child) for char, child in sorted(node.items())]
+        if len(branches) == 1:
+            return branches[0]
+        return '(?:%s)' % '|'.join(branches)
+
+    return pattern(trie)
+
+
+class SkipList(object):
+    """
+    Matches metric names against SKIP_LIST. A name is skipped if any entry is
+    a substring of it, exactly like a loop of 'in' tests, but the entries are
+    compiled once into a single automaton and verdicts are cached per name.
+    """
+    def __init__(self, entries, cache_size=100000):
+        entries = list(entries)
+        self.search = re.compile(trie_pattern(entries)).search if entries else None
+        self.cache = LRUCache(cache_size)
+
+    def __contains__(self, metric_name):
+        verdict = self.cache.get(metric_name)
+        if verdict is None:
+            verdict = self.search is not None and self.search(metric_name) is not None
+            self.cache[metric_name] = verdict
+        return verdict
@@ -2,17 +2,19 @@ import redis
 import logging
 import simplejson as json
 import sys
+import operator
 from msgpack import Unpacker
 from flask import Flask, request, render_template
 from daemon import runner
 from os.path import dirname, abspath
-from ring import RedisRing
 
 # add the shared settings file to namespace
 sys.path.insert(0, dirname(dirname(abspath(__file__))))
 import settings
+from ring import RedisRing
+from codec import MSGPACK, storage_key, read_format, decode_timeseries
 
-RING = RedisRing(settings.REDIS_BACKENDS)
+RING = RedisRing(settings.REDIS_BACKENDS, logging.getLogger("AppLog"))
 
 app = Flask(__name__)
 app.config['PROPAGATE_EXCEPTIONS'] = True
@@ -39,14 +41,20 @@ def app_settings():
 def data():
     metric = request.args.get('metric', None)
     try:
-        raw_series = REDIS_CONN.get(metric)
+        fmt = read_format()
+        raw_series = RING.run('get', storage_key(metric, fmt))
         if not raw_series:
             resp = json.dumps({'results': 'Error: No metric by that name'})
             return resp, 404
         else:
-            unpacker = Unpacker(use_list = False)
-            unpacker.feed(raw_series)
-            timeseries = [item[:2] for item in unpacker]
+            if metric.startswith(settings.MINI_NAMESPACE):
+                duration = settings.MINI_DURATION
+            else:
+                duration = settings.FULL_DURATION
+            timeseries = decode_timeseries(raw_series, fmt, duration)
+            if fmt != MSGPACK:
+                timeseries = timeseries.tolist()
+            timeseries = [item[:2] for item in timeseries]
             resp = json.dumps({'results': timeseries})
             return resp, 200
     except Exception as e:
@@ -58,14 +66,12 @@ def data():
 def anomalies():
     resp = 'handle_data([])'
     try:
-        analyzer_key_node = REDIS_BACKENDS.get_node(settings.ANALYZER_ANOMALY_KEY)
-        anomaly_keys = RING.run('smembers', settings.ANALYZER_ANOMALY_KEY)
+        anomaly_keys = list(RING.run('smembers', settings.ANALYZER_ANOMALY_KEY))
         anomalies = {}
         if not anomaly_keys:
             logger.info("No anomaly key found!")
             return resp, 200
-        for key in list(anomaly_keys):
-            raw_anomalies = RING.run('get',key)
+        for key, raw_anomalies in zip(anomaly_keys, RING.mget(anomaly_keys)):
             if not raw_anomalies:
                 logger.info("Can't get anomalies for key %s, removing it from set" % key)
                 RING.run('srem', settings.ANALYZER_ANOMALY_KEY, key)
@@ -98,6 +104,9 @@ class App():
         logger.info('hosted at %s' % settings.WEBAPP_IP)
         logger.info('running on port %d' % settings.WEBAPP_PORT)
 
+        # Start watching the Redis backends
+        RING.check_connections()
+
         app.run(settings.WEBAPP_IP, settings.WEBAPP_PORT)
 
 if __name__ == "__main__":
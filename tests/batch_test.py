@@ -0,0 +1,74 @@
+import unittest2 as unittest
+from mock import patch
+from time import time
+import numpy as np
+
+import sys
+from os.path import dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))) + '/src')
+sys.path.insert(0, dirname(dirname(abspath(__file__))) + '/src/analyzer')
+
+import algorithms
+import batch
+
+
+class TestBatch(unittest.TestCase):
+    """
+    Test that the batch algorithms agree with the scalar ones
+    """
+
+    def data(self, ts):
+        """
+        Series of different lengths and shapes, some with a spike at the end
+        """
+        rng = np.random.RandomState(42)
+        timeseries = []
+        for i in range(60):
+            length = rng.randint(3, 1500)
+            timestamps = ts - 90000 + np.arange(length) * (90000.0 / length)
+            if i % 4 == 0:
+                values = rng.normal(100, 5, length)
+            elif i % 4 == 1:
+                values = rng.poisson(3, length).astype(float)
+            elif i % 4 == 2:
+                values = np.linspace(0, 50, length) + rng.normal(0, 1, length)
+            else:
+                values = np.ones(length)
+                values[rng.randint(length)] = 7
+            if i % 3 == 0:
+                values[-rng.randint(1, 4):] += rng.choice([5, 50, 500, -30])
+            timeseries.append(zip(timestamps.tolist(), values.tolist()))
+        return ts, timeseries
+
+    @patch.object(batch, 'time')
+    @patch.object(algorithms, 'time')
+    def test_run_algorithms(self, timeMock, batchTimeMock):
+        timeMock.return_value, timeseries = self.data(time())
+        batchTimeMock.return_value = timeMock.return_value
+
+        names = sorted(batch.BATCH_ALGORITHMS)
+        ensembles = batch.run_algorithms(timeseries, names)
+        for series, ensemble in zip(timeseries, ensembles):
+            expected = [getattr(algorithms, name)(series) for name in names]
+            self.assertEqual(ensemble, expected)
+        self.assertTrue(any(any(ensemble) for ensemble in ensembles))
+
+    @patch.object(batch, 'time')
+    @patch.object(algorithms, 'time')
+    def test_run_selected_algorithms(self, timeMock, batchTimeMock):
+        now = time()
+        timeMock.return_value = batchTimeMock.return_value = now
+        timeseries = [map(list, zip(np.arange(now - 86400, now + 1, 10.0), [1.0] * 8641)),
+                      map(list, zip(np.arange(now - 86400, now + 1, 10.0), np.arange(8641.0) % 7))]
+        timeseries[0][-1][1] = 1000.0
+
+        results = batch.run_selected_algorithms(timeseries, ['test.spike', 'test.cycle'])
+        self.assertEqual(results, [algorithms.run_selected_algorithm(series, name)
+                                   for series, name in zip(timeseries, ['test.spike', 'test.cycle'])])
+        self.assertTrue(results[0][0])
+        self.assertFalse(results[1][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
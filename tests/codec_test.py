@@ -0,0 +1,105 @@
+import unittest2 as unittest
+import numpy as np
+
+import sys
+from os.path import dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))) + '/src')
+
+from codec import MSGPACK, BINARY, COMPRESSED, RING, STORAGE_RESOLUTION, BLOCK_HEADER, \
+    encode_datapoint, decode_timeseries, decode_array, trim_series, split_series, \
+    merge_series, ring_slots, ring_offset
+
+
+class TestCodec(unittest.TestCase):
+
+    def series(self):
+        return [(1370000000 + i * 10, float(i) / 3) for i in range(300)]
+
+    def encode(self, timeseries, fmt):
+        return ''.join(encode_datapoint(datapoint, fmt) for datapoint in timeseries)
+
+    def test_formats_decode_alike(self):
+        timeseries = self.series()
+        for fmt in [MSGPACK, BINARY, COMPRESSED]:
+            raw = self.encode(timeseries, fmt)
+            self.assertEqual([tuple(d) for d in decode_timeseries(raw, fmt)], timeseries)
+            if fmt != MSGPACK:
+                self.assertIsInstance(decode_timeseries(raw, fmt), np.ndarray)
+            self.assertEqual(decode_array(raw, fmt).tolist(), [list(d) for d in timeseries])
+
+    def test_binary_ignores_partial_record(self):
+        raw = self.encode(self.series(), BINARY)
+        self.assertEqual(len(decode_array(raw[:-3], BINARY)), 299)
+
+    def test_trim_matches_across_formats(self):
+        timeseries = self.series()
+        shuffled = timeseries[100:] + timeseries[:150] + [(timeseries[200][0], 99.0), (timeseries[201][0], -1.0)]
+        cutoff = timeseries[49][0]
+        for fmt in [MSGPACK, BINARY, COMPRESSED]:
+            trimmed = trim_series(self.encode(shuffled, fmt), cutoff, fmt)
+            self.assertEqual([tuple(d) for d in decode_timeseries(trimmed, fmt)], timeseries[50:])
+            self.assertIsNone(trim_series(self.encode(shuffled, fmt), timeseries[-1][0], fmt))
+
+    def test_compressed_blocks(self):
+        timeseries = [(1370000000 + i * 10, float(i % 7)) for i in range(1000)] + \
+            [(1370010000 + i * 2.5, i / 3.0) for i in range(100)]
+        raw = trim_series(self.encode(timeseries, COMPRESSED), 0, COMPRESSED)
+        blocks, tail = split_series(raw)
+        self.assertEqual(len(blocks), 4)
+        self.assertEqual(len(tail), 0)
+        self.assertLess(len(raw), len(self.encode(timeseries, MSGPACK)) / 5)
+
+        # Datapoints appended after sealing, one of them late and one
+        # repeating a timestamp of the first block
+        late = [(1370010500, 1.0), (1370000005, 2.0), (1370000010, 5.0)]
+        raw += self.encode(late, COMPRESSED)
+        expected = sorted(timeseries + late[:2])
+        self.assertEqual(decode_array(raw, COMPRESSED).tolist(), [list(d) for d in expected])
+
+        # Sealing them keeps the blocks in order and drops the repeat
+        resealed = trim_series(raw, 0, COMPRESSED)
+        self.assertEqual(decode_array(resealed, COMPRESSED).tolist(), [list(d) for d in expected])
+        headers = [BLOCK_HEADER.unpack_from(block) for block in split_series(resealed)[0]]
+        self.assertTrue(all(a[4] < b[3] for a, b in zip(headers, headers[1:])))
+
+        # Expired blocks are dropped whole
+        raw = trim_series(raw, 1370005000, COMPRESSED)
+        self.assertEqual(decode_array(raw, COMPRESSED)[0].tolist(), [1370003600, 3600 / 10 % 7])
+
+    def test_merge_keeps_first_stored(self):
+        timeseries = self.series()
+        old = timeseries[:200]
+        new = [(t, -v) for t, v in timeseries[150:]]
+        for fmt in [MSGPACK, BINARY, COMPRESSED]:
+            merged = merge_series(self.encode(old, fmt), self.encode(new, fmt), fmt)
+            trimmed = trim_series(merged, 0, fmt)
+            self.assertEqual([tuple(d) for d in decode_timeseries(trimmed, fmt)], old + new[50:])
+
+    def test_ring_linearizes(self):
+        duration = 100 * STORAGE_RESOLUTION
+        slots = ring_slots(duration)
+        ring = bytearray()
+
+        def write(datapoint):
+            offset = ring_offset(datapoint[0], slots)
+            record = encode_datapoint(datapoint, RING)
+            ring.extend('\0' * max(0, offset + len(record) - len(ring)))
+            ring[offset:offset + len(record)] = record
+
+        # A partly filled ring, then a full lap and a half with a gap and a
+        # datapoint landing on an occupied slot
+        timeseries = [(1370000000 + i * STORAGE_RESOLUTION, float(i)) for i in range(40)]
+        for datapoint in timeseries:
+            write(datapoint)
+        self.assertEqual(decode_timeseries(str(ring), RING, duration).tolist(), [list(d) for d in timeseries])
+
+        timeseries = [(1370000000 + i * STORAGE_RESOLUTION, float(i)) for i in range(150) if i != 140]
+        for datapoint in timeseries + [(1370000001 + 149 * STORAGE_RESOLUTION, -1.0)]:
+            write(datapoint)
+        expected = [list(d) for d in timeseries[-99:-1]] + [[1370000001 + 149 * STORAGE_RESOLUTION, -1.0]]
+        self.assertEqual(decode_timeseries(str(ring), RING, duration).tolist(), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
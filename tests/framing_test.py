@@ -0,0 +1,62 @@
+import unittest2 as unittest
+
+import sys
+from os.path import dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))) + '/src')
+
+from framing import BATCH_HEADER, pack_metric, pack_batch, unpack_frames, jump_hash, worker_for
+
+
+class TestFrames(unittest.TestCase):
+    """
+    Test that datapoints survive the trip from relay to worker
+    """
+
+    def test_round_trip(self):
+        metrics = [('metrics.a', (1370000000, 1.5)), ('metrics.b', (1370000001, -2))]
+        # msgpack hands tuples back as lists
+        expected = [[name, list(datapoint)] for name, datapoint in metrics]
+        self.assertEqual(unpack_frames(pack_metric(metrics[0])), expected[:1])
+        self.assertEqual(pack_batch(metrics)[0], BATCH_HEADER)
+        self.assertEqual(unpack_frames(pack_batch(metrics)), expected)
+        self.assertEqual(unpack_frames(pack_batch([])), [])
+
+    def test_unknown_header(self):
+        with self.assertRaises(ValueError):
+            unpack_frames(['skyline.other', pack_batch([])[1]])
+
+
+class TestRouting(unittest.TestCase):
+    """
+    Test that metric names are routed to workers consistently
+    """
+
+    def test_jump_hash_known_buckets(self):
+        # As given by the C++ implementation in the paper
+        keys = [0, 1, 2, 0xdeadbeef, 0xffffffffffffffff]
+        buckets = [1, 2, 8, 10, 100, 1000]
+        self.assertEqual([[jump_hash(key, n) for n in buckets] for key in keys], [
+            [0, 0, 0, 0, 0, 0],
+            [0, 0, 6, 6, 55, 549],
+            [0, 0, 6, 6, 62, 338],
+            [0, 1, 5, 5, 87, 285],
+            [0, 1, 7, 9, 92, 313],
+        ])
+        names = ['carbon.agents.a', 'metrics.cpu.user', 'stats.requests', '']
+        self.assertEqual([worker_for(name, 8) for name in names], [7, 4, 4, 0])
+
+    def test_adding_a_worker_only_moves_keys_to_it(self):
+        names = ['metrics.%d' % i for i in range(5000)]
+        for workers in range(1, 12):
+            before = [worker_for(name, workers) for name in names]
+            after = [worker_for(name, workers + 1) for name in names]
+            moved = [new for old, new in zip(before, after) if old != new]
+            self.assertEqual(set(moved), set([workers]))
+            # About 1/(workers + 1) of the keys move
+            self.assertAlmostEqual(float(len(moved)) / len(names), 1.0 / (workers + 1), delta=0.03)
+            self.assertEqual(set(after), set(range(workers + 1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
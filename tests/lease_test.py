@@ -0,0 +1,176 @@
+import unittest2 as unittest
+from mock import patch
+from redis import RedisError
+
+import sys
+from os.path import dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))) + '/src')
+
+import lease
+from ring import RedisRing
+from lease import Leases
+from scripts import CLAIM_LEASE, FINISH_LEASE, RELEASE_LEASE
+
+
+def redis_ring():
+    """
+    A RedisRing over a scratch database of a local Redis server, cleared of
+    test leases, or None if there isn't one.
+    """
+    ring = RedisRing(['redis://localhost:6379/15'])
+    try:
+        for conn in ring.connections.values():
+            keys = conn.keys('skyline.lease.test.*')
+            if keys:
+                conn.delete(*keys)
+    except RedisError:
+        return None
+    return ring
+
+
+class FakeRing(object):
+    """
+    Just enough of RedisRing for leases, with the lease scripts played in
+    Python. Keys never expire. Only stands in for a Redis server when there
+    isn't one, as it can't tell whether the Lua scripts still do what it
+    does.
+    """
+    def __init__(self):
+        self.hashes = {}
+        self.scores = {}
+        self.scripts = {
+            CLAIM_LEASE: self.claim,
+            FINISH_LEASE: self.finish,
+            RELEASE_LEASE: self.release,
+        }
+
+    def register_script(self, script):
+        return script
+
+    def run(self, command, *args):
+        return self.run_many([(command,) + args])[0]
+
+    def run_many(self, commands):
+        return [(self.scripts.get(command[0]) or getattr(self, command[0]))(*command[1:])
+                for command in commands]
+
+    def zadd(self, key, score, member):
+        self.scores[member] = score
+
+    def zremrangebyscore(self, key, low, high):
+        for member, score in self.scores.items():
+            if score <= high:
+                del self.scores[member]
+
+    def expire(self, key, ttl):
+        pass
+
+    def zrange(self, key, start, stop):
+        return sorted(self.scores, key=self.scores.get)
+
+    def hget(self, key, field):
+        return self.hashes.get(key, {}).get(field)
+
+    def hmget(self, key, *fields):
+        return [self.hget(key, field) for field in fields]
+
+    def claim(self, key, owner, ttl, now, steal_after):
+        held, done = self.hmget(key, 'owner', 'done')
+        if held != owner:
+            if held and (steal_after == '' or float(now) - float(done or 0) < float(steal_after)):
+                return 0
+            self.hashes[key] = {'owner': owner, 'done': now}
+        return 1
+
+    def finish(self, key, owner, ttl, now, steal_after):
+        if self.hget(key, 'owner') != owner:
+            return 0
+        self.hashes[key]['done'] = now
+        return 1
+
+    def release(self, key, owner, ttl, now, steal_after):
+        if self.hget(key, 'owner') != owner:
+            return 0
+        del self.hashes[key]
+        return 1
+
+
+class TestLeases(unittest.TestCase):
+
+    def setUp(self):
+        self.leases = Leases(RedisRing(['redis://10.0.0.1:6379']), 'test', 'host:1')
+
+    def test_partition(self):
+        partitions = [self.leases.partition('metrics.%d' % i) for i in range(10000)]
+        self.assertEqual(self.leases.partition('metrics.a'), self.leases.partition('metrics.a'))
+        self.assertEqual(min(partitions), 0)
+        self.assertEqual(max(partitions), self.leases.partitions - 1)
+
+    def test_joining_member_only_takes_its_share(self):
+        members = ['host:%d' % i for i in range(1, 5)]
+        before = [self.leases.preferred(p, members) for p in range(self.leases.partitions)]
+        after = [self.leases.preferred(p, members + ['other:1']) for p in range(self.leases.partitions)]
+        moved = [(old, new) for old, new in zip(before, after) if old != new]
+        self.assertTrue(all(new == 'other:1' for old, new in moved))
+        self.assertGreater(len(moved), 0)
+        self.assertLess(len(moved), self.leases.partitions / 3)
+        self.assertEqual(set(before), set(members))
+
+    def share(self, owner, members):
+        return [p for p in range(self.leases.partitions) if self.leases.preferred(p, members) == owner]
+
+    @patch.object(lease, 'time')
+    def test_acquire_releases_surplus(self, timeMock):
+        timeMock.return_value = 1000.0
+        ring = redis_ring() or FakeRing()
+        a = Leases(ring, 'test', 'host:1')
+        b = Leases(ring, 'test', 'host:2')
+
+        # Alone, a member holds every partition
+        self.assertEqual(a.acquire(), range(a.partitions))
+
+        # One joining can't take its share until the holder gives it up
+        self.assertEqual(b.acquire(), [])
+        mine = self.share('host:1', ['host:1', 'host:2'])
+        self.assertEqual(a.acquire(), mine)
+        surplus = sorted(set(range(a.partitions)) - set(mine))
+        self.assertEqual([ring.run('hget', a.keys[p], 'owner') for p in surplus], [None] * len(surplus))
+        self.assertEqual(b.acquire(), surplus)
+
+    @patch.object(lease, 'time')
+    def test_steal_and_reclaim(self, timeMock):
+        timeMock.return_value = 1000.0
+        ring = redis_ring() or FakeRing()
+        a = Leases(ring, 'test', 'host:1')
+        b = Leases(ring, 'test', 'host:2')
+        a.acquire()
+        b.acquire()
+        held_a = a.acquire()
+        held_b = b.acquire()
+        self.assertEqual(a.finish(held_a), held_a)
+        self.assertEqual(b.finish(held_b), held_b)
+
+        # Nothing is stale yet, and a partition nobody holds isn't stolen
+        b.release(held_b[:1])
+        timeMock.return_value += a.steal_after - 1
+        self.assertEqual(a.steal(), [])
+
+        # Both fell behind, but a only steals from b
+        timeMock.return_value += 1
+        stolen = a.steal()
+        self.assertEqual(stolen, held_b[1:])
+
+        # b finds out it lost them when it renews or finishes
+        self.assertEqual(b.renew(stolen), [])
+        self.assertEqual(b.finish(stolen), [])
+
+        # Once a gives them back, b takes its share again
+        a.release(stolen)
+        self.assertEqual([ring.run('hget', a.keys[p], 'owner') for p in stolen], [None] * len(stolen))
+        self.assertEqual(b.acquire(), held_b)
+        self.assertEqual(a.acquire(), held_a)
+
+
+if __name__ == '__main__':
+    unittest.main()
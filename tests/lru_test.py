@@ -0,0 +1,55 @@
+import unittest2 as unittest
+
+import sys
+from os.path import dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))) + '/src')
+
+from lru import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_get_and_set(self):
+        cache = LRUCache(10)
+        cache['a'] = 1
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('b', 2), 2)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+
+    def test_bounded(self):
+        cache = LRUCache(10)
+        for i in range(1000):
+            cache[i] = i
+            self.assertTrue(len(cache) <= 10)
+        self.assertEqual(cache.get(999), 999)
+        self.assertEqual(cache.get(0), None)
+
+    def test_recently_used_survive(self):
+        cache = LRUCache(10)
+        cache['hot'] = True
+        for i in range(100):
+            cache[i] = i
+            self.assertTrue(cache.get('hot'))
+
+    def test_overwrite(self):
+        cache = LRUCache(4)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['c'] = 3
+        cache['a'] = 4
+        self.assertEqual(cache.get('a'), 4)
+        self.assertEqual(len(cache), 3)
+
+    def test_clear(self):
+        cache = LRUCache(4)
+        cache['a'] = 1
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertFalse('a' in cache)
+
+
+if __name__ == '__main__':
+    unittest.main()
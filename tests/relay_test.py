@@ -0,0 +1,208 @@
+import unittest2 as unittest
+from errno import EAGAIN, ECONNABORTED, EHOSTUNREACH, EMFILE
+from mock import Mock
+from cPickle import dumps
+from msgpack import packb
+from os import getpid, listdir
+from os.path import join
+from shutil import rmtree
+from struct import pack
+from tempfile import mkdtemp
+from threading import Thread, Event
+from time import time, sleep
+import socket
+import zmq
+
+import sys
+from os.path import dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))) + '/src')
+sys.path.insert(0, dirname(dirname(abspath(__file__))) + '/src/relay')
+
+import relay
+from framing import pack_batch, unpack_frames
+from unpickler import decode_pickle
+
+
+class TestRelay(unittest.TestCase):
+    """
+    Test that the relay only passes on well formed datapoints
+    """
+
+    def test_unpack_datagram(self):
+        data = packb('abc') + packb(('metric', (1, 2.0))) + packb(5) + packb(('me{tric}', (1, 2))) + \
+            packb(((1, (1, 2)), ('metric.inf', (float('inf'), 1)), ('other', (1, 2))))
+        self.assertEqual(relay.unpack_datagram(data), ([('metric', (1, 2.0)), ('other', (1, 2))], 5))
+
+    def test_unpack_datagram_prefix(self):
+        data = packb(('key.metric', (1, 2.0))) + packb(('metric', (1, 2))) + packb((('key.', 1),))
+        self.assertEqual(relay.unpack_datagram(data, 'key.'), ([('metric', (1, 2.0))], 1))
+
+    def test_parse_lines(self):
+        data = 'metric 1 2\nmetric nan 3\nmetric 1 inf\nmetric x 1\nshort 1\nmetric} 1 2\n'
+        self.assertEqual(relay.parse_lines(data), ([('metric', (2.0, 1.0))], 5))
+
+    def test_decode_pickle(self):
+        frame = dumps([('metric', (1, 2)), 'abc', (u'unicode', (1, 2)), ('text', (1, '2')), ('nan', (1, float('nan')))], 2)
+        self.assertEqual(decode_pickle(frame), ([('metric', (1, 2))], 4))
+        self.assertEqual(decode_pickle(frame, 'met'), ([('ric', (1, 2))], 4))
+        with self.assertRaises(Exception):
+            decode_pickle(dumps([('metric', (1, set([2])))], 2))
+
+    def test_pickle_connection_feed(self):
+        def frame(metrics):
+            data = dumps(metrics, 2)
+            return pack('!I', len(data)) + data
+
+        conn = relay.PickleConnection(None, ('127.0.0.1', 1), 1024)
+        first = [('metric.a', (1, 2.0)), ('metric.b', (1, 3))]
+        second = [('metric.c', (2, 4.0))]
+        self.assertEqual(conn.feed(frame(first)), first)
+
+        # A frame split across two reads, after a whole one
+        data = frame(second) + frame(first)
+        self.assertEqual(conn.feed(data[:-10]), second)
+        self.assertEqual(conn.feed(data[-10:]), first)
+        self.assertEqual((conn.frames, conn.datapoints, conn.dropped), (3, 5, 0))
+
+        # What the relay decodes comes out of a worker the same
+        metrics = first + second
+        self.assertEqual(unpack_frames(pack_batch(metrics)), [[name, list(datapoint)] for name, datapoint in metrics])
+
+        # A frame over the limit is refused before it is buffered whole
+        with self.assertRaises(ValueError):
+            conn.feed(pack('!I', 1025) + 'x' * 10)
+
+    def test_line_connection_feed(self):
+        conn = relay.LineConnection(None, ('127.0.0.1', 1), 64)
+        self.assertEqual(conn.feed('metric.a 1 10\nmetric.b 2'), [('metric.a', (10.0, 1.0))])
+
+        # A line spread over several reads is parsed once its newline arrives
+        self.assertEqual(conn.feed(' 1'), [])
+        self.assertEqual(conn.feed('0'), [])
+        self.assertEqual(conn.feed('\nmetric.c 3 10\n'), [('metric.b', (10.0, 2.0)), ('metric.c', (10.0, 3.0))])
+        self.assertEqual(conn.feed(''), [])
+        self.assertEqual((conn.frames, conn.datapoints, conn.dropped), (3, 3, 0))
+
+        # A line that never ends is dropped with the connection
+        conn.feed('x' * 40)
+        with self.assertRaises(ValueError):
+            conn.feed('x' * 40)
+
+    def test_spill_queue_resumes_after_delivered(self):
+        path = mkdtemp()
+        try:
+            queue = relay.SpillQueue(path, 4096, 16384)
+            for i in range(3):
+                queue.put(None, ['frame %d' % i], 1)
+            queue.peek()
+            queue.commit()
+
+            # A restarted relay only replays what wasn't delivered
+            open(join(path, '99999999999999999999.spill'), 'w').close()
+            queue = relay.SpillQueue(path, 4096, 16384)
+            self.assertEqual(queue.pending, 2)
+            self.assertEqual(queue.peek(), (None, ['frame 1'], 1))
+            self.assertFalse('99999999999999999999.spill' in listdir(path))
+        finally:
+            rmtree(path)
+
+    def test_spill_keeps_messages_for_absent_workers(self):
+        path = mkdtemp()
+        try:
+            listener = relay.Relay(getpid())
+            listener.spill = relay.SpillQueue(path, 4096, 16384)
+            listener.publisher = Mock()
+            listener.publisher.send_multipart.side_effect = zmq.ZMQError(EHOSTUNREACH)
+
+            # The worker is gone, its messages wait on disk
+            listener.send('worker', ['frame'], 1)
+            listener.replay()
+            self.assertEqual(listener.spill.pending, 1)
+            self.assertEqual(listener.undeliverable, 0)
+
+            # And go out once it is back
+            listener.publisher.send_multipart.side_effect = None
+            listener.replay()
+            self.assertEqual(listener.spill.pending, 0)
+            listener.publisher.send_multipart.assert_called_with(['worker', 'frame'], zmq.NOBLOCK)
+        finally:
+            rmtree(path)
+
+    def test_accept_survives_errors(self):
+        listener = relay.Relay(getpid())
+        server = Mock()
+        server.fileno.return_value = 3
+        poller = Mock()
+        connections = {}
+
+        # An aborted connection is skipped, the next one is still accepted
+        client = Mock()
+        client.fileno.return_value = 4
+        server.accept.side_effect = [socket.error(ECONNABORTED, 'aborted'), (client, ('10.0.0.1', 1000)),
+                                     socket.error(EAGAIN, 'again')]
+        listener.accept(server, poller, connections, relay.LineConnection)
+        self.assertEqual(connections.keys(), [4])
+        poller.register.assert_called_once_with(4)
+
+        # Out of file descriptors, the listener is left out for a while
+        server.accept.side_effect = [socket.error(EMFILE, 'too many open files')]
+        listener.accept(server, poller, connections, relay.LineConnection)
+        poller.unregister.assert_called_once_with(3)
+        self.assertIsNotNone(listener.accept_paused)
+        self.assertEqual(listener.accept_errors, 2)
+
+    def test_listen_udp_survives_bad_datagrams(self):
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+
+        listener = relay.Relay(getpid())
+        listener.ip = '127.0.0.1'
+        listener.port = port
+        published = []
+
+        def publish(metric):
+            # A routing error, as a bad name used to cause
+            if metric[0] == 'boom':
+                raise TypeError('unroutable')
+            published.append(metric)
+        listener.publish = publish
+
+        bound = Event()
+        listen_socket = listener.listen_socket
+
+        def listen(kind):
+            sock = listen_socket(kind)
+            bound.set()
+            return sock
+        listener.listen_socket = listen
+
+        thread = Thread(target=listener.listen_udp)
+        thread.daemon = True
+        thread.start()
+        self.assertTrue(bound.wait(5))
+
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for data in ['\xc1\xc1', packb(('metric', (1, 2)))[:-3], dumps([('metric', (1, 2))]),
+                     dumps([('metric', (1, 2))], 2), packb(('boom', (1, 2))), packb(('metric', (1, 2)))]:
+            sender.sendto(data, ('127.0.0.1', port))
+
+        deadline = time() + 5
+        while not published and time() < deadline:
+            sleep(0.01)
+        self.assertTrue(thread.is_alive())
+        self.assertEqual(published, [('metric', (1, 2))])
+
+        # Wake the listener up to stop it
+        def stop():
+            raise SystemExit
+        listener.check_if_parent_is_alive = stop
+        sender.sendto(packb(('metric', (1, 2))), ('127.0.0.1', port))
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+import unittest2 as unittest
+from redis import ConnectionError, ResponseError
+
+import sys
+from os.path import dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))) + '/src')
+
+from ring import ConsistentHash, RedisRing, OPEN
+from codec import BINARY, COMPRESSED, RING, hash_tag, storage_key
+
+
+class FakeConnection(object):
+    """
+    A backend holding keys in a dict, that either works, answers every
+    command with an error, or can't be reached at all.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.data = {}
+        self.errors = False
+        self.down = False
+
+    def mget(self, keys):
+        if self.down:
+            raise ConnectionError('%s is down' % self.name)
+        return [self.data.get(key) for key in keys]
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.commands.append((name,) + args)
+
+    def execute(self, raise_on_error=True):
+        if self.conn.down:
+            raise ConnectionError('%s is down' % self.conn.name)
+        results = []
+        for command in self.commands:
+            if self.conn.errors:
+                results.append(ResponseError('%s failed' % self.conn.name))
+            elif command[0] == 'set':
+                self.conn.data[command[1]] = command[2]
+                results.append(True)
+            else:
+                results.append(self.conn.data.get(command[1]))
+        if raise_on_error and self.conn.errors and results:
+            raise results[0]
+        return results
+
+
+class TestRing(unittest.TestCase):
+
+    backends = ['redis://10.0.0.%d:6379' % i for i in range(1, 6)]
+
+    def test_hash_tags(self):
+        ring = ConsistentHash(self.backends)
+        keys = ['metrics.a.b.%d' % i for i in range(200)]
+        for key in keys:
+            self.assertEqual(ring.nodes('b:{%s}' % key), ring.nodes(key))
+            self.assertEqual(ring.nodes('x{%s}y{z}' % key), ring.nodes(key))
+            for fmt in [BINARY, COMPRESSED, RING]:
+                self.assertEqual(ring.nodes(storage_key(key, fmt)), ring.nodes(key))
+            self.assertEqual(ring.nodes('last_alert.smtp.' + hash_tag(key)), ring.nodes(key))
+        self.assertNotEqual(len(set(ring.nodes(key)[0] for key in keys)), 1)
+        self.assertEqual(ring.nodes('a{}b'), ring.nodes('a{}b'))
+
+    def test_weights(self):
+        ring = ConsistentHash(self.backends, {self.backends[0]: 3})
+        owners = [ring.nodes('metrics.%d' % i)[0] for i in range(7000)]
+        self.assertGreater(owners.count(self.backends[0]), 2 * owners.count(self.backends[1]))
+
+    def test_replicas_follow_membership(self):
+        ring = RedisRing(self.backends)
+        ring.replication = 2
+        key = 'metrics.some.metric'
+        preference = ring.hash.nodes(key)
+        conns = ring.get_connections(key)
+        self.assertEqual(conns, [ring.connections[backend] for backend in preference[:2]])
+        self.assertIs(ring.get_connections(key), conns)
+
+        # Taking a replica out moves its keys to the next backend on the ring
+        ring.health[preference[0]]['state'] = OPEN
+        ring._build()
+        self.assertEqual(ring.get_connections(key),
+                         [ring.connections[backend] for backend in preference[1:3]])
+
+    def fake_ring(self, replication):
+        ring = RedisRing(self.backends[:2])
+        ring.replication = replication
+        ring.connections = dict((backend, FakeConnection(backend)) for backend in ring.backends)
+        ring._build()
+        a, b = [ring.connections[backend] for backend in ring.backends]
+
+        # Keys owned by one backend are spread between those of the other
+        keys = ['metrics.%d' % i for i in range(40)]
+        owners = [ring.hash.nodes(key)[0] for key in keys]
+        self.assertNotEqual(owners, sorted(owners))
+        for key in keys:
+            for conn in ring.connections.values():
+                conn.data[key] = '%s %s' % (conn.name, key)
+        return ring, a, b, keys, [ring.connections[owner] for owner in owners]
+
+    def test_scatter_keeps_order(self):
+        ring, a, b, keys, owners = self.fake_ring(1)
+        self.assertEqual(ring.mget(keys), ['%s %s' % (owner.name, key) for key, owner in zip(keys, owners)])
+
+        # Reads and writes mixed, each answered by the backend owning its key
+        commands = []
+        for i, key in enumerate(keys):
+            commands.append(('set', key, i) if i % 3 else ('get', key))
+        results = ring.run_many(commands)
+        self.assertEqual(results, [True if i % 3 else '%s %s' % (owner.name, key)
+                                   for i, (key, owner) in enumerate(zip(keys, owners))])
+        self.assertEqual([owner.data[key] for key, owner in zip(keys, owners)],
+                         [i if i % 3 else '%s %s' % (owner.name, key)
+                          for i, (key, owner) in enumerate(zip(keys, owners))])
+
+        # A backend that fails fails the whole call
+        b.down = True
+        with self.assertRaises(ConnectionError):
+            ring.mget(keys)
+        b.down = False
+        b.errors = True
+        with self.assertRaises(ResponseError):
+            ring.run_many(commands)
+
+    def test_scatter_replicas(self):
+        ring, a, b, keys, owners = self.fake_ring(2)
+        b.errors = True
+        results = ring.run_many([('set', key, i) for i, key in enumerate(keys)], replicas=True)
+        self.assertEqual(len(results), len(keys))
+        for i, (key, result) in enumerate(zip(keys, results)):
+            replies = dict(result)
+            self.assertEqual(sorted(replies), sorted([a, b]))
+            self.assertIs(replies[a], True)
+            self.assertIsInstance(replies[b], ResponseError)
+            self.assertEqual(a.data[key], i)
+            self.assertEqual(b.data[key], '%s %s' % (b.name, key))
+
+        # Without replicas, a write returns its first replica's result
+        b.errors = False
+        self.assertEqual(ring.run_many([('set', key, 0) for key in keys]), [True] * len(keys))
+        self.assertEqual(set(b.data[key] for key in keys), set([0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
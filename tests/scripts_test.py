@@ -0,0 +1,146 @@
+import unittest2 as unittest
+from redis import StrictRedis, RedisError
+
+import sys
+from os.path import dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))) + '/src')
+
+from codec import MSGPACK, BINARY, COMPRESSED, RING, STORAGE_RESOLUTION, BLOCK_HEADER, \
+    encode_datapoint, decode_timeseries, decode_array, trim_series, split_series, \
+    ring_slots, ring_offset
+from scripts import TRIM_SERIES
+
+
+def redis_server():
+    """
+    A connection to a scratch database of a local Redis server, or None if
+    there isn't one.
+    """
+    conn = StrictRedis(db=15, socket_timeout=5)
+    try:
+        conn.ping()
+    except RedisError:
+        return None
+    return conn
+
+
+class TestTrimSeries(unittest.TestCase):
+    """
+    Test that the trim script agrees with codec.trim_series
+    """
+
+    key = 'skyline.test.trim'
+
+    def setUp(self):
+        self.conn = redis_server()
+        if self.conn is None:
+            self.skipTest('no Redis server')
+        self.trim_script = self.conn.register_script(TRIM_SERIES)
+
+    def tearDown(self):
+        self.conn.delete(self.key)
+
+    def series(self, length):
+        return [(1370000000 + i * 10, float(i) / 3) for i in range(length)]
+
+    def encode(self, timeseries, fmt):
+        return ''.join(encode_datapoint(datapoint, fmt) for datapoint in timeseries)
+
+    def trim(self, raw, cutoff, fmt):
+        """
+        Run the trim script over raw, and return its reply and what it left
+        stored.
+        """
+        self.conn.set(self.key, raw)
+        reply = self.trim_script(keys=[self.key], args=[fmt, repr(cutoff)])
+        return reply, self.conn.get(self.key)
+
+    def check(self, raw, cutoffs, fmt):
+        for cutoff in cutoffs:
+            reply, stored = self.trim(raw, cutoff, fmt)
+            expected = trim_series(raw, cutoff, fmt)
+            if expected is None:
+                self.assertEqual(reply, ['dead', 0])
+                continue
+
+            self.assertEqual(reply[0], 'trimmed')
+            if fmt == BINARY:
+                self.assertEqual(stored, expected)
+            elif fmt == MSGPACK:
+                self.assertEqual(decode_timeseries(stored, fmt), decode_timeseries(expected, fmt))
+
+            if fmt == COMPRESSED:
+                # Blocks are only trimmed whole, and the script doesn't seal
+                # the tail
+                blocks, tail = split_series(stored)
+                self.assertEqual(reply[1], len(tail))
+                series = decode_array(stored, fmt)
+                trimmed = decode_array(expected, fmt)
+                self.assertEqual(series[series[:, 0] > cutoff].tolist(),
+                                 trimmed[trimmed[:, 0] > cutoff].tolist())
+                lasts = [BLOCK_HEADER.unpack_from(block)[4] for block in blocks]
+                self.assertEqual(float(reply[2]), min(lasts + tail[:, 0].tolist()))
+            else:
+                series = decode_array(expected, fmt)
+                self.assertEqual(reply[1], len(series))
+                self.assertEqual(float(reply[2]), series[0, 0])
+
+    def test_binary_and_msgpack(self):
+        timeseries = self.series(300)
+        cutoffs = [0, timeseries[49][0], timeseries[49][0] + 5, timeseries[-1][0]]
+        shuffled = timeseries[100:] + timeseries[:150] + [(timeseries[200][0], 99.0), (timeseries[201][0], -1.0)]
+        for fmt in [BINARY, MSGPACK]:
+            self.check(self.encode(timeseries, fmt), cutoffs, fmt)
+            self.check(self.encode(shuffled, fmt), cutoffs, fmt)
+            # A partial datapoint at the end is dropped
+            self.check(self.encode(timeseries, fmt)[:-3], cutoffs, fmt)
+
+    def test_compressed(self):
+        timeseries = self.series(1000)
+        sealed = trim_series(self.encode(timeseries, COMPRESSED), 0, COMPRESSED)
+        self.assertEqual(len(split_series(sealed)[0]), 3)
+        cutoffs = [0, timeseries[100][0], timeseries[400][0], timeseries[900][0], timeseries[999][0]]
+
+        # A tail that hasn't been sealed yet, then one after sealed blocks
+        # with late, repeated and partial datapoints
+        shuffled = self.series(1100)[1000:] + [(timeseries[500][0] + 5, 1.0), (timeseries[950][0], 2.0)]
+        self.check(self.encode(timeseries, COMPRESSED), cutoffs, COMPRESSED)
+        self.check(sealed, cutoffs, COMPRESSED)
+        self.check(sealed + self.encode(shuffled, COMPRESSED), cutoffs, COMPRESSED)
+        self.check(sealed + self.encode(shuffled, COMPRESSED)[:-3], cutoffs, COMPRESSED)
+
+        # Expired blocks are cut out from under the header
+        reply, stored = self.trim(sealed + self.encode(shuffled, COMPRESSED), timeseries[400][0], COMPRESSED)
+        blocks, tail = split_series(stored)
+        self.assertEqual(len(blocks), 2)
+        self.assertEqual(len(tail), len(shuffled))
+        reply, stored = self.trim(sealed + self.encode(shuffled, COMPRESSED), timeseries[999][0], COMPRESSED)
+        blocks, tail = split_series(stored)
+        self.assertEqual(blocks, [])
+        self.assertEqual(tail[:, 0].tolist(), sorted(set(t for t, v in shuffled if t > timeseries[999][0])))
+
+    def test_ring(self):
+        duration = 100 * STORAGE_RESOLUTION
+        slots = ring_slots(duration)
+        ring = bytearray(slots * len(encode_datapoint((0, 0), RING)))
+        timeseries = [(1370000000 + i * STORAGE_RESOLUTION, float(i)) for i in range(150)]
+        for datapoint in timeseries:
+            offset = ring_offset(datapoint[0], slots)
+            record = encode_datapoint(datapoint, RING)
+            ring[offset:offset + len(record)] = record
+        raw = str(ring)
+
+        # Rings are never rewritten, only found dead
+        for cutoff in [0, timeseries[100][0], timeseries[-1][0]]:
+            reply, stored = self.trim(raw, cutoff, RING)
+            self.assertEqual(stored, raw)
+            if cutoff >= timeseries[-1][0]:
+                self.assertEqual(reply, ['dead', 0])
+            else:
+                self.assertEqual(reply[0], 'trimmed')
+                self.assertGreater(float(reply[2]), cutoff)
+
+
+if __name__ == '__main__':
+    unittest.main()
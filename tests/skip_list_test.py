@@ -0,0 +1,47 @@
+import unittest2 as unittest
+import random
+
+import sys
+from os.path import dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))) + '/src')
+
+from skip_list import SkipList
+
+
+class TestSkipList(unittest.TestCase):
+
+    def naive(self, entries, metric_name):
+        for to_skip in entries:
+            if to_skip in metric_name:
+                return True
+        return False
+
+    def test_substring_semantics(self):
+        entries = ['example.statsd.metric', '_90', '.lower', '.count_ps', '.sum']
+        skip_list = SkipList(entries)
+        for metric_name in ['example.statsd.metric', 'a.example.statsd.metric.b',
+                            'timer_90', 'timer.lower', 'timer.lowerish',
+                            'counter.count', 'summary', 'a.sum', 'a.b.c', '']:
+            self.assertEqual(metric_name in skip_list, self.naive(entries, metric_name), metric_name)
+
+    def test_matches_naive_check(self):
+        rand = random.Random(42)
+        parts = ['a', 'b', 'ab', 'ba', '.', '_', 'stats', 'x.y', '(', '*', '[']
+        for trial in range(50):
+            entries = [''.join(rand.choice(parts) for i in range(rand.randint(1, 4)))
+                       for j in range(rand.randint(1, 20))]
+            skip_list = SkipList(entries)
+            for i in range(100):
+                metric_name = ''.join(rand.choice(parts) for k in range(rand.randint(0, 8)))
+                self.assertEqual(metric_name in skip_list, self.naive(entries, metric_name))
+                # Again, from the cache
+                self.assertEqual(metric_name in skip_list, self.naive(entries, metric_name))
+
+    def test_empty(self):
+        self.assertFalse('anything' in SkipList([]))
+        self.assertTrue('anything' in SkipList(['']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest2 as unittest
+from mock import patch
+from time import time
+import numpy as np
+
+import sys
+from os.path import dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))) + '/src')
+sys.path.insert(0, dirname(dirname(abspath(__file__))) + '/src/analyzer')
+
+import algorithms
+import batch
+import streaming
+import worker
+
+
+class TestStreaming(unittest.TestCase):
+    """
+    Test that running statistics follow a series as it moves along
+    """
+
+    def data(self, ts):
+        """
+        A day and a half of noisy datapoints every 10 seconds, up to ts
+        """
+        rng = np.random.RandomState(7)
+        length = 12960
+        values = rng.normal(1000, 20, length)
+        values[rng.randint(length, size=20)] += 400
+        return np.column_stack([ts - length * 10 + np.arange(1, length + 1) * 10.0, values])
+
+    def fresh(self, series):
+        return streaming.summarize([streaming.moments(series[start:start + 100])
+                                    for start in xrange(0, len(series), 100)])
+
+    def test_update(self):
+        stream = self.data(time())
+        state = streaming.SeriesState('test.metric')
+        for end in xrange(8640, len(stream), 97):
+            # The Roomba trims whatever expired, a few datapoints at a time
+            series = stream[end - 8640 + end % 7:end]
+            state.update(series)
+            self.assertFalse(streaming.drifted(state.total, self.fresh(series), 1e-9))
+        self.assertTrue(len(state.runs) > 20)
+
+        # A datapoint that came in late throws the count off
+        series = np.insert(stream[-8640:], 5000, [stream[-3640, 0] - 5, 0], axis=0)
+        state.update(series)
+        self.assertFalse(streaming.drifted(state.total, self.fresh(series), 1e-9))
+
+    def test_verify(self):
+        stream = self.data(time())
+        state = streaming.SeriesState('test.metric')
+        state.update(stream[:8640])
+        self.assertFalse(state.verify(stream[:8640]))
+
+        # A datapoint rewritten in place goes unnoticed until it is checked
+        series = stream[5:8645].copy()
+        series[4000, 1] += 500
+        state.update(series)
+        self.assertTrue(streaming.drifted(state.total, self.fresh(series)))
+        self.assertTrue(state.verify(series))
+        self.assertFalse(streaming.drifted(state.total, self.fresh(series)))
+
+    @patch.object(batch, 'time')
+    @patch.object(algorithms, 'time')
+    def test_run_algorithms(self, timeMock, batchTimeMock):
+        now = time()
+        timeMock.return_value = batchTimeMock.return_value = now
+        stream = self.data(now)
+        stream[-2:, 1] = [1000, 1600]
+        timeseries = [stream[-8640:].tolist(), stream[-8642:-2].tolist()]
+        states = [streaming.SeriesState('test.spike'), streaming.SeriesState('test.flat')]
+        batch.run_algorithms([stream[-8660:-20].tolist(), stream[-8662:-22].tolist()],
+                             ['grubbs'], states)
+
+        names = sorted(streaming.STREAMING_ALGORITHMS)
+        ensembles = batch.run_algorithms(timeseries, names, states)
+        for series, ensemble in zip(timeseries, ensembles):
+            self.assertEqual(ensemble, [getattr(algorithms, name)(series) for name in names])
+        self.assertTrue(all(ensembles[0]))
+        self.assertFalse(any(ensembles[1]))
+
+    @patch.object(worker.settings, 'ANALYZER_INCREMENTAL', True, create=True)
+    def test_worker_forgets_states(self):
+        analyzer = worker.Worker(0, 1, None, None)
+        analyzer.states = {'test.gone': streaming.SeriesState('test.gone')}
+        # Even with nothing left to analyze
+        analyzer.analyze([])
+        self.assertEqual(analyzer.states, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
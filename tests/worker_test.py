@@ -0,0 +1,98 @@
+import unittest2 as unittest
+from imp import load_source
+from mock import Mock
+from redis import ConnectionError
+
+import sys
+from os.path import dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))) + '/src')
+sys.path.insert(0, dirname(dirname(abspath(__file__))) + '/src/horizon')
+
+# The analyzer has a worker module too, so load this one under its own name
+Worker = load_source('horizon_worker', dirname(dirname(abspath(__file__))) + '/src/horizon/worker.py').Worker
+
+
+class FakePipeline(object):
+    """
+    Records the commands sent through it, and hands them to its connection
+    when executed.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.commands.append((name,) + args)
+
+    def execute(self, raise_on_error=True):
+        if self.conn.failures:
+            self.conn.failures -= 1
+            raise ConnectionError('backend went away')
+        self.conn.written.extend(self.commands)
+        return [True] * len(self.commands)
+
+
+class FakeConnection(object):
+    """
+    A backend whose next failures pipelines fail.
+    """
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.written = []
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class TestWorkerFlush(unittest.TestCase):
+    """
+    Test that a failed flush is only retried on the backend it failed on
+    """
+
+    def setUp(self):
+        self.worker = Worker(0, None)
+        self.worker.ring = Mock()
+        self.a = FakeConnection(failures=1)
+        self.b = FakeConnection()
+        self.worker.ring.get_connections.return_value = [self.a, self.b]
+
+    def test_retry_only_failed_backend(self):
+        self.worker.queue('sadd', 'unique_metrics', 'metrics.a')
+        self.worker.append('metrics.a', 'x')
+        self.worker.append('metrics.a', 'y')
+        commands = [('sadd', 'unique_metrics', 'metrics.a'), ('append', 'metrics.a', 'xy')]
+
+        self.worker.flush()
+        self.assertEqual(self.a.written, [])
+        self.assertEqual(self.b.written, commands)
+        self.assertEqual(self.worker.pending.keys(), [self.a])
+        self.assertIsNotNone(self.worker.oldest_pending)
+
+        # The retry goes to a alone, so b isn't written twice
+        self.worker.flush()
+        self.assertEqual(self.a.written, commands)
+        self.assertEqual(self.b.written, commands)
+        self.assertEqual(self.worker.pending, {})
+        self.assertIsNone(self.worker.oldest_pending)
+
+    def test_drop_after_retries(self):
+        self.a.failures = self.worker.flush_retries
+        self.worker.queue('setrange', 'ring:{metrics.a}', 8, 'x')
+        for attempt in range(self.worker.flush_retries - 1):
+            self.worker.flush()
+            self.assertEqual(self.worker.pending.keys(), [self.a])
+            self.assertEqual([command[3] for command in self.worker.pending[self.a]], [attempt + 1])
+
+        self.worker.flush()
+        self.assertEqual(self.worker.pending, {})
+        self.assertEqual(self.a.written, [])
+        self.assertEqual(self.b.written, [('setrange', 'ring:{metrics.a}', 8, 'x')])
+
+        # Nothing is left to retry once a is back
+        self.worker.flush()
+        self.assertEqual(self.a.written, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
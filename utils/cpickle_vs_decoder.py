@@ -0,0 +1,44 @@
+import sys
+import timeit
+import cPickle
+from os.path import dirname, join, realpath
+
+sys.path.insert(0, join(dirname(realpath(__file__)), '..', 'src', 'relay'))
+from unpickler import decode_pickle
+
+"""
+The relay used to cPickle.loads every frame and then rewrite each datapoint
+with a method call. decode_pickle refuses globals and strips the ACCESS_KEY
+prefix in the same pass over the frame.
+"""
+
+key = 'team'
+prefix = key + '.'
+frame = cPickle.dumps(
+    [('team.host%d.cpu.user' % i, (1370000000 + i, float(i))) for i in range(500)],
+    protocol=2)
+
+
+def white_list_rewrite(metric):
+    if not metric[0].startswith(prefix):
+        return None
+    return (metric[0][len(prefix):], metric[1])
+
+
+def cpickle_decode():
+    metrics = [white_list_rewrite(metric) for metric in cPickle.loads(frame)]
+    metrics = [metric for metric in metrics if metric]
+
+
+def decoder_decode():
+    metrics = decode_pickle(frame, prefix)
+
+
+def decoder_decode_no_key():
+    metrics = decode_pickle(frame)
+
+
+if __name__ == '__main__':
+    print("cPickle: " + str(timeit.timeit("cpickle_decode()", setup="from __main__ import cpickle_decode", number=3000)))
+    print("Decoder: " + str(timeit.timeit("decoder_decode()", setup="from __main__ import decoder_decode", number=3000)))
+    print("Decoder, no ACCESS_KEY: " + str(timeit.timeit("decoder_decode_no_key()", setup="from __main__ import decoder_decode_no_key", number=3000)))
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+"""
+Move keys to the backends that own them after REDIS_BACKENDS, REDIS_WEIGHTS
+or REDIS_REPLICATION changed.
+
+Deploy the new settings first, so that new datapoints go to the new owners,
+then run this with the backends as they were before. Every key is copied from
+the backend that used to own it to each of its new owners that didn't hold it,
+with pipelined DUMP and RESTORE, while ingest carries on. Keys the workers
+have written to on a new owner since are merged: sets and sorted sets are
+unioned, and series are merged with what was written since.
+
+    python utils/rebalance.py --old unix:///tmp/redis.sock,redis://10.0.0.1:6379
+
+Keys stay on the backends they are moved from unless --delete is given.
+"""
+
+import sys
+from collections import defaultdict
+from optparse import OptionParser
+from os.path import dirname, abspath
+
+from redis import WatchError, ResponseError
+
+# add the shared settings file to namespace
+sys.path.insert(0, ''.join((dirname(dirname(abspath(__file__))), "/src")))
+import settings
+from ring import RedisRing, ConsistentHash
+from codec import series_format, merge_series
+
+TEMP_PREFIX = 'skyline.rebalance:'
+
+
+def merge(conn, key, kind, dumped):
+    """
+    Merge a moved key into the copy a worker has written since.
+    """
+    temp = TEMP_PREFIX + key
+    conn.delete(temp)
+    conn.restore(temp, 0, dumped)
+    try:
+        if kind == 'set':
+            conn.sunionstore(key, [key, temp])
+        elif kind == 'zset':
+            conn.zunionstore(key, [key, temp], aggregate='MAX')
+        elif kind == 'string' and series_format(key):
+            fmt = series_format(key)
+            pipe = conn.pipeline()
+            while 1:
+                try:
+                    pipe.watch(key)
+                    current = pipe.get(key) or ''
+                    # The moved copy was stored first
+                    merged = merge_series(conn.get(temp), current, fmt)
+                    pipe.multi()
+                    pipe.set(key, merged)
+                    pipe.execute()
+                    break
+                except WatchError:
+                    continue
+                finally:
+                    pipe.reset()
+        # Anything else, the copy written since is newer
+    finally:
+        conn.delete(temp)
+
+
+def move(conns, source, keys, old_hash, old_replication, new_hash, replication, delete):
+    """
+    Copy a batch of keys from source to their new owners. Returns the number
+    of keys copied and merged.
+    """
+    moves = []
+    for key in keys:
+        if key.startswith(TEMP_PREFIX):
+            continue
+        old_owners = old_hash.nodes(key)[:old_replication]
+        # The other replicas hold copies of the same key
+        if old_owners[0] != source:
+            continue
+        new_owners = new_hash.nodes(key)[:replication]
+        targets = [backend for backend in new_owners if backend not in old_owners]
+        stale = delete and source not in new_owners
+        if targets or stale:
+            moves.append((key, targets, stale))
+    if not moves:
+        return 0, 0
+
+    pipe = conns[source].pipeline(transaction=False)
+    for key, targets, stale in moves:
+        pipe.type(key)
+        pipe.pttl(key)
+        pipe.dump(key)
+    replies = pipe.execute()
+
+    restores = defaultdict(list)
+    for i, (key, targets, stale) in enumerate(moves):
+        kind, pttl, dumped = replies[i * 3:i * 3 + 3]
+        # Gone since the SCAN
+        if dumped is None:
+            continue
+        for target in targets:
+            restores[target].append((key, kind, max(pttl, 0), dumped))
+
+    copied = 0
+    merged = 0
+    for target, items in restores.iteritems():
+        pipe = conns[target].pipeline(transaction=False)
+        for key, kind, ttl, dumped in items:
+            pipe.restore(key, ttl, dumped)
+        for (key, kind, ttl, dumped), result in zip(items, pipe.execute(raise_on_error=False)):
+            if isinstance(result, ResponseError):
+                merge(conns[target], key, kind, dumped)
+                merged += 1
+            else:
+                copied += 1
+
+    stale = [key for key, targets, stale in moves if stale]
+    if stale:
+        conns[source].delete(*stale)
+
+    return copied, merged
+
+
+def rebalance(old_backends, old_replication, batch, delete):
+    ring = RedisRing(settings.REDIS_BACKENDS)
+    old_hash = ConsistentHash(old_backends, getattr(settings, 'REDIS_WEIGHTS', {}),
+                              getattr(settings, 'REDIS_VNODES', 40))
+
+    conns = dict(ring.connections)
+    for backend in old_backends:
+        if backend not in conns:
+            conns[backend] = ring._connect(backend)
+
+    for source in old_backends:
+        print 'Scanning %s...' % source
+        copied = 0
+        merged = 0
+        keys = []
+        for key in conns[source].scan_iter(count=batch):
+            keys.append(key)
+            if len(keys) >= batch:
+                counts = move(conns, source, keys, old_hash, old_replication,
+                              ring.hash, ring.replication, delete)
+                copied += counts[0]
+                merged += counts[1]
+                keys = []
+        counts = move(conns, source, keys, old_hash, old_replication,
+                      ring.hash, ring.replication, delete)
+        copied += counts[0]
+        merged += counts[1]
+        print 'Copied %d keys and merged %d from %s' % (copied, merged, source)
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option("-o", "--old", dest="old",
+                      help="The comma separated REDIS_BACKENDS keys were placed with")
+    parser.add_option("-r", "--old-replication", dest="old_replication", type="int", default=1,
+                      help="The REDIS_REPLICATION keys were placed with")
+    parser.add_option("-b", "--batch", dest="batch", type="int", default=500,
+                      help="The number of keys to move per pipeline")
+    parser.add_option("-d", "--delete", dest="delete", action="store_true", default=False,
+                      help="Delete moved keys from the backends that no longer own them")
+    (options, args) = parser.parse_args()
+
+    if not options.old:
+        parser.error('--old is required')
+
+    rebalance(options.old.split(','), options.old_replication, options.batch, options.delete)